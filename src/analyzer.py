@@ -6,9 +6,11 @@ from typing import List, Dict, Tuple
 
 from feature_lib import Particle, import_default_features
 from generator import Generator
-from rules import Rule, RuleFamily, import_default_rules
+from rules import Rule, RuleFamily, ExampleType, import_default_rules
 from sound import Sound
-from templates import Template, import_default_templates, import_default_phonemes
+from templates import Template, import_default_templates
+from phonemes import import_default_phonemes
+from applicability import ApplicabilityMatrix
 
 if __name__ == '__main__':
     tup = import_default_features()
@@ -18,27 +20,37 @@ if __name__ == '__main__':
     type_to_features = tup[2]  # type: Dict[str, List[str]]
     feature_to_type = tup[3]  # type: Dict[str, str]
     feature_to_sounds = tup[4]  # type: Dict[str, List[Sound]]
-    features_to_sound = tup[5]  # type: Dict[Particle, Sound]
+    features_to_sound = tup[5]  # type: Dict[Tuple[str, ...], Sound]
 
     templates = import_default_templates(features)  # type: List[Template]
 
-    rule_data = import_default_rules(features)  # type: Tuple[List[RuleFamily], List[Rule]]
+    rule_data: Tuple[List[RuleFamily], List[Rule]] = import_default_rules(features, feature_to_type, feature_to_sounds)
     rule_families = rule_data[0]  # type: List[RuleFamily]
     rules = rule_data[1]  # type: List[Rule]
 
     phonemes = import_default_phonemes()
 
+    matrix = ApplicabilityMatrix(rules, phonemes, templates, feature_to_type, feature_to_sounds)
     row_data = []
 
     for rule in rules:
         print("\n\n", str(rule), ":")
         success = True
         data = [str(rule)]  # type:list
+        available = [str(matrix.get(rule).get_word_count(t)) for t in ExampleType]
+
+        if not matrix.is_applicable(rule):
+            data.extend(["-" for _ in range(0, 5)])
+            data.append("NOT APPLICABLE")
+            data.extend(available)
+            row_data.append(data)
+            print(False, '\n\n')
+            continue
 
         try:
-            gen = Generator(phonemes, templates, rule, 5, feature_to_type, feature_to_sounds)
+            with Generator(phonemes, templates, rule, 5, feature_to_type, feature_to_sounds) as gen:
+                result = gen.generate(20, feature_to_type, feature_to_sounds)
 
-            result = gen.generate(20, feature_to_type, feature_to_sounds)
             amounts = [str(i) for i in result[4]]
         except:
             success = False
@@ -54,6 +66,7 @@ if __name__ == '__main__':
             else:
                 data.append("-")
 
+        data.extend(available)
         row_data.append(data)
         print(success, '\n\n')
 
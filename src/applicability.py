@@ -0,0 +1,528 @@
+from __future__ import annotations
+
+from collections import Counter
+from itertools import product
+from typing import List, Dict, Tuple, Optional, Set, FrozenSet, Iterable
+
+from word import Word
+from rules import Rule, ExampleType
+from templates import Template
+from phonotactics import Phonotactics
+from sound import Sound
+from feature_lib import FeatureSoundMap
+from batch import CADT_BIT, CADNT_BIT, CAND_BIT, NCAD_BIT, PATTERN_UNCHANGED, PATTERN_CHANGED, PATTERN_ERROR
+
+_NO_PATTERN = -1
+_ERROR_STATE = None
+
+
+class RuleApplicability:
+    """
+    What one rule can produce from the words of a template set over a phoneme inventory, counting only the words that
+    keep to the phonotactics of their template and of the inventory.
+
+    Each classification outcome of a template word is a tuple holding, per C/D alternative, the example types classify
+    reports, or None when classifying the word raises. Every outcome comes with the exact number of template words
+    getting it.
+    """
+    _rule: Rule
+    _outcomes: Dict[Template, Dict[Optional[Tuple[FrozenSet[ExampleType], ...]], int]]
+    _a_to_b: List[Tuple[Word, Word]]
+
+    def __init__(self, rule: Rule,
+                 outcomes: Dict[Template, Dict[Optional[Tuple[FrozenSet[ExampleType], ...]], int]],
+                 a_to_b: List[Tuple[Word, Word]]) -> None:
+        self._rule = rule
+        self._outcomes = outcomes
+        self._a_to_b = a_to_b
+
+    def get_rule(self) -> Rule:
+        return self._rule
+
+    def get_outcomes(self, template: Template) -> Set[Optional[Tuple[FrozenSet[ExampleType], ...]]]:
+        return set(self._outcomes[template])
+
+    def get_outcome_counts(self, template: Template) -> Dict[Optional[Tuple[FrozenSet[ExampleType], ...]], int]:
+        return dict(self._outcomes[template])
+
+    def get_counts(self, template: Optional[Template] = None) -> Dict[ExampleType, List[int]]:
+        """
+        :return: per example type, the number of words of template (of every template if None) getting it in each C/D
+                 alternative; words whose classification raises are not counted
+        """
+        result = {t: [0] * len(self._rule.get_edges()[0]) for t in ExampleType}  # type: Dict[ExampleType, List[int]]
+
+        for outcome, n in self._get_outcome_counts(template).items():
+            if outcome is None:
+                continue
+
+            for i in range(0, len(outcome)):
+                for example_type in outcome[i]:
+                    result[example_type][i] += n
+
+        return result
+
+    def get_word_count(self, example_type: ExampleType, template: Optional[Template] = None) -> int:
+        """
+        :return: the number of words of template (of every template if None) getting example_type in some alternative
+        """
+        return sum([n for outcome, n in self._get_outcome_counts(template).items()
+                    if outcome is not None and True in [example_type in types for types in outcome]])
+
+    def get_error_count(self, template: Optional[Template] = None) -> int:
+        return self._get_outcome_counts(template).get(None, 0)
+
+    def _get_outcome_counts(self, template: Optional[Template]) -> Dict[
+            Optional[Tuple[FrozenSet[ExampleType], ...]], int]:
+        if template is not None:
+            return self._outcomes[template]
+
+        result = Counter()
+
+        for counts in self._outcomes.values():
+            result.update(counts)
+
+        return result
+
+    def get_reachable_types(self, alternative: int, template: Optional[Template] = None) -> Set[ExampleType]:
+        """
+        :return: example types some word of template (of any template if None) gets in the C/D alternative
+        """
+        templates = list(self._outcomes.keys()) if template is None else [template]
+        result = set()  # type: Set[ExampleType]
+
+        for t in templates:
+            for outcome in self._outcomes[t]:
+                if outcome is not None:
+                    result.update(outcome[alternative])
+
+        return result
+
+    def get_firing_alternatives(self) -> List[int]:
+        """
+        :return: the C/D alternatives in which some word gets changed
+        """
+        return [i for i in range(0, len(self._rule.get_edges()[0]))
+                if ExampleType.CADT in self.get_reachable_types(i)]
+
+    def get_a_to_b(self) -> List[Tuple[Word, Word]]:
+        """
+        :return: A patterns some template can put where the rule changes them, with what they become
+        """
+        return [pair for pair in self._a_to_b]
+
+    def can_raise(self) -> bool:
+        return True in [None in outcomes for outcomes in self._outcomes.values()]
+
+    def is_applicable(self) -> bool:
+        return len(self.get_firing_alternatives()) > 0
+
+
+class ApplicabilityMatrix:
+    """
+    RuleApplicability of every rule for one phoneme inventory and template set, computed up front without generating
+    or classifying sample words.
+    """
+    _entries: Dict[Rule, RuleApplicability]
+
+    def __init__(self, rules: List[Rule], phonemes: List[Word], templates: List[Template],
+                 feature_to_type: Dict[str, str], feature_to_sounds: Dict[str, List[Sound]],
+                 phonotactics: Optional[Phonotactics] = None) -> None:
+        """
+        :param phonotactics: constraints of the phoneme inventory, on top of those of each template
+        """
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        self._entries = {}
+        template_sets = {t: _get_template_sets(t, phonemes, feature_to_sounds) for t in templates}
+        template_phonotactics = {t: phonotactics if t.get_phonotactics() is None else
+                                 t.get_phonotactics().union(phonotactics) for t in templates}
+
+        for rule in rules:
+            self._entries[rule] = _analyze(rule, template_sets, template_phonotactics, phonemes, feature_to_type,
+                                           feature_to_sounds)
+
+    def get(self, rule: Rule) -> RuleApplicability:
+        return self._entries[rule]
+
+    def is_applicable(self, rule: Rule) -> bool:
+        return self._entries[rule].is_applicable()
+
+    def get_applicable_rules(self) -> List[Rule]:
+        return [r for r, entry in self._entries.items() if entry.is_applicable()]
+
+
+class _CompiledRule:
+    """
+    the parts of a rule over one phoneme inventory that decide classification
+    """
+    statuses: Dict[int, int]
+    single_sound: bool
+    c_contexts: List[Optional[List[Set[int]]]]
+    d_contexts: List[Optional[List[Set[int]]]]
+    c_edges: List[bool]
+    d_edges: List[bool]
+    dead: List[bool]
+    replacements: Dict[Word, object]
+
+    def __init__(self, rule: Rule, phonemes: List[Word], feature_to_type: Dict[str, str],
+                 feature_to_sounds: FeatureSoundMap) -> None:
+        self.replacements = rule.get_replacements(phonemes, feature_to_type, feature_to_sounds)
+        self.statuses = {}
+        self.single_sound = True
+
+        for pattern, replaced in self.replacements.items():
+            if len(pattern) != 1:
+                self.single_sound = self.single_sound and len(pattern) == 0
+                continue
+
+            if isinstance(replaced, Exception):
+                self.statuses[pattern.get_ids()[0]] = PATTERN_ERROR
+            else:
+                self.statuses[pattern.get_ids()[0]] = PATTERN_CHANGED if replaced != pattern else PATTERN_UNCHANGED
+
+        c_contexts, d_contexts = rule.get_contexts(phonemes, feature_to_sounds)
+        self.c_contexts = [None if c is None or len(c) == 0 else c for c in c_contexts]
+        self.d_contexts = [None if d is None or len(d) == 0 else d for d in d_contexts]
+        self.c_edges, self.d_edges = rule.get_edges()
+        self.dead = [True in [len(s) == 0 for s in (c or []) + (d or [])]
+                     for c, d in zip(self.c_contexts, self.d_contexts)]
+
+    def get_signature(self, num: int) -> Tuple[int, Tuple[Tuple[int, int], ...]]:
+        """
+        everything classification can tell about the sound: its A pattern status and, per alternative, bit k set for
+        every position k of C and of D it matches
+        """
+        alternatives = []
+
+        for c, d in zip(self.c_contexts, self.d_contexts):
+            c_bits = 0 if c is None else sum([1 << k for k in range(0, len(c)) if num in c[k]])
+            d_bits = 0 if d is None else sum([1 << k for k in range(0, len(d)) if num in d[k]])
+            alternatives.append((c_bits, d_bits))
+
+        return self.statuses.get(num, _NO_PATTERN), tuple(alternatives)
+
+
+def _get_template_sets(template: Template, phonemes: List[Word], feature_to_sounds: FeatureSoundMap) -> List[Set[int]]:
+    return [set(s.get_num() for s in p.get_matching_sounds(phonemes, feature_to_sounds))
+            for p in template.get_components()]
+
+
+def _analyze(rule: Rule, template_sets: Dict[Template, List[Set[int]]],
+             template_phonotactics: Dict[Template, Optional[Phonotactics]], phonemes: List[Word],
+             feature_to_type: Dict[str, str], feature_to_sounds: FeatureSoundMap) -> RuleApplicability:
+    compiled = _CompiledRule(rule, phonemes, feature_to_type, feature_to_sounds)
+    outcomes = {}  # type: Dict[Template, Dict[Optional[Tuple[FrozenSet[ExampleType], ...]], int]]
+    a_to_b = {}  # type: Dict[Word, Word]
+
+    for template, sets in template_sets.items():
+        phonotactics = template_phonotactics[template]
+
+        if compiled.single_sound:
+            outcomes[template] = _count_outcomes(compiled, sets, phonotactics, feature_to_sounds)
+        else:
+            outcomes[template] = _enumerate_outcomes(rule, compiled, sets, phonotactics, phonemes, feature_to_type,
+                                                     feature_to_sounds)
+
+        for pattern, replaced in compiled.replacements.items():
+            if pattern not in a_to_b and not isinstance(replaced, Exception) and replaced != pattern and \
+                    _can_change(compiled, sets, pattern, phonotactics, feature_to_sounds):
+                a_to_b[pattern] = replaced
+
+    return RuleApplicability(rule, outcomes, list(a_to_b.items()))
+
+
+def _can_change(compiled: _CompiledRule, sets: List[Set[int]], pattern: Word,
+                phonotactics: Optional[Phonotactics], feature_to_sounds: FeatureSoundMap) -> bool:
+    """
+    whether some word of the template keeping to phonotactics has pattern with a matching C before it and a matching D
+    after it
+    """
+    ids = pattern.get_ids()
+    size = len(ids)
+    word_len = len(sets)
+
+    for loc in range(0, word_len - size + 1):
+        if False in [ids[k] in sets[loc + k] for k in range(0, size)]:
+            continue
+
+        d_loc = loc + size
+
+        for i in range(0, len(compiled.dead)):
+            c = compiled.c_contexts[i]
+            d = compiled.d_contexts[i]
+
+            if compiled.dead[i]:
+                continue
+
+            if c is None:
+                c = []
+
+                if compiled.c_edges[i] and loc > 0:
+                    continue
+            elif loc < len(c) or (compiled.c_edges[i] and loc > len(c)):
+                continue
+
+            if d is None:
+                d = []
+
+                if compiled.d_edges[i] and d_loc < word_len:
+                    continue
+            elif d_loc + len(d) > word_len or (compiled.d_edges[i] and d_loc + len(d) < word_len):
+                continue
+
+            # the slots narrowed to the sounds such a word can have there
+            narrowed = [s for s in sets]
+
+            for k in range(0, len(c)):
+                narrowed[loc - len(c) + k] = c[k] & sets[loc - len(c) + k]
+
+            for k in range(0, size):
+                narrowed[loc + k] = {ids[k]}
+
+            for k in range(0, len(d)):
+                narrowed[d_loc + k] = d[k] & sets[d_loc + k]
+
+            if 0 not in [len(s) for s in narrowed] and \
+                    (phonotactics is None or _count_words(narrowed, phonotactics, feature_to_sounds) > 0):
+                return True
+
+    return False
+
+
+def _count_words(slots: List[Iterable[int]], phonotactics: Phonotactics, feature_to_sounds: FeatureSoundMap) -> int:
+    """
+    :return: the number of words with a sound of each slot that keep to phonotactics
+    """
+    states = {(): 1}  # type: Dict[Tuple[int, ...], int]
+
+    for sounds in slots:
+        next_states = Counter()
+
+        for window, n in states.items():
+            for num in sounds:
+                ids = window + (num,)
+
+                if phonotactics.allows_end(ids, feature_to_sounds):
+                    next_states[_keep_window(ids, phonotactics)] += n
+
+        states = next_states
+
+    return sum(states.values())
+
+
+def _keep_window(ids: Tuple[int, ...], phonotactics: Phonotactics) -> Tuple[int, ...]:
+    """
+    the last sounds of ids the windows ending at the next sounds still look at
+    """
+    return ids[-(phonotactics.get_span() - 1):] if phonotactics.get_span() > 1 else ()
+
+
+def _count_outcomes(compiled: _CompiledRule, sets: List[Set[int]], phonotactics: Optional[Phonotactics],
+                    feature_to_sounds: FeatureSoundMap) -> Dict[
+        Optional[Tuple[FrozenSet[ExampleType], ...]], int]:
+    """
+    Classification outcomes of the template's words with how many words get each, for rules whose A patterns are
+    single sounds.
+
+    Runs over the template slots keeping the reachable states, and how many word prefixes reach each, instead of the
+    words themselves. Sounds with the same signature are interchangeable, so each slot only branches once per
+    signature, weighted by the number of its sounds having it. A state holds, per alternative, the Shift-And progress
+    of C and the sites still waiting for D to be read, together with the example type flags seen so far.
+
+    Under phonotactics sounds of one signature are not interchangeable any more: a state also holds the last sounds
+    later constraint windows look at, and each slot branches once per sound, dropping the prefixes a window ending
+    there bans.
+    """
+    word_len = len(sets)
+    alternatives = len(compiled.dead)
+    states = {((tuple([None if compiled.dead[i] else (0, ()) for i in range(0, alternatives)]),
+                tuple([0] * alternatives), False), ()): 1}
+
+    for j in range(0, word_len):
+        next_states = Counter()
+
+        if phonotactics is None:
+            signatures = Counter(compiled.get_signature(num) for num in sets[j])
+
+            for (state, window), n in states.items():
+                for signature, weight in signatures.items():
+                    next_states[(_step(compiled, state, signature, j, word_len), window)] += n * weight
+        else:
+            signatures = {num: compiled.get_signature(num) for num in sets[j]}
+
+            for (state, window), n in states.items():
+                for num, signature in signatures.items():
+                    ids = window + (num,)
+
+                    if phonotactics.allows_end(ids, feature_to_sounds):
+                        next_states[(_step(compiled, state, signature, j, word_len),
+                                     _keep_window(ids, phonotactics))] += n
+
+        states = next_states
+
+    outcomes = Counter()
+
+    for (state, _), n in states.items():
+        outcomes[_finish(compiled, state)] += n
+
+    return dict(outcomes)
+
+
+def _step(compiled: _CompiledRule, state: Optional[Tuple[tuple, Tuple[int, ...], bool]],
+          signature: Tuple[int, Tuple[Tuple[int, int], ...]], j: int, word_len: int) -> Optional[
+        Tuple[tuple, Tuple[int, ...], bool]]:
+    if state is _ERROR_STATE:
+        return _ERROR_STATE
+
+    alt_states, flags, has_site = state
+    status, alt_signatures = signature
+    new_states = []
+    new_flags = []
+
+    for i in range(0, len(alt_states)):
+        if alt_states[i] is None:
+            new_states.append(None)
+            new_flags.append(0)
+            continue
+
+        c_progress, pending = alt_states[i]
+        c_bits, d_bits = alt_signatures[i]
+        c = compiled.c_contexts[i]
+        d = compiled.d_contexts[i]
+        flag = flags[i]
+        waiting = []
+
+        for matched, is_c, site_status in pending:
+            if (d_bits >> matched) & 1 == 0:
+                flag = _resolve(flag, is_c, False, site_status)
+            elif matched + 1 == len(d):
+                flag = _resolve(flag, is_c, not compiled.d_edges[i] or j == word_len - 1, site_status)
+            else:
+                waiting.append((matched + 1, is_c, site_status))
+
+            if flag is None:
+                return _ERROR_STATE
+
+        if status != _NO_PATTERN:
+            if c is None:
+                is_c = not compiled.c_edges[i] or j == 0
+            else:
+                is_c = (c_progress >> (len(c) - 1)) & 1 == 1 and (not compiled.c_edges[i] or j == len(c))
+
+            if d is None:
+                flag = _resolve(flag, is_c, not compiled.d_edges[i] or j == word_len - 1, status)
+
+                if flag is None:
+                    return _ERROR_STATE
+            else:
+                waiting.append((0, is_c, status))
+
+        new_states.append((0 if c is None else ((c_progress << 1) | 1) & c_bits, tuple(waiting)))
+        new_flags.append(flag)
+
+    return tuple(new_states), tuple(new_flags), has_site or status != _NO_PATTERN
+
+
+def _resolve(flag: int, is_c: bool, is_d: bool, status: int) -> Optional[int]:
+    """
+    flag with the site's example type added, None when classifying the site raises
+    """
+    if is_c and is_d:
+        if status == PATTERN_ERROR:
+            return None
+
+        return flag | (CADT_BIT if status == PATTERN_CHANGED else CADNT_BIT)
+
+    if is_c:
+        return flag | CAND_BIT
+
+    if is_d:
+        return flag | NCAD_BIT
+
+    return flag
+
+
+def _finish(compiled: _CompiledRule, state: Optional[Tuple[tuple, Tuple[int, ...], bool]]) -> Optional[
+        Tuple[FrozenSet[ExampleType], ...]]:
+    if state is _ERROR_STATE:
+        return None
+
+    alt_states, flags, has_site = state
+
+    if not has_site:
+        return tuple([frozenset([ExampleType.IRR]) for _ in alt_states])
+
+    result = []
+
+    for i in range(0, len(alt_states)):
+        if alt_states[i] is None:
+            result.append(frozenset())
+            continue
+
+        flag = flags[i]
+
+        # sites still waiting for D ran out of word
+        for _, is_c, site_status in alt_states[i][1]:
+            flag = _resolve(flag, is_c, False, site_status)
+
+        result.append(_to_types(flag))
+
+    return tuple(result)
+
+
+def _to_types(flag: int) -> FrozenSet[ExampleType]:
+    if flag & CADT_BIT:
+        return frozenset([ExampleType.CADT])
+
+    if flag & CADNT_BIT:
+        return frozenset([ExampleType.CADNT])
+
+    return frozenset([t for t, bit in ((ExampleType.CAND, CAND_BIT), (ExampleType.NCAD, NCAD_BIT)) if flag & bit])
+
+
+def _enumerate_outcomes(rule: Rule, compiled: _CompiledRule, sets: List[Set[int]],
+                        phonotactics: Optional[Phonotactics], phonemes: List[Word],
+                        feature_to_type: Dict[str, str], feature_to_sounds: FeatureSoundMap) -> Dict[
+        Optional[Tuple[FrozenSet[ExampleType], ...]], int]:
+    """
+    Classification outcomes of the template's words with how many words get each, for rules with longer A patterns,
+    by classifying one word per sequence of sound signatures. Sounds of A patterns keep their own signature. Under
+    phonotactics a sequence weighs as many words as keep to them among those its sounds make.
+    """
+    pattern_sounds = set(num for pattern in compiled.replacements.keys() for num in pattern.get_ids())
+    slots = []  # type: List[List[List[int]]]
+
+    for sounds in sets:
+        classes = {}  # type: Dict[tuple, List[int]]
+
+        for num in sorted(sounds):
+            key = (num if num in pattern_sounds else _NO_PATTERN, compiled.get_signature(num)[1])
+            classes.setdefault(key, []).append(num)
+
+        slots.append(list(classes.values()))
+
+    inventory = feature_to_sounds.get_inventory()
+    outcomes = Counter()
+
+    for choice in product(*slots):
+        if phonotactics is None:
+            weight = 1
+
+            for nums in choice:
+                weight *= len(nums)
+        else:
+            weight = _count_words(list(choice), phonotactics, feature_to_sounds)
+
+            if weight == 0:
+                continue
+
+        try:
+            types = rule.classify(Word.from_ids([nums[0] for nums in choice], inventory), phonemes, feature_to_type,
+                                  feature_to_sounds)
+            outcomes[tuple([frozenset(t.keys()) for t in types])] += weight
+        except (NotImplementedError, ValueError, KeyError):
+            outcomes[None] += weight
+
+    return dict(outcomes)
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import List, Dict, Optional, Set, Tuple
+
+from word import Word
+
+
+class PatternAutomaton:
+    """
+    Aho-Corasick automaton over sound numbers, finding every occurrence of a list of patterns in one left-to-right
+    pass. Patterns are ranked by their order in the list; where several match at one position, the site is ordered by
+    the first of them and sized by the last, as a pattern-by-pattern search overwriting earlier results would report.
+    """
+    _patterns: List[Tuple[int, int, Word]]
+    _goto: List[Dict[int, int]]
+    _fail: List[int]
+    _outputs: List[List[Tuple[int, int]]]
+
+    def __init__(self, patterns: List[Word]) -> None:
+        self._patterns = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        pattern_index = {}  # type: Dict[Tuple[int, ...], int]
+
+        for rank in range(0, len(patterns)):
+            pattern = patterns[rank]
+            key = tuple(pattern.get_ids())
+
+            if len(key) == 0:
+                continue
+
+            if key in pattern_index:
+                index = pattern_index[key]
+                self._patterns[index] = (self._patterns[index][0], rank, pattern)
+                continue
+
+            pattern_index[key] = len(self._patterns)
+            self._patterns.append((rank, rank, pattern))
+            state = 0
+
+            for num in key:
+                if num not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                    self._goto[state][num] = len(self._goto) - 1
+
+                state = self._goto[state][num]
+
+            self._outputs[state].append((len(key), pattern_index[key]))
+
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for num, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+
+                while fallback != 0 and num not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+
+                self._fail[child] = self._goto[fallback].get(num, 0)
+                self._outputs[child] = self._outputs[child] + self._outputs[self._fail[child]]
+
+    def step(self, state: int, num: int) -> int:
+        goto = self._goto
+        fail = self._fail
+
+        while state != 0 and num not in goto[state]:
+            state = fail[state]
+
+        return goto[state].get(num, 0)
+
+    def collect(self, state: int, end: int, sites: Dict[int, Tuple[int, int, Word]]) -> None:
+        """
+        record into sites, by location, the patterns ending at position end in the given state
+        """
+        for size, index in self._outputs[state]:
+            begin = end - size + 1
+            match = self._patterns[index]
+            known = sites.get(begin)
+
+            if known is None:
+                sites[begin] = match
+            else:
+                first = known if known[0] <= match[0] else match
+                last = known if known[1] >= match[1] else match
+                sites[begin] = (first[0], last[1], last[2])
+
+    def find(self, word: Word) -> List[Tuple[int, int, Word]]:
+        """
+        :return: match sites as (location, size, pattern) in pattern order
+        """
+        sites = {}  # type: Dict[int, Tuple[int, int, Word]]
+        state = 0
+        ids = word.get_ids()
+
+        for j in range(0, len(ids)):
+            state = self.step(state, ids[j])
+            self.collect(state, j, sites)
+
+        return _order_sites(sites)
+
+
+def _order_sites(sites: Dict[int, Tuple[int, int, Word]]) -> List[Tuple[int, int, Word]]:
+    ordered = sorted(sites.items(), key=lambda item: (item[1][0], item[0]))
+    return [(loc, len(match[2]), match[2]) for loc, match in ordered]
+
+
+class RuleAutomaton:
+    """
+    Finite-state matcher for one rule over one phoneme inventory, working on sound numbers.
+
+    Every C and D context is a sequence of per-position sound sets. All contexts run together as one bit-parallel
+    Shift-And automaton: bit k of a context's segment is set after reading position j when the first k + 1 positions of
+    the context match the sounds ending at j. A patterns run through a PatternAutomaton stepped alongside. A single
+    left-to-right scan therefore yields the A sites and, per C/D alternative, where C matches end and D matches start.
+    """
+    _a_automaton: PatternAutomaton
+    _masks: Dict[int, int]
+    _starts: int
+    _finals: int
+    _final_segments: Dict[int, Tuple[int, bool, int]]
+    _alternatives: int
+    _dead: Set[int]
+
+    def __init__(self, a_automaton: PatternAutomaton, c_contexts: List[Optional[List[Set[int]]]],
+                 d_contexts: List[Optional[List[Set[int]]]]) -> None:
+        """
+        :param a_automaton: the rule's A patterns
+        :param c_contexts: per alternative, the C sound sets, or None when the alternative has no C
+        :param d_contexts: per alternative, the D sound sets, or None when the alternative has no D
+        """
+        self._a_automaton = a_automaton
+        self._alternatives = len(c_contexts)
+        self._masks = {}
+        self._starts = 0
+        self._finals = 0
+        self._final_segments = {}
+        self._dead = set()
+        offset = 0
+
+        for i in range(0, self._alternatives):
+            for is_c, context in ((True, c_contexts[i]), (False, d_contexts[i])):
+                if context is None or len(context) == 0:
+                    continue
+
+                if True in [len(sounds) == 0 for sounds in context]:
+                    self._dead.add(i)
+
+                self._starts |= 1 << offset
+
+                for k in range(0, len(context)):
+                    for num in context[k]:
+                        self._masks[num] = self._masks.get(num, 0) | (1 << (offset + k))
+
+                final = 1 << (offset + len(context) - 1)
+                self._finals |= final
+                self._final_segments[final] = (i, is_c, len(context))
+                offset += len(context)
+
+    def is_dead(self, alternative: int) -> bool:
+        """
+        whether some position of the alternative's C or D matches no sound at all
+        """
+        return alternative in self._dead
+
+    def scan(self, word: Word) -> Tuple[List[Tuple[int, int, Word]], List[int], List[int]]:
+        """
+        :return: A sites as (location, size of the last matching pattern, pattern) in matcher order; per alternative,
+                 a bitset of the positions where a C match ends and a bitset of the positions where a D match starts
+        """
+        ids = word.get_ids()
+        c_ends = [0] * self._alternatives
+        d_starts = [0] * self._alternatives
+        sites = {}  # type: Dict[int, Tuple[int, int, Word]]
+        state = 0
+        a_state = 0
+        a_automaton = self._a_automaton
+        masks = self._masks
+        starts = self._starts
+        finals = self._finals
+
+        for j in range(0, len(ids)):
+            state = ((state << 1) | starts) & masks.get(ids[j], 0)
+            hits = state & finals
+
+            while hits:
+                low = hits & -hits
+                hits ^= low
+                alternative, is_c, size = self._final_segments[low]
+
+                if is_c:
+                    c_ends[alternative] |= 1 << j
+                else:
+                    d_starts[alternative] |= 1 << (j - size + 1)
+
+            a_state = a_automaton.step(a_state, ids[j])
+            a_automaton.collect(a_state, j, sites)
+
+        return _order_sites(sites), c_ends, d_starts
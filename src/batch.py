@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+from typing import List, Optional, Set, Tuple, Dict
+
+from word import Word
+from inventory import Inventory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CADT_BIT = 1
+CADNT_BIT = 2
+CAND_BIT = 4
+NCAD_BIT = 8
+IRR_BIT = 16
+
+PATTERN_UNCHANGED = 0
+PATTERN_CHANGED = 1
+PATTERN_ERROR = 2
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise ImportError("numpy is required for batch classification")
+
+
+def to_id_matrix(words: List[Word], pad: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the sound numbers of words as rows of a 2-D array padded with pad, and the length of every word
+    """
+    _require_numpy()
+    lengths = np.array([len(w) for w in words], dtype=np.intp)
+    ids = np.full((len(words), int(lengths.max()) if len(words) > 0 else 0), pad, dtype=np.uint16)
+
+    for i in range(0, len(words)):
+        ids[i, :lengths[i]] = words[i].get_ids()
+
+    return ids, lengths
+
+
+def to_words(ids: np.ndarray, lengths: np.ndarray, inventory: Inventory) -> List[Word]:
+    _require_numpy()
+    return [Word.from_ids(ids[i, :lengths[i]].tolist(), inventory) for i in range(0, len(lengths))]
+
+
+class RuleBatch:
+    """
+    One rule over one phoneme inventory compiled into lookup tables indexed by sound number, classifying and rewriting
+    whole matrices of words with boolean masks shifted across positions.
+
+    Every A pattern has a rank, its position in the rule's matcher. At each position the matching pattern of highest
+    rank decides the site, which sizes the site like the per-word classification does.
+    """
+    _num_count: int
+    _rank_by_num: np.ndarray
+    _pattern_by_num: np.ndarray
+    _long_patterns: List[Tuple[int, int, Tuple[int, ...]]]
+    _sizes: np.ndarray
+    _status: np.ndarray
+    _errors: Dict[int, Exception]
+    _replacements: np.ndarray
+    _replacement_lengths: np.ndarray
+    _c_tables: List[Optional[List[np.ndarray]]]
+    _d_tables: List[Optional[List[np.ndarray]]]
+    _c_edges: List[bool]
+    _d_edges: List[bool]
+    _dead: List[bool]
+
+    def __init__(self, num_count: int, a_patterns: List[Word], replacements: Dict[Word, object],
+                 c_contexts: List[Optional[List[Set[int]]]], c_edges: List[bool],
+                 d_contexts: List[Optional[List[Set[int]]]], d_edges: List[bool]) -> None:
+        """
+        :param num_count: one more than the highest sound number of the inventory
+        :param a_patterns: A patterns in matcher order
+        :param replacements: per A pattern, the word replacing it or the error raised replacing it
+        :param c_contexts: per alternative, the C sound sets, or None when the alternative has no C
+        :param d_contexts: per alternative, the D sound sets, or None when the alternative has no D
+        """
+        _require_numpy()
+        self._num_count = num_count
+        self._rank_by_num = np.full(num_count, -1, dtype=np.intp)
+        self._pattern_by_num = np.zeros(num_count, dtype=np.intp)
+        self._long_patterns = []
+        self._errors = {}
+        pattern_index = {}  # type: Dict[Tuple[int, ...], int]
+        sizes = []  # type: List[int]
+        status = []  # type: List[int]
+        replaced = []  # type: List[List[int]]
+
+        for rank in range(0, len(a_patterns)):
+            pattern = a_patterns[rank]
+            key = tuple(pattern.get_ids())
+
+            if len(key) == 0:
+                continue
+
+            if key not in pattern_index:
+                pattern_index[key] = len(sizes)
+                sizes.append(len(key))
+                replacement = replacements[pattern]
+
+                if isinstance(replacement, Exception):
+                    self._errors[len(status)] = replacement
+                    status.append(PATTERN_ERROR)
+                    replaced.append([])
+                else:
+                    status.append(PATTERN_CHANGED if replacement != pattern else PATTERN_UNCHANGED)
+                    replaced.append(list(replacement.get_ids()))
+
+            index = pattern_index[key]
+
+            if len(key) == 1:
+                self._rank_by_num[key[0]] = rank
+                self._pattern_by_num[key[0]] = index
+            else:
+                self._long_patterns.append((rank, index, key))
+
+        self._sizes = np.array(sizes + [0], dtype=np.intp)
+        self._status = np.array(status + [PATTERN_UNCHANGED], dtype=np.int8)
+        self._replacement_lengths = np.array([len(r) for r in replaced] + [0], dtype=np.intp)
+        self._replacements = np.zeros((len(replaced) + 1, max([len(r) for r in replaced] + [1])), dtype=np.intp)
+
+        for i in range(0, len(replaced)):
+            self._replacements[i, :len(replaced[i])] = replaced[i]
+
+        self._c_tables = [self._to_tables(c) for c in c_contexts]
+        self._d_tables = [self._to_tables(d) for d in d_contexts]
+        self._c_edges = c_edges
+        self._d_edges = d_edges
+        self._dead = [(c is not None and True in [len(s) == 0 for s in c]) or
+                      (d is not None and True in [len(s) == 0 for s in d]) for c, d in zip(c_contexts, d_contexts)]
+
+    def _to_tables(self, context: Optional[List[Set[int]]]) -> Optional[List[np.ndarray]]:
+        if context is None:
+            return None
+
+        tables = []
+
+        for sounds in context:
+            table = np.zeros(self._num_count, dtype=bool)
+            table[list(sounds)] = True
+            tables.append(table)
+
+        return tables
+
+    def classify(self, ids: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """
+        :return: per word and C/D alternative, the example types found as an OR of the *_BIT flags; an alternative
+                 whose context can never match has no flag at all
+        """
+        ids, lengths, valid = self._prepare(ids, lengths)
+        site, is_c, is_d, pattern = self._scan(ids, lengths, valid)
+        codes = np.zeros((len(lengths), len(self._dead)), dtype=np.uint8)
+        no_site = ~site.any(axis=1)
+        changed = self._status[pattern] == PATTERN_CHANGED
+
+        for i in range(0, len(self._dead)):
+            if self._dead[i]:
+                continue
+
+            cd = site & is_c[i] & is_d[i]
+            self._check_errors(cd, pattern)
+            cadt = (cd & changed).any(axis=1)
+            cadnt = cd.any(axis=1) & ~cadt
+            undecided = ~cd.any(axis=1)
+            cand = undecided & (site & is_c[i] & ~is_d[i]).any(axis=1)
+            ncad = undecided & (site & ~is_c[i] & is_d[i]).any(axis=1)
+            codes[:, i] = cadt * CADT_BIT | cadnt * CADNT_BIT | cand * CAND_BIT | ncad * NCAD_BIT
+
+        codes[no_site, :] = IRR_BIT
+
+        return codes
+
+    def apply(self, ids: np.ndarray, lengths: np.ndarray, pad: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: the rewritten words, padded with pad, and their lengths
+        """
+        raw_ids = ids
+        ids, lengths, valid = self._prepare(ids, lengths)
+        site, is_c, is_d, pattern = self._scan(ids, lengths, valid)
+        changed = site & (self._status[pattern] == PATTERN_CHANGED)
+        to_replace = np.zeros(ids.shape, dtype=bool)
+
+        for i in range(0, len(self._dead)):
+            if self._dead[i]:
+                continue
+
+            cd = site & is_c[i] & is_d[i]
+            self._check_errors(cd, pattern)
+            to_replace |= cd & changed
+
+        # only single sound patterns can be replaced, so every replaced site consumes exactly one position
+        out_sizes = np.where(to_replace, self._replacement_lengths[pattern], valid.astype(np.intp))
+        new_lengths = out_sizes.sum(axis=1)
+        starts = np.cumsum(out_sizes, axis=1) - out_sizes
+        result = np.full((len(lengths), int(new_lengths.max()) if len(lengths) > 0 else 0), pad,
+                         dtype=np.asarray(raw_ids).dtype)
+
+        rows, cols = np.nonzero(valid & ~to_replace)
+        result[rows, starts[rows, cols]] = ids[rows, cols]
+
+        for r in range(0, self._replacements.shape[1]):
+            rows, cols = np.nonzero(to_replace & (self._replacement_lengths[pattern] > r))
+            result[rows, starts[rows, cols] + r] = self._replacements[pattern[rows, cols], r]
+
+        return result, new_lengths
+
+    def _prepare(self, ids: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        ids = np.asarray(ids, dtype=np.intp)
+        lengths = np.asarray(lengths, dtype=np.intp)
+
+        if ids.ndim != 2 or lengths.shape != (ids.shape[0],):
+            raise ValueError("expect an (n, length) sound number array and n lengths, get %s and %s"
+                             % (str(ids.shape), str(lengths.shape)))
+
+        valid = np.arange(ids.shape[1]) < lengths[:, None]
+
+        return np.where(valid, ids, 0), lengths, valid
+
+    def _scan(self, ids: np.ndarray, lengths: np.ndarray, valid: np.ndarray) -> Tuple[
+        np.ndarray, List[np.ndarray], List[np.ndarray], np.ndarray]:
+        """
+        :return: where A sites begin, per alternative where C ends right before and where D starts right after the
+                 site, and the pattern index of every site
+        """
+        width = ids.shape[1]
+        rank = np.where(valid, self._rank_by_num[ids], -1)
+        pattern = np.where(rank >= 0, self._pattern_by_num[ids], len(self._sizes) - 1)
+
+        for pattern_rank, index, key in self._long_patterns:
+            if len(key) > width:
+                continue
+
+            matched = np.zeros(ids.shape, dtype=bool)
+            matched[:, :width - len(key) + 1] = valid[:, len(key) - 1:]
+
+            for k in range(0, len(key)):
+                matched[:, :width - len(key) + 1] &= ids[:, k:width - len(key) + 1 + k] == key[k]
+
+            better = matched & (pattern_rank > rank)
+            rank = np.where(better, pattern_rank, rank)
+            pattern = np.where(better, index, pattern)
+
+        site = rank >= 0
+        d_loc = np.arange(width)[None, :] + self._sizes[pattern]
+        is_c = []  # type: List[np.ndarray]
+        is_d = []  # type: List[np.ndarray]
+
+        for i in range(0, len(self._dead)):
+            c_before = self._match_ends(self._c_tables[i], ids, valid)
+            d_after = self._match_starts(self._d_tables[i], ids, valid)
+            positions = np.arange(width + 1)[None, :]
+
+            if self._c_edges[i]:
+                c_size = 0 if self._c_tables[i] is None else len(self._c_tables[i])
+                c_before &= positions == c_size
+
+            if self._d_edges[i]:
+                d_size = 0 if self._d_tables[i] is None else len(self._d_tables[i])
+                d_after &= positions + d_size == lengths[:, None]
+
+            is_c.append(c_before[:, :width])
+            is_d.append(np.take_along_axis(d_after, np.minimum(d_loc, width), axis=1))
+
+        return site, is_c, is_d, pattern
+
+    @staticmethod
+    def _match_ends(tables: Optional[List[np.ndarray]], ids: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        whether the context matches the sounds right before each position, positions 0 to width included
+        """
+        width = ids.shape[1]
+        result = np.ones((ids.shape[0], width + 1), dtype=bool)
+
+        if tables is None:
+            return result
+
+        size = len(tables)
+        result[:, :min(size, width + 1)] = False
+
+        if size <= width:
+            for k in range(0, size):
+                window = slice(k, width - size + 1 + k)
+                result[:, size:] &= tables[k][ids[:, window]] & valid[:, window]
+
+        return result
+
+    @staticmethod
+    def _match_starts(tables: Optional[List[np.ndarray]], ids: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        whether the context matches the sounds from each position on, positions 0 to width included
+        """
+        width = ids.shape[1]
+        result = np.ones((ids.shape[0], width + 1), dtype=bool)
+
+        if tables is None:
+            return result
+
+        size = len(tables)
+        result[:, max(width - size + 1, 0):] = False
+
+        if size <= width:
+            for k in range(0, size):
+                window = slice(k, width - size + 1 + k)
+                result[:, :width - size + 1] &= tables[k][ids[:, window]] & valid[:, window]
+
+        return result
+
+    def _check_errors(self, cd: np.ndarray, pattern: np.ndarray) -> None:
+        failed = cd & (self._status[pattern] == PATTERN_ERROR)
+
+        if failed.any():
+            rows, cols = np.nonzero(failed)
+            error = self._errors[int(pattern[rows[0], cols[0]])]
+            raise type(error)(*error.args)
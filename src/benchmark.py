@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import random
+import statistics
+import sys
+import warnings
+from time import perf_counter
+from typing import List, Dict, Tuple
+
+from feature_lib import Particle, import_default_features
+from generator import Generator
+from glossgroup import import_default_gloss
+from rules import Rule, RuleFamily, import_default_rules
+from sound import Sound
+from templates import Template, import_default_templates
+from phonemes import import_default_phonemes
+from applicability import ApplicabilityMatrix
+
+CALLS = 1000
+BUCKET = 100
+AMOUNT = 20
+
+
+def time_generate(gen: Generator, calls: int, feature_to_type: Dict[str, str],
+                  feature_to_sounds: Dict[str, List[Sound]], gloss_groups: list) -> List[Tuple[float, int]]:
+    """
+    :return: the seconds each of calls consecutive generate calls took with the number of words it returned, duplicate
+             exclusions kept between calls
+    """
+    latencies = []
+
+    for _ in range(0, calls):
+        start = perf_counter()
+        result = gen.generate(AMOUNT, False, feature_to_type, feature_to_sounds, gloss_groups)
+        latencies.append((perf_counter() - start, 0 if result is None else len(result[0])))
+
+    return latencies
+
+
+if __name__ == '__main__':
+    tup = import_default_features()
+
+    features = tup[0]  # type: List[str]
+    feature_to_type = tup[3]  # type: Dict[str, str]
+    feature_to_sounds = tup[4]  # type: Dict[str, List[Sound]]
+    features_to_sound = tup[5]  # type: Dict[Tuple[str, ...], Sound]
+
+    random.seed(0)
+    warnings.simplefilter("ignore")
+
+    templates = import_default_templates(features)  # type: List[Template]
+    rule_data: Tuple[List[RuleFamily], List[Rule]] = import_default_rules(features, feature_to_type, feature_to_sounds)
+    phonemes = import_default_phonemes()
+    gloss_groups = import_default_gloss()[1]
+
+    if len(sys.argv) > 1:
+        rule = rule_data[1][int(sys.argv[1])]
+    else:
+        matrix = ApplicabilityMatrix(rule_data[1], phonemes, templates, feature_to_type, feature_to_sounds)
+        rule = matrix.get_applicable_rules()[0]
+
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else CALLS
+
+    gen = Generator(phonemes, templates, rule, 5, feature_to_type, feature_to_sounds)
+
+    try:
+        latencies = time_generate(gen, calls, feature_to_type, feature_to_sounds, gloss_groups)
+    finally:
+        gen.close()
+
+    print("%d generate calls of %d words, %s" % (calls, AMOUNT, str(rule)))
+    print("calls\tmean ms\tmedian ms\tmax ms\tmean words")
+
+    for begin in range(0, calls, BUCKET):
+        bucket = [t for t, _ in latencies[begin:begin + BUCKET]]
+        words = [n for _, n in latencies[begin:begin + BUCKET]]
+        print("%d-%d\t%.2f\t%.2f\t%.2f\t%.1f" % (begin + 1, begin + len(bucket), 1000 * statistics.mean(bucket),
+                                                 1000 * statistics.median(bucket), 1000 * max(bucket),
+                                                 statistics.mean(words)))
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import pickle
+import warnings
+from typing import List, Dict, Tuple, Optional, Any
+
+BUNDLE_FILE = "defaultbundle.pickle"
+USE_BUNDLE = True
+USE_MMAP = True
+
+_SOURCE_FILES = ["defaultipa.csv", "defaultrules.csv", "defaulttemplate.txt", "defaultgloss.txt"]
+_CODE_FILES = ["bundle.py", "sound.py", "inventory.py", "word.py", "feature_lib.py", "rules.py", "cache.py",
+               "templates.py", "glossgroup.py"]
+
+_loaded = None  # type: Optional[Dict[str, Any]]
+
+
+def load_default_bundle() -> Optional[Dict[str, Any]]:
+    """
+    Parsed default inventory (with its features), rules (with their transformation tables and the warnings building
+    those raised, which import_default_rules repeats on every load), templates and glosses.
+
+    The bundle is read from BUNDLE_FILE when the contents recorded in its fingerprint still match the default source
+    files and the loader code, and rebuilt from the sources otherwise. When only modification times changed, just the
+    fingerprint is rewritten so the files are not hashed again next time. It is loaded at most once per process.
+
+    :return: None when USE_BUNDLE is off
+    """
+    global _loaded
+
+    if not USE_BUNDLE:
+        return None
+
+    if _loaded is None:
+        fingerprint = _read_fingerprint(BUNDLE_FILE)
+        current = _fingerprint(fingerprint)
+
+        if fingerprint is not None and _digests(fingerprint) == _digests(current):
+            _loaded = _read_bundle(BUNDLE_FILE)
+
+            if _loaded is not None and fingerprint != current:
+                _rewrite_fingerprint(BUNDLE_FILE, current)
+
+        if _loaded is None:
+            _loaded = _build_bundle()
+            _write_bundle(BUNDLE_FILE, current, _loaded)
+
+    return _loaded
+
+
+def _source_paths() -> List[str]:
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    return _SOURCE_FILES + [os.path.join(code_dir, f) for f in _CODE_FILES]
+
+
+def _fingerprint(previous: Optional[Dict[str, Tuple[int, int, str]]]) -> Dict[str, Tuple[int, int, str]]:
+    """
+    path -> (mtime, size, sha256) of every file the bundle is derived from. Files whose mtime and size match the
+    previous fingerprint are not re-hashed.
+    """
+    result = {}  # type: Dict[str, Tuple[int, int, str]]
+
+    for path in _source_paths():
+        stat = os.stat(path)
+        known = None if previous is None else previous.get(path)
+
+        if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            result[path] = known
+            continue
+
+        with open(path, 'rb') as data_file:
+            result[path] = (stat.st_mtime_ns, stat.st_size, hashlib.sha256(data_file.read()).hexdigest())
+
+    return result
+
+
+def _digests(fingerprint: Dict[str, Tuple[int, int, str]]) -> Dict[str, str]:
+    return {path: entry[2] for path, entry in fingerprint.items()}
+
+
+def _build_bundle() -> Dict[str, Any]:
+    from feature_lib import _fetch_inventory
+    from rules import _read_rule_csv, _get_rule_warnings
+    from templates import _fetch_templates
+    from glossgroup import _fetch_gloss
+
+    inventory = _fetch_inventory(_SOURCE_FILES[0])
+    features_data = inventory.get_feature_data()
+    features, feature_to_type, feature_to_sounds = features_data[0], features_data[3], features_data[4]
+    rule_data = _read_rule_csv(features, _SOURCE_FILES[1])
+    rule_warnings = _get_rule_warnings(rule_data[1], feature_to_type, feature_to_sounds)
+
+    return {
+        "inventory": inventory,
+        "features": features_data,
+        "rules": rule_data,
+        "rule_warnings": rule_warnings,
+        "templates": _fetch_templates(_SOURCE_FILES[2], features),
+        "gloss": _fetch_gloss(_SOURCE_FILES[3])
+    }
+
+
+def _read_fingerprint(filename: str) -> Optional[Dict[str, Tuple[int, int, str]]]:
+    try:
+        with open(filename, 'rb') as data_file:
+            return pickle.load(data_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def _read_bundle(filename: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(filename, 'rb') as data_file:
+            pickle.load(data_file)
+
+            if not USE_MMAP:
+                return pickle.load(data_file)
+
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                mapped.seek(data_file.tell())
+                return pickle.load(mapped)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        warnings.warn("Discarding unreadable bundle %s: %s" % (filename, str(e)))
+        return None
+
+
+def _write_bundle(filename: str, fingerprint: Dict[str, Tuple[int, int, str]], bundle: Dict[str, Any]) -> None:
+    temp_name = "%s.%d.tmp" % (filename, os.getpid())
+
+    try:
+        with open(temp_name, 'wb') as data_file:
+            pickle.dump(fingerprint, data_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(bundle, data_file, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_name, filename)
+    except OSError as e:
+        warnings.warn("Could not write bundle %s: %s" % (filename, str(e)))
+
+
+def _rewrite_fingerprint(filename: str, fingerprint: Dict[str, Tuple[int, int, str]]) -> None:
+    """
+    replace the fingerprint heading filename, copying the pickled bundle after it as is
+    """
+    temp_name = "%s.%d.tmp" % (filename, os.getpid())
+
+    try:
+        with open(filename, 'rb') as data_file:
+            pickle.load(data_file)
+            rest = data_file.read()
+
+        with open(temp_name, 'wb') as data_file:
+            pickle.dump(fingerprint, data_file, pickle.HIGHEST_PROTOCOL)
+            data_file.write(rest)
+
+        os.replace(temp_name, filename)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        warnings.warn("Could not write bundle %s: %s" % (filename, str(e)))
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Dict, Hashable, Any, Optional
+
+
+class LRUCache:
+    """
+    Mapping holding at most max_size entries. Storing into a full cache evicts the least recently used entry. Lookups
+    through get are counted as hits or misses, and evictions are counted too.
+    """
+    _entries: OrderedDict
+    _max_size: int
+    _hits: int
+    _misses: int
+    _evictions: int
+
+    def __init__(self, max_size: int) -> None:
+        if max_size < 1:
+            raise ValueError("cache size must be positive, get %d" % max_size)
+
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        if key in self._entries:
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self._misses += 1
+        return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        store value under key, replacing what was stored there before
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def set_max_size(self, max_size: int) -> None:
+        if max_size < 1:
+            raise ValueError("cache size must be positive, get %d" % max_size)
+
+        self._max_size = max_size
+        self._evict()
+
+    def get_max_size(self) -> int:
+        return self._max_size
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"hits": self._hits, "misses": self._misses, "evictions": self._evictions, "size": len(self._entries),
+                "max_size": self._max_size}
+
+    def _evict(self) -> None:
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
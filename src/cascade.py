@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from array import array
+from enum import Enum
+from typing import List, Dict, Tuple
+
+from word import Word
+from rules import Rule
+from sound import Sound
+from feature_lib import FeatureSoundMap
+from inventory import Inventory
+
+
+class Interaction(Enum):
+    FEEDING = 0
+    BLEEDING = 1
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class RuleCascade:
+    """
+    Ordered rules deriving a surface form from an underlying form, each rule applying to the output of the one before.
+
+    Consecutive rules that cannot see each other's changes are fused: a rule joins the group of the rules before it
+    when it looks at none of the sounds they remove or write and they never change the length of the word. The rules
+    of a group all find their changes in the group's input, and the word is rewritten once for the whole group.
+    """
+    _rules: List[Rule]
+    _groups: Dict[Tuple[Inventory, int], List[List[Rule]]]
+
+    def __init__(self, rules: List[Rule]) -> None:
+        if len(rules) == 0:
+            raise AttributeError("A cascade needs at least one rule")
+
+        self._rules = rules
+        self._groups = {}
+
+    def get_rules(self) -> List[Rule]:
+        return [r for r in self._rules]
+
+    def apply(self, word: Word, phonemes: List[Word], feature_to_type: Dict[str, str],
+              feature_to_sounds: Dict[str, List[Sound]]) -> Word:
+        """
+        :return: the surface form of word after every rule
+        """
+        for group in self._get_groups(phonemes, feature_to_type, feature_to_sounds):
+            changes = []  # type: List[Tuple[int, int, Word]]
+
+            for rule in group:
+                changes.extend(rule.get_changes(word, phonemes, feature_to_type, feature_to_sounds))
+
+            if len(changes) > 0:
+                word = _rewrite(word, sorted(changes, key=lambda c: c[0]))
+
+        return word
+
+    def derive(self, word: Word, phonemes: List[Word], feature_to_type: Dict[str, str],
+               feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
+        """
+        :return: word followed by its form after each rule in turn, the last being the surface form
+        """
+        forms = [word]
+
+        for rule in self._rules:
+            forms.append(rule.apply(forms[-1], phonemes, feature_to_type, feature_to_sounds))
+
+        return forms
+
+    def get_interactions(self, word: Word, phonemes: List[Word], feature_to_type: Dict[str, str],
+                         feature_to_sounds: Dict[str, List[Sound]]) -> List[Tuple[int, int, Interaction]]:
+        """
+        How earlier rules change the application of later ones in the derivation of word. Rule i feeds a later rule j
+        when j changes more locations of the output of i than of its input, and bleeds j when it changes fewer.
+
+        :return: (i, j, interaction) with i and j indexes into the cascade's rules
+        """
+        forms = self.derive(word, phonemes, feature_to_type, feature_to_sounds)
+        result = []  # type: List[Tuple[int, int, Interaction]]
+
+        for i in range(0, len(self._rules)):
+            if forms[i] == forms[i + 1]:
+                continue
+
+            for j in range(i + 1, len(self._rules)):
+                rule = self._rules[j]
+                before = len(rule.get_changes(forms[i], phonemes, feature_to_type, feature_to_sounds))
+                after = len(rule.get_changes(forms[i + 1], phonemes, feature_to_type, feature_to_sounds))
+
+                if after > before:
+                    result.append((i, j, Interaction.FEEDING))
+                elif after < before:
+                    result.append((i, j, Interaction.BLEEDING))
+
+        return result
+
+    def get_groups(self, phonemes: List[Word], feature_to_type: Dict[str, str],
+                   feature_to_sounds: Dict[str, List[Sound]]) -> List[List[Rule]]:
+        """
+        :return: the rules in order, split into the groups applied in one pass each
+        """
+        return [list(g) for g in self._get_groups(phonemes, feature_to_type, feature_to_sounds)]
+
+    def _get_groups(self, phonemes: List[Word], feature_to_type: Dict[str, str],
+                    feature_to_sounds: Dict[str, List[Sound]]) -> List[List[Rule]]:
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        phoneme_mask = -1 if phonemes is None else feature_to_sounds.get_phoneme_mask(phonemes)
+        key = (feature_to_sounds.get_inventory(), phoneme_mask)
+
+        if key not in self._groups:
+            groups = []  # type: List[List[Rule]]
+            group_written = set()
+            group_keeps_length = False
+
+            for rule in self._rules:
+                read, written, keeps_length = rule.get_footprint(phonemes, feature_to_type, feature_to_sounds)
+
+                if len(groups) > 0 and group_keeps_length and group_written.isdisjoint(read):
+                    groups[-1].append(rule)
+                    group_written |= written
+                    group_keeps_length = group_keeps_length and keeps_length
+                else:
+                    groups.append([rule])
+                    group_written = set(written)
+                    group_keeps_length = keeps_length
+
+            self._groups[key] = groups
+
+        return self._groups[key]
+
+
+def _rewrite(word: Word, changes: List[Tuple[int, int, Word]]) -> Word:
+    """
+    word with every (begin, end, replacement) of changes, sorted and not overlapping, replaced in one pass
+    """
+    ids = word.get_ids()
+    result = array('H')
+    prev = 0
+
+    for begin, end, replacement in changes:
+        result.extend(ids[prev:begin])
+        result.extend(replacement.get_ids())
+        prev = end
+
+    result.extend(ids[prev:])
+
+    return Word.from_ids(result, word.get_inventory())
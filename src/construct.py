@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import random
+from bisect import bisect_right
+from typing import List, Dict, Tuple, Set, Optional
+
+from word import Word
+from rules import Rule, ExampleType
+from templates import Template
+from sound import Sound
+from feature_lib import FeatureSoundMap
+from phonotactics import Phonotactics
+
+CONSTRUCT_ATTEMPT_FACTOR = 20
+
+
+class _Environment:
+    """
+    One way for a template word to hold a rule's A in a C_D environment: an alternative, a location and an A pattern
+    group, as the sounds allowed in every slot it constrains.
+    """
+    constraints: List[Tuple[int, Set[int]]]
+    choices: List[List[int]]
+    weight: int
+
+    def __init__(self, constraints: Dict[int, Set[int]], sets: List[List[int]]) -> None:
+        self.constraints = sorted(constraints.items())
+        self.choices = [[n for n in sets[j] if n in constraints[j]] if j in constraints else sets[j]
+                        for j in range(0, len(sets))]
+        self.weight = 1
+
+        for choice in self.choices:
+            self.weight *= len(choice)
+
+    def holds(self, ids: List[int]) -> bool:
+        for j, allowed in self.constraints:
+            if ids[j] not in allowed:
+                return False
+
+        return True
+
+
+def construct_examples(rule: Rule, template: Template, phonemes: List[Word], size_limit: int,
+                       example_type: ExampleType, feature_to_type: Dict[str, str],
+                       feature_to_sounds: Dict[str, List[Sound]],
+                       phonotactics: Optional[Phonotactics] = None) -> List[Word]:
+    """
+    Build distinct template words meant to be CADT (or CADNT) examples of the rule, drawn uniformly among such words,
+    instead of sampling the template and hoping.
+
+    An environment places a changing (or, for CADNT, non-changing) A pattern at one location with a matching C before
+    it and a matching D after it, the other slots being free. An environment is picked in proportion to how many words
+    hold it, the word is filled from it, and it is kept with probability one over the number of environments it holds,
+    which makes every word holding at least one environment equally likely. CADNT words holding a changing environment
+    are dropped, as are words breaking the template's or phonotactics' constraints. Patterns longer than one sound that
+    could override a placed one are not checked for, so the words still go through classify.
+
+    :return: at most size_limit words; fewer when the template has fewer such words or they keep repeating
+    """
+    if example_type not in (ExampleType.CADT, ExampleType.CADNT):
+        raise AttributeError("Can only construct CADT or CADNT examples, get %s" % str(example_type))
+
+    if not isinstance(feature_to_sounds, FeatureSoundMap):
+        feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+    sets = [[s.get_num() for s in p.get_matching_sounds(phonemes, feature_to_sounds)]
+            for p in template.get_components()]
+    changing, unchanging = _get_environments(rule, sets, phonemes, feature_to_type, feature_to_sounds)
+    targets = changing if example_type == ExampleType.CADT else unchanging
+    excluded = [] if example_type == ExampleType.CADT else changing
+    targets = [e for e in targets if e.weight > 0]
+
+    if len(targets) == 0 or size_limit <= 0:
+        return []
+
+    cumulative = []  # type: List[int]
+    total = 0
+
+    for environment in targets:
+        total += environment.weight
+        cumulative.append(total)
+
+    inventory = feature_to_sounds.get_inventory()
+    result = {}  # type: Dict[Word, None]
+    attempts = 0
+
+    while len(result) < size_limit and attempts < size_limit * CONSTRUCT_ATTEMPT_FACTOR:
+        attempts += 1
+        environment = targets[bisect_right(cumulative, random.randrange(0, total))]
+        ids = [random.choice(choice) for choice in environment.choices]
+        held = len([e for e in targets if e.holds(ids)])
+
+        if random.randrange(0, held) != 0 or True in [e.holds(ids) for e in excluded]:
+            continue
+
+        if not template.allows(ids, feature_to_sounds, phonotactics):
+            continue
+
+        result[Word.from_ids(ids, inventory)] = None
+
+    return list(result.keys())
+
+
+def _get_environments(rule: Rule, sets: List[List[int]], phonemes: List[Word], feature_to_type: Dict[str, str],
+                      feature_to_sounds: FeatureSoundMap) -> Tuple[List[_Environment], List[_Environment]]:
+    """
+    :return: every environment of a changing A pattern in the template, and every one of an A pattern left unchanged
+    """
+    c_contexts, d_contexts = rule.get_contexts(phonemes, feature_to_sounds)
+    c_edges, d_edges = rule.get_edges()
+    groups = {True: set(), False: set()}  # type: Dict[bool, Set[int]]
+    long_patterns = []  # type: List[Tuple[bool, Tuple[int, ...]]]
+
+    for pattern, replaced in rule.get_replacements(phonemes, feature_to_type, feature_to_sounds).items():
+        if isinstance(replaced, Exception) or len(pattern) == 0:
+            continue
+
+        if len(pattern) == 1:
+            groups[replaced != pattern].add(pattern.get_ids()[0])
+        else:
+            long_patterns.append((replaced != pattern, tuple(pattern.get_ids())))
+
+    a_choices = [(changed, [ids]) for changed, ids in groups.items() if len(ids) > 0] + \
+                [(changed, [{n} for n in ids]) for changed, ids in long_patterns]
+    changing = []  # type: List[_Environment]
+    unchanging = []  # type: List[_Environment]
+    word_len = len(sets)
+
+    for i in range(0, len(c_contexts)):
+        c = c_contexts[i] or []
+        d = d_contexts[i] or []
+
+        if True in [len(s) == 0 for s in c + d]:
+            continue
+
+        for changed, a_sets in a_choices:
+            for loc in range(len(c), word_len - len(a_sets) - len(d) + 1):
+                if c_edges[i] and loc != len(c):
+                    continue
+
+                if d_edges[i] and loc + len(a_sets) + len(d) != word_len:
+                    continue
+
+                constraints = {}  # type: Dict[int, Set[int]]
+
+                for k in range(0, len(c)):
+                    constraints[loc - len(c) + k] = c[k]
+
+                for k in range(0, len(a_sets)):
+                    constraints[loc + k] = a_sets[k]
+
+                for k in range(0, len(d)):
+                    constraints[loc + len(a_sets) + k] = d[k]
+
+                (changing if changed else unchanging).append(_Environment(constraints, sets))
+
+    return changing, unchanging
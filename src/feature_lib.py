@@ -1,87 +1,223 @@
 from __future__ import annotations
 
 import csv
-from typing import List, Tuple, Dict, Optional
+from time import perf_counter
+from typing import List, Tuple, Dict, Optional, FrozenSet
 
-from sound import Sound
+from sound import Sound, TransformationTable
 from word import Word
+from inventory import Inventory, get_inventory
+import instrument
+
+_PARTICLE_KEYS = {}  # type: Dict[FrozenSet[str], FrozenSet[str]]
+
+
+class FeatureSoundMap(dict):
+    """
+    feature -> sounds map of one Inventory that also keeps one bitmask per feature, bit (num - 1) standing for sound
+    num, and the feature row -> sound index. Must not be modified after construction.
+    """
+    _masks: Dict[str, int]
+    _full_mask: int
+    _by_bit: Dict[int, Sound]
+    _particle_masks: Dict[Particle, int]
+    _decoded: Dict[int, List[Sound]]
+    _features_to_sound: Dict[Tuple[str, ...], Sound]
+    _transformations: Dict[Tuple[Particle, Tuple[str, ...]], TransformationTable]
+    _inventory: Optional[Inventory]
+
+    def __init__(self, feature_to_sounds: Dict[str, List[Sound]],
+                 features_to_sound: Optional[Dict[Tuple[str, ...], Sound]] = None,
+                 inventory: Optional[Inventory] = None) -> None:
+        dict.__init__(self, feature_to_sounds)
+        self._masks = {}
+        self._full_mask = 0
+        self._by_bit = {}
+        self._particle_masks = {}
+        self._decoded = {}
+        self._transformations = {}
+
+        for feature, sounds in feature_to_sounds.items():
+            mask = 0
+
+            for sound in sounds:
+                mask |= sound.get_mask()
+                self._by_bit[sound.get_num() - 1] = sound
+
+            self._masks[feature] = mask
+            self._full_mask |= mask
+
+        if features_to_sound is None:
+            features_to_sound = {tuple(s.get_features()): s for s in self._by_bit.values()}
+
+        self._features_to_sound = features_to_sound
+
+        if inventory is None and len(self._by_bit) > 0:
+            inventory = next(iter(self._by_bit.values())).get_inventory()
+
+        self._inventory = inventory
+
+    def get_inventory(self) -> Optional[Inventory]:
+        return self._inventory
+
+    def get_mask(self, feature: str) -> int:
+        if feature.startswith("!"):
+            return self._full_mask & ~self._masks[feature[1:]]
+
+        return self._masks[feature]
+
+    def get_full_mask(self) -> int:
+        return self._full_mask
+
+    def get_particle_mask(self, particle: Particle) -> int:
+        if particle not in self._particle_masks:
+            mask = self._full_mask
+
+            for feature in particle.get_features():
+                mask &= self.get_mask(feature)
+
+            self._particle_masks[particle] = mask
+
+        return self._particle_masks[particle]
+
+    def get_sound(self, features: List[str]) -> Optional[Sound]:
+        """
+        the sound whose feature row is exactly features, column by column, None if there is none
+        """
+        return self._features_to_sound.get(tuple(features))
+
+    def get_transformations(self, target_particle: Particle, ignored_types: List[str],
+                            feature_to_type: Dict[str, str]) -> TransformationTable:
+        """
+        transformation table towards target_particle, built on first request and shared by every rule with that B
+        """
+        key = (target_particle, tuple(ignored_types))
+
+        if key not in self._transformations:
+            self._transformations[key] = TransformationTable(target_particle, ignored_types, feature_to_type, self)
+
+        return self._transformations[key]
+
+    @staticmethod
+    def get_phoneme_mask(phonemes: List[Word]) -> int:
+        mask = 0
+
+        for phoneme in phonemes:
+            mask |= phoneme.get_sounds()[0].get_mask()
+
+        return mask
+
+    def get_sounds(self, mask: int) -> List[Sound]:
+        """
+        sounds whose bits are set in mask, in loading order
+        """
+        if mask not in self._decoded:
+            sounds = []
+            rest = mask
+
+            while rest:
+                low = rest & -rest
+                sounds.append(self._by_bit[low.bit_length() - 1])
+                rest ^= low
+
+            self._decoded[mask] = sounds
+
+        return list(self._decoded[mask])
 
 
 class Particle:
+    """
+    Unordered feature bundle: particles with the same features in any order are equal and hash alike, while each one
+    displays its features in the order it was given them. Their feature sets are interned. Sound rows are not
+    particles: the column a feature sits in matters there, so they are keyed by their feature tuples.
+    """
     _features: List[str]
+    _key: FrozenSet[str]
+    _hash: int
 
     def __init__(self, features_: List[str]) -> None:
-        self._features = features_
-
-    def get_matching_sounds(self, phonemes: Optional[List[Word], None], feature_to_sounds: Dict[str, List[Sound]]) -> \
-            List[Sound]:
-        intersection = None
-        full_sounds = None
-
-        for feature in self._features:
-            curr_sounds = list(dict.fromkeys(feature_to_sounds[feature.lstrip("!")]))
+        key = frozenset(features_)
 
-            if feature.startswith("!"):
-                if full_sounds is None:
-                    full_sounds = set(s for key in list(feature_to_sounds.keys()) if key != 'NA' for s in key)
+        self._features = list(dict.fromkeys(features_))
+        self._key = _PARTICLE_KEYS.setdefault(key, key)
+        self._hash = hash(self._key)
 
-                curr_sounds = [s for s in full_sounds if s not in curr_sounds]
+    def __reduce__(self) -> Tuple[type, Tuple[List[str]]]:
+        return Particle, (self._features,)
 
-            if intersection is None:
-                intersection = curr_sounds
-            else:
-                valid = []
-                for sound in intersection:
-                    if sound in curr_sounds:
-                        valid.append(sound)
+    def get_matching_sounds(self, phonemes: Optional[List[Word]], feature_to_sounds: Dict[str, List[Sound]]) -> \
+            List[Sound]:
+        start = perf_counter() if instrument.ENABLED else None
 
-                intersection = valid
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
 
-        if phonemes is None:
-            return intersection
+        mask = feature_to_sounds.get_particle_mask(self)
 
-        result = []
+        if phonemes is not None:
+            mask &= feature_to_sounds.get_phoneme_mask(phonemes)
 
-        for sound in intersection:
-            phoneme_sounds = [w.get_sounds()[0] for w in phonemes]
+        sounds = feature_to_sounds.get_sounds(mask)
 
-            if sound in phoneme_sounds:
-                result.append(sound)
+        if start is not None:
+            instrument.record_time("particle.match", perf_counter() - start)
+            instrument.observe("particle.match.sounds", len(sounds))
 
-        return result
+        return sounds
 
     def get_features(self) -> List[str]:
         return [f for f in self._features]
 
     def __eq__(self, other: Particle) -> bool:
-        for i in range(0, len(self._features)):
-            if not self._features[i] == other._features[i]:
-                return False
+        return isinstance(other, Particle) and (self._key is other._key or self._key == other._key)
 
-        return True
+    def __ne__(self, other: Particle) -> bool:
+        return not self == other
 
     def __hash__(self) -> int:
-        return 0
+        return self._hash
 
     def __str__(self) -> str:
         return "[%s]" % ",".join(self._features)
 
 
 def import_default_features() -> Tuple[
-    List[str], List[Sound], Dict[str, List[str]], Dict[str, str], Dict[str, List[Sound]], Dict[Particle, Sound]]:
-    return _fetch_feature_csv("defaultipa.csv")
+    List[str], List[Sound], Dict[str, List[str]], Dict[str, str], Dict[str, List[Sound]], Dict[Tuple[str, ...], Sound]]:
+    return import_default_inventory().get_feature_data()
+
+
+def import_default_inventory() -> Inventory:
+    from bundle import load_default_bundle
+
+    bundle = load_default_bundle()
+
+    if bundle is not None:
+        return bundle["inventory"]
+
+    return _fetch_inventory("defaultipa.csv")
 
 
 def _fetch_feature_csv(filename: str) -> Tuple[
-    List[str], List[Sound], Dict[str, List[str]], Dict[str, str], Dict[str, List[Sound]], Dict[Particle, Sound]]:
+    List[str], List[Sound], Dict[str, List[str]], Dict[str, str], Dict[str, List[Sound]], Dict[Tuple[str, ...], Sound]]:
+    return _fetch_inventory(filename).get_feature_data()
+
+
+def _fetch_inventory(filename: str, name: Optional[str] = None) -> Inventory:
+    """
+    :param name: name to register the inventory under, the file name if None
+    :return: the inventory registered under name, which is the one loaded before when the table was loaded already
+    """
+    inventory = Inventory(filename if name is None else name)
     features = []  # type: List[str]
     type_to_features = {}  # type: Dict[str, List[str]]
     feature_to_type = {}  # type: Dict[str, str]
     feature_to_sounds = {}  # type: Dict[str, List[Sound]]
-    features_to_sound = {}  # type: Dict[Particle, Sound]
+    features_to_sound = {}  # type: Dict[Tuple[str, ...], Sound]
     sounds = []  # type: List[Sound]
 
     feature_types = []
+    seen_features = set()
+    seen_type_features = set()
 
     with open(filename, encoding='utf-8') as data_file:
         lines = csv.reader(data_file)
@@ -121,13 +257,16 @@ def _fetch_feature_csv(filename: str) -> Tuple[
                 raise ImportError("Feature line \'%s\' does not align with types" % str(features_))
 
             _sound = Sound(sound_num, str(line[0]), features_)
+            inventory.add_sound(_sound)
             sound_num += 1
 
-            if Particle(features_) in features_to_sound.keys():
+            row = tuple(features_)
+
+            if row in features_to_sound:
                 raise ImportError(
-                    "Sound %s has the same property as sound %s" % (str(_sound), features_to_sound[features_]))
+                    "Sound %s has the same property as sound %s" % (str(_sound), features_to_sound[row]))
 
-            features_to_sound[Particle(features_)] = _sound
+            features_to_sound[row] = _sound
             sounds.append(_sound)
 
             for i in range(0, len(features_)):
@@ -137,10 +276,12 @@ def _fetch_feature_csv(filename: str) -> Tuple[
                 if feature_ not in feature_to_type.keys():
                     feature_to_type[feature_] = type_
 
-                if feature_ not in features:
+                if feature_ not in seen_features:
+                    seen_features.add(feature_)
                     features.append(feature_)
 
-                if feature_ not in type_to_features[type_]:
+                if (type_, feature_) not in seen_type_features:
+                    seen_type_features.add((type_, feature_))
                     type_to_features[type_].append(feature_)
 
                 if feature_ not in feature_to_sounds.keys():
@@ -148,4 +289,6 @@ def _fetch_feature_csv(filename: str) -> Tuple[
 
                 feature_to_sounds[feature_].append(_sound)
 
-    return features, sounds, type_to_features, feature_to_type, feature_to_sounds, features_to_sound
+    inventory.set_feature_data(features, type_to_features, feature_to_type,
+                               FeatureSoundMap(feature_to_sounds, features_to_sound, inventory), features_to_sound)
+    return get_inventory(inventory.get_name())
@@ -1,19 +1,33 @@
 from __future__ import annotations
 
+import os
 import random
 import warnings
-from typing import List, Tuple, Dict, Optional
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import List, Tuple, Dict, Optional, Union
 
 from word import Word
 from rules import Rule, ExampleType
 from sound import Sound
 from templates import Template
+from phonotactics import Phonotactics
+from construct import construct_examples
+from applicability import ApplicabilityMatrix, RuleApplicability
+from library_store import LibraryStore, StoredExample, get_fingerprint
 
 from glossgroup import GlossGroup
+import instrument
 
 WORD_POOL_DEFAULT_SIZE = 300
+EXPANSION_BATCH_SIZE = 300
+EXPANSION_BUDGET_DEFAULT = 3000
+PARALLEL_CHUNK_SIZE = 64
 IRR_PERCENTAGE = 0.1
 RELATED_PERCENTAGE = 0.9
+CADT_CONSTRUCTED_PERCENTAGE = 0.2
+CADNT_CONSTRUCTED_PERCENTAGE = 0.1
 
 EXCLUSION_TYPES = [ExampleType.CADT, ExampleType.CADNT]
 
@@ -23,121 +37,419 @@ class Generator:
     _difficulty_to_percent: Dict[int, Tuple[float, float, float, float, float]]
     _templates: List[Template]
     _rule: Rule
-    _dict_initialized: bool
     _phonemes: List[Word]
-    _CADT: List[Dict[Word, List[Word]]]
-    _CADNT: List[Dict[Word, List[Word]]]
-    _CAND: List[Dict[Word, List[Word]]]
-    _NCAD: List[Dict[Word, List[Word]]]
-    _IRR: List[Dict[Word, List[Word]]]
-    _duplicate_exclusion: List[Word]
+    _CADT: List[_Pool]
+    _CADNT: List[_Pool]
+    _CAND: List[_Pool]
+    _NCAD: List[_Pool]
+    _IRR: List[_Pool]
+    _duplicate_exclusion: Dict[Word, None]
+    _word_pools: Dict[Word, List[_Pool]]
+    _availability: RuleApplicability
+    _phonotactics: Optional[Phonotactics]
+    _yields: Dict[Tuple[Template, ExampleType, int], List[int]]
+    _expansion_budget: int
+    _workers: int
+    _executor: Optional[ProcessPoolExecutor]
+    _shutdown: Optional[weakref.finalize]
+    _sampler: _Sampler
+    _store: Optional[LibraryStore]
+    _fingerprint: Optional[str]
+    _store_position: int
+    _unsaved: List[StoredExample]
 
     def __init__(self, phonemes: List[Word], templates: List[Template], rule: Rule, difficulty: int,
-                 feature_to_type: Dict[str, str], feature_to_sounds: Dict[str, List[Sound]]) -> None:
+                 feature_to_type: Dict[str, str], feature_to_sounds: Dict[str, List[Sound]],
+                 phonotactics: Optional[Phonotactics] = None,
+                 expansion_budget: int = EXPANSION_BUDGET_DEFAULT, workers: Optional[int] = None,
+                 store: Optional[LibraryStore] = None) -> None:
+        """
+        :param phonotactics: constraints of the phoneme inventory every generated word keeps to, on top of those of
+                             its template
+        :param expansion_budget: the most words sampled to top up one example type when the library runs short of it
+        :param workers: processes sampling and classifying template words, every core when None; with more than one,
+                        call close once done with the generator, or use it in a with statement
+        :param store: where the examples of earlier generators over the same rule, templates, phonemes and inventory
+                      are loaded from, so the library is only sampled when they are not enough, and where the new
+                      examples are appended
+        """
         self._templates = templates
+        self._phonotactics = phonotactics
         self._rule = rule
-        self._CADT = []
-        self._CADNT = []
-        self._CAND = []
-        self._NCAD = []
-        self._IRR = []
-        self._dict_initialized = False
+        alternatives = len(rule.get_edges()[0])
+        self._CADT = [_Pool() for _ in range(0, alternatives)]
+        self._CADNT = [_Pool() for _ in range(0, alternatives)]
+        self._CAND = [_Pool() for _ in range(0, alternatives)]
+        self._NCAD = [_Pool() for _ in range(0, alternatives)]
+        self._IRR = [_Pool() for _ in range(0, alternatives)]
+        self._yields = {}
+        self._expansion_budget = expansion_budget
+        self._workers = (os.cpu_count() or 1) if workers is None else workers
+        self._executor = None
+        self._shutdown = None
+        self._sampler = _Sampler(rule, templates, phonemes, feature_to_type, feature_to_sounds, phonotactics)
         self._phonemes = phonemes
-        self._duplicate_exclusion = []
+        self._duplicate_exclusion = {}
+        self._word_pools = {}
+        self._availability = ApplicabilityMatrix([rule], phonemes, templates, feature_to_type, feature_to_sounds,
+                                                 phonotactics).get(rule)
 
         self._difficulty_to_percent = {
             5: (0.4, 0.1, 0.2, 0.2, 0.1)
         }
 
         self._difficulty = difficulty
-        self._expand_library(WORD_POOL_DEFAULT_SIZE, feature_to_type, feature_to_sounds)
+        self._store = store
+        self._fingerprint = None
+        self._store_position = 0
+        self._unsaved = []
+
+        if store is not None:
+            self._fingerprint = get_fingerprint(rule, templates, phonemes, phonemes[0].get_inventory(), phonotactics)
+
+            for (template, example_type, index), value in store.load_yields(self._fingerprint).items():
+                if template < len(templates) and index < alternatives:
+                    self._yields[(templates[template], example_type, index)] = value
+
+            self._load_stored()
+
+        try:
+            if sum([pool.get_size() for pools in (self._CADT, self._CADNT, self._CAND, self._NCAD, self._IRR)
+                    for pool in pools]) == 0:
+                self._expand_library(WORD_POOL_DEFAULT_SIZE, feature_to_type, feature_to_sounds)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self) -> Generator:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     def _expand_library(self, pool_size: int, feature_to_type: Dict[str, str],
                         feature_to_sounds: Dict[str, List[Sound]]) -> None:
+        """
+        fill the library with about pool_size words split evenly across the templates, for every example type at once
+        """
+        round_start = perf_counter() if instrument.ENABLED else None
         template_pool_size = pool_size / len(self._templates)
         generation_summary = {ExampleType.CADT: 0, ExampleType.CADNT: 0, ExampleType.CAND: 0, ExampleType.NCAD: 0,
                               ExampleType.IRR: 0}
 
+        jobs = []  # type: List[Tuple[int, int, int, int, int, int]]
+
         for template in self._templates:
             irr_size = round(template_pool_size * IRR_PERCENTAGE)
             related_size = round(template_pool_size * RELATED_PERCENTAGE)
+            cadt_size = min(round(template_pool_size * CADT_CONSTRUCTED_PERCENTAGE),
+                            self._availability.get_word_count(ExampleType.CADT, template))
+            cadnt_size = min(round(template_pool_size * CADNT_CONSTRUCTED_PERCENTAGE),
+                             self._availability.get_word_count(ExampleType.CADNT, template))
+            jobs.append((len(jobs), irr_size, related_size - cadt_size - cadnt_size, cadt_size, cadnt_size,
+                         random.getrandbits(64)))
 
-            a_matcher = self._rule.get_a_matcher(self._phonemes, None, feature_to_sounds)
-            irr_phoneme = [w for w in self._phonemes if w not in a_matcher]
+        samples = self._sample_all(jobs)
+        classified = self._classify_all([w for related, _ in samples for w in related])
 
-            irr_word_list = template.generate_word_list(irr_phoneme, irr_size, feature_to_sounds, None)
-            related_word_list = template.generate_word_list(self._phonemes, related_size, feature_to_sounds, a_matcher)
+        for template, (related_word_list, irr_word_list) in zip(self._templates, samples):
+            template_start = perf_counter() if instrument.ENABLED else None
 
-            random.shuffle(irr_word_list)
+            for example_type, n in self._add_examples(template, None, related_word_list,
+                                                      classified[:len(related_word_list)], irr_word_list).items():
+                generation_summary[example_type] += n
+
+            classified = classified[len(related_word_list):]
+
+            if template_start is not None:
+                instrument.record_time("generator.expand:%s @ %s" % (self._rule.get_name(), str(template)),
+                                       perf_counter() - template_start)
+
+        self._save()
+
+        if round_start is not None:
+            instrument.count("generator.expand.rounds")
+            instrument.record_time("generator.expand", perf_counter() - round_start)
+
+        if instrument.has_listeners():
+            instrument.event("generator.expand", {str(t): n for t, n in generation_summary.items()})
+
+    def _top_up(self, example_type: ExampleType, index: int, amount: int, feature_to_type: Dict[str, str],
+                feature_to_sounds: Dict[str, List[Sound]]) -> None:
+        """
+        Sample more words of the missing type only, in batches split across the templates by how well each has produced
+        it so far, until the pool holds amount fresh words, holds every such word of the templates, or the expansion
+        budget is spent. A report is warned when the pool is still short.
+        """
+        pool = self._get_pool(example_type, index)
+        available = self._availability.get_counts()[example_type][index]
+        spent = 0
+        top_up_start = perf_counter() if instrument.ENABLED else None
+
+        if self._store is not None:
+            self._load_stored()
+
+        while pool.get_fresh_size() < amount and pool.get_size() < available and spent < self._expansion_budget:
+            allocation = self._allocate(example_type, index, min(EXPANSION_BATCH_SIZE, self._expansion_budget - spent))
+
+            if len(allocation) == 0:
+                break
+
+            samples = self._sample_all([self._get_job(t, example_type, size) for t, size in allocation])
+            classified = self._classify_all([w for related, _ in samples for w in related])
+
+            for (template, _), (related_word_list, irr_word_list) in zip(allocation, samples):
+                self._add_examples(template, (example_type, index), related_word_list,
+                                   classified[:len(related_word_list)], irr_word_list)
+                classified = classified[len(related_word_list):]
+
+            spent += sum([size for _, size in allocation])
+            self._save()
+
+        if top_up_start is not None:
+            instrument.count("generator.top_up.words", spent)
+            instrument.record_time("generator.top_up", perf_counter() - top_up_start)
+
+        if instrument.has_listeners():
+            instrument.event("generator.top_up", {"type": str(example_type), "alternative": index, "required": amount,
+                                                  "fresh": pool.get_fresh_size(), "sampled": spent})
+
+        if pool.get_fresh_size() < amount:
+            if pool.get_size() >= available:
+                reason = "only %d in the templates" % available
+            elif spent >= self._expansion_budget:
+                reason = "expansion budget of %d words spent" % self._expansion_budget
+            else:
+                reason = "no template left to sample"
+
+            yields = []  # type: List[str]
+
+            for template in self._templates:
+                sampled, found = self._get_yield(template, example_type, index)
+                yields.append("%s %d/%d" % (str(template), found, sampled))
+
+            warnings.warn("Insufficient amount of %s type in alternative %d.(%d required, %d found; %s; found/sampled "
+                          "per template: %s)" % (str(example_type), index, amount, pool.get_fresh_size(), reason,
+                                                 ", ".join(yields)))
+
+    def _allocate(self, example_type: ExampleType, index: int, size: int) -> List[Tuple[Template, int]]:
+        """
+        Split size samples across the templates that still have unseen words of the type, in proportion to the share
+        of their samples that turned out to be new such words, smoothed so untried templates get their chance. Shares
+        are rounded by largest remainder, so exactly size samples are handed out; templates getting none are left out.
+        """
+        weights = []  # type: List[Tuple[Template, float]]
+
+        for template in self._templates:
+            sampled, found = self._get_yield(template, example_type, index)
+
+            if found < self._availability.get_counts(template)[example_type][index]:
+                weights.append((template, (found + 1) / (sampled + 2)))
+
+        if len(weights) == 0:
+            return []
 
-            # RELATED
-
-            for word in related_word_list:
-                classify_data = self._rule.classify(word, self._phonemes, feature_to_type, feature_to_sounds)
-                records = []  # type: List[Tuple[ExampleType, Dict[Word, List[Word]], Word, Word]]
-                exclusion_lock = False
-                no_irr = False
-
-                for index in range(0, len(classify_data)):
-                    data = classify_data[index]
-
-                    if not self._dict_initialized:
-                        self._CADT.append({})
-                        self._CADNT.append({})
-                        self._CAND.append({})
-                        self._NCAD.append({})
-                        self._IRR.append({})
-
-                    if ExampleType.IRR in data:
-                        raise ValueError("Related word list should never have IRR type")
-                    elif ExampleType.CADT in data:
-                        inherited = [r for r in records if r[0] == ExampleType.CADT]
-                        inherited.append((ExampleType.CADT, self._CADT[index], data[ExampleType.CADT], word))
-                        records = inherited
+        total = sum([w for _, w in weights])
+        quotas = [size * w / total for _, w in weights]
+        sizes = [int(q) for q in quotas]
+        by_remainder = sorted(range(0, len(weights)), key=lambda i: sizes[i] - quotas[i])
+
+        for i in by_remainder[:size - sum(sizes)]:
+            sizes[i] += 1
+
+        return [(weights[i][0], sizes[i]) for i in range(0, len(weights)) if sizes[i] > 0]
+
+    def _get_job(self, template: Template, example_type: ExampleType, size: int) -> Tuple[int, int, int, int, int, int]:
+        """
+        :return: the sampling job of size words of template aimed at the example type, for _Sampler.sample
+        """
+        index = self._templates.index(template)
+        seed = random.getrandbits(64)
+
+        if example_type == ExampleType.IRR:
+            return index, size, 0, 0, 0, seed
+
+        if example_type == ExampleType.CADT:
+            return index, 0, 0, size, 0, seed
+
+        if example_type == ExampleType.CADNT:
+            return index, 0, 0, 0, size, seed
+
+        return index, 0, size, 0, 0, seed
+
+    def _sample_all(self, jobs: List[Tuple[int, int, int, int, int, int]]) -> List[Tuple[List[Word], List[Word]]]:
+        """
+        the related and IRR words of every sampling job, in order; across the worker processes when there are several
+        jobs and enough words. Every job draws from its own seed, so the words do not depend on where it ran.
+        """
+        if self._workers <= 1 or len(jobs) < 2 or sum([sum(job[1:5]) for job in jobs]) < 2 * PARALLEL_CHUNK_SIZE:
+            return [self._sampler.sample(job) for job in jobs]
+
+        return list(self._get_executor().map(_sample_job, jobs))
+
+    def _classify_all(self, words: List[Word]) -> List[List[Dict[ExampleType, Word]]]:
+        """
+        classify of every word, in order; in chunks across the worker processes when there are enough words
+        """
+        if self._workers <= 1 or len(words) < 2 * PARALLEL_CHUNK_SIZE:
+            return self._sampler.classify(words)
+
+        chunk_size = max(PARALLEL_CHUNK_SIZE, -(-len(words) // self._workers))
+        chunks = [words[i:i + chunk_size] for i in range(0, len(words), chunk_size)]
+
+        return [data for chunk in self._get_executor().map(_classify_chunk, chunks) for data in chunk]
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self._workers, initializer=_init_worker,
+                                                 initargs=(self._phonemes[0].get_inventory(), self._sampler))
+            self._shutdown = weakref.finalize(self, self._executor.shutdown)
+
+        return self._executor
+
+    def close(self) -> None:
+        """
+        stop the worker processes, if any; they are started again when needed. A generator nobody closed stops them
+        when it is garbage collected.
+        """
+        if self._shutdown is not None:
+            self._shutdown()
+            self._shutdown = None
+            self._executor = None
+
+    def _add_examples(self, template: Template, target: Optional[Tuple[ExampleType, int]],
+                      related_word_list: List[Word], classified: List[List[Dict[ExampleType, Word]]],
+                      irr_word_list: List[Word]) -> Dict[ExampleType, int]:
+        """
+        Record the related words into the pools by their classify results, and the IRR words into the IRR pools,
+        counting the words sampled from template and the new examples found towards the yield of target, or of every
+        type and alternative when target is None.
+
+        :return: how many examples of each type were recorded
+        """
+        generation_summary = {t: 0 for t in ExampleType}
+        found = {}  # type: Dict[Tuple[ExampleType, int], int]
+        template_index = self._templates.index(template)
+
+        # RELATED
+
+        for word, classify_data in zip(related_word_list, classified):
+            records = []  # type: List[Tuple[ExampleType, int, Word, Word]]
+            exclusion_lock = False
+            no_irr = False
+
+            for index in range(0, len(classify_data)):
+                data = classify_data[index]
+
+                if ExampleType.IRR in data:
+                    raise ValueError("Related word list should never have IRR type")
+                elif ExampleType.CADT in data:
+                    inherited = [r for r in records if r[0] == ExampleType.CADT]
+                    inherited.append((ExampleType.CADT, index, data[ExampleType.CADT], word))
+                    records = inherited
+                    no_irr = True
+                    break
+
+                if ExampleType.CADNT in data:
+                    inherited = [r for r in records if r[0] == ExampleType.CADNT]
+                    inherited.append((ExampleType.CADNT, index, data[ExampleType.CADNT], word))
+                    records = inherited
+                    exclusion_lock = True
+                    no_irr = True
+
+                if not exclusion_lock:
+                    if ExampleType.CAND in data:
+                        records.append((ExampleType.CAND, index, data[ExampleType.CAND], word))
                         no_irr = True
-                        break
 
-                    if ExampleType.CADNT in data:
-                        inherited = [r for r in records if r[0] == ExampleType.CADNT]
-                        inherited.append((ExampleType.CADNT, self._CADNT[index], data[ExampleType.CADNT], word))
-                        records = inherited
-                        exclusion_lock = True
+                    if ExampleType.NCAD in data:
+                        records.append((ExampleType.NCAD, index, data[ExampleType.NCAD], word))
                         no_irr = True
 
-                    if not exclusion_lock:
-                        if ExampleType.CAND in data:
-                            records.append((ExampleType.CAND, self._CAND[index], data[ExampleType.CAND], word))
-                            no_irr = True
+            for record in records:
+                generation_summary[record[0]] += 1
+
+                if record[0] != ExampleType.IRR or not no_irr:
+                    if self._pool_add(self._get_pool(record[0], record[1]), record[2], record[3]):
+                        found[(record[0], record[1])] = found.get((record[0], record[1]), 0) + 1
+                        self._unsaved.append((template_index, record[0], record[1], record[2], record[3]))
+
+        # IRR
+
+        for word in irr_word_list:
+            generation_summary[ExampleType.IRR] += 1
+
+            for index in range(0, len(self._IRR)):
+                if self._pool_add(self._IRR[index], Word([]), word):
+                    found[(ExampleType.IRR, index)] = found.get((ExampleType.IRR, index), 0) + 1
+                    self._unsaved.append((template_index, ExampleType.IRR, index, Word([]), word))
+
+        sampled = len(related_word_list) + len(irr_word_list)
+        targets = [target] if target is not None else [(t, i) for t in ExampleType for i in range(0, len(self._IRR))]
 
-                        if ExampleType.NCAD in data:
-                            records.append((ExampleType.NCAD, self._NCAD[index], data[ExampleType.NCAD], word))
-                            no_irr = True
+        for example_type, index in targets:
+            previous_sampled, previous_found = self._get_yield(template, example_type, index)
+            self._yields[(template, example_type, index)] = [previous_sampled + sampled,
+                                                             previous_found + found.get((example_type, index), 0)]
 
-                for record in records:
-                    generation_summary[record[0]] += 1
+        return generation_summary
 
-                    if record[0] != ExampleType.IRR or not no_irr:
-                        self._dict_add(record[1], record[2], record[3])
+    def _load_stored(self) -> None:
+        """
+        add the examples appended to the store since the last load to the pools
+        """
+        examples, self._store_position = self._store.load(self._fingerprint, self._phonemes[0].get_inventory(),
+                                                          self._store_position)
+
+        for _, example_type, index, key, word in examples:
+            if index < len(self._IRR):
+                self._pool_add(self._get_pool(example_type, index), key, word)
 
-                self._dict_initialized = True
+    def _save(self) -> None:
+        """
+        append the examples found since the last save, and the current yields, to the store
+        """
+        if self._store is None:
+            return
 
-            # IRR
+        yields = {(self._templates.index(t), example_type, index): value
+                  for (t, example_type, index), value in self._yields.items()}
+        self._store.append(self._fingerprint, self._unsaved, yields)
+        self._unsaved = []
 
-            for word in irr_word_list:
-                generation_summary[ExampleType.IRR] += 1
+    def _get_yield(self, template: Template, example_type: ExampleType, index: int) -> List[int]:
+        """
+        :return: the words sampled from template towards the type in the alternative, and the new examples found
+        """
+        return self._yields.get((template, example_type, index), [0, 0])
 
-                for index in range(0, len(self._IRR)):
-                    self._dict_add(self._IRR[index], Word(''), word)
+    def _get_pool(self, example_type: ExampleType, index: int) -> _Pool:
+        return {ExampleType.CADT: self._CADT, ExampleType.CADNT: self._CADNT, ExampleType.CAND: self._CAND,
+                ExampleType.NCAD: self._NCAD, ExampleType.IRR: self._IRR}[example_type][index]
 
-        print(generation_summary)
+    def _pool_add(self, pool: _Pool, key: Word, word: Word) -> bool:
+        """
+        :return: whether word is new to pool
+        """
+        if not pool.add(key, word, word not in self._duplicate_exclusion):
+            return False
 
-    @staticmethod
-    def _dict_add(dic: Dict[Word, List[Word]], key: Word, value: Word) -> None:
-        if key in dic:
-            if value not in dic[key]:
-                dic[key].append(value)
+        if word in self._word_pools:
+            self._word_pools[word].append(pool)
         else:
-            dic[key] = [value]
+            self._word_pools[word] = [pool]
+
+        return True
+
+    def _exclude(self, words: List[Word]) -> None:
+        """
+        set words aside in every pool holding them, until the next fresh generation
+        """
+        for word in words:
+            self._duplicate_exclusion[word] = None
+
+            for pool in self._word_pools.get(word, []):
+                pool.set_aside(word)
 
     def get_difficulty(self) -> int:
         return self._difficulty
@@ -162,89 +474,35 @@ class Generator:
         if cadt + cadnt + cand + ncad + irr > amount:
             irr -= 1
 
-        print("\nExpected Number:", "CADT", cadt, "CADNT", cadnt, "CAND", cand, "NCAD", ncad, "IRR", irr)
-        return cadt, cadnt, cand, ncad, irr
-
-    @staticmethod
-    def _get_dist_values(dic: Dict[Word, List[Word]]) -> List[Word]:
-        existed = []
+        if instrument.has_listeners():
+            instrument.event("generator.expected", {"CADT": cadt, "CADNT": cadnt, "CAND": cand, "NCAD": ncad,
+                                                    "IRR": irr})
 
-        for lst in dic.values():
-            for item in lst:
-                if item not in existed:
-                    existed.append(item)
-
-        return existed
+        return cadt, cadnt, cand, ncad, irr
 
-    def _generate_words(self, amount: int, dic: Dict[Word, List[Word]]) -> List[Word]:
+    def _generate_words(self, amount: int, pool: _Pool) -> List[Word]:
         if amount == 0:
             return []
 
-        words = []
-        rand_keys = list(dic)
-        curr_index = 0
-        continue_find = True
-        empty_run = 0
-        prev_len = None
-
-        for key in rand_keys:
-            random.shuffle(dic[key])
-
-        while continue_find:
-            random.shuffle(rand_keys)
-
-            for key in rand_keys:
-                value_lst = dic[key]
-
-                if curr_index < len(value_lst):
-                    chosen = value_lst[curr_index]
-
-                    if chosen not in words and chosen not in self._duplicate_exclusion:
-                        words.append(chosen)
-
-                        if len(words) >= amount:
-                            continue_find = False
-                            break
-
-            if prev_len is None:
-                prev_len = len(words)
-            elif prev_len == len(words):
-                empty_run += 1
-
-            if empty_run >= 10:
-                break
-
-            curr_index += 1
-
-        self._duplicate_exclusion.extend(words)
+        words = pool.draw(amount)
+        self._exclude(words)
         return words
 
-    def _generate_helper(self, dic: Dict[Word, List[Word]], amount: int, name: str, feature_to_type: Dict[str, str],
+    def _generate_helper(self, example_type: ExampleType, index: int, amount: int, feature_to_type: Dict[str, str],
                          feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
         if amount == 0:
             return []
 
-        vals = self._get_dist_values(dic)
+        pool = self._get_pool(example_type, index)
 
-        if len(vals) == 0:
-            warnings.warn("No %s type found.(%d required, 0 found)" % (name, amount))
-            return []
+        if pool.get_fresh_size() < amount:
+            self._top_up(example_type, index, amount, feature_to_type, feature_to_sounds)
 
-        if len(vals) >= amount:
-            words = self._generate_words(amount, dic)
-            return words
-        else:
-            print("?")
-            warnings.warn(
-                "Insufficient amount of %s type.(%d required, %d found), expanding library" % (name, amount, len(vals)))
-            self._expand_library(WORD_POOL_DEFAULT_SIZE, feature_to_type, feature_to_sounds)
-            self._duplicate_exclusion.extend(vals)
-            vals.extend(self._generate_helper(dic, amount - len(vals), name, feature_to_type, feature_to_sounds))
-            return vals
-
-    def generate(self, amount: Optional[int, List[int]], is_fresh: bool, feature_to_type: Dict[str, str],
+        return self._generate_words(amount, pool)
+
+    def generate(self, amount: Union[int, List[int]], is_fresh: bool, feature_to_type: Dict[str, str],
                  feature_to_sounds: Dict[str, List[Sound]], gloss_groups: List[GlossGroup]) -> Optional[
-        Tuple[List[Tuple[Word, str]], List[Tuple[Word, str]], Rule, List[Template], List[int]], None]:
+        Tuple[List[Tuple[Word, str]], List[Tuple[Word, str]], Rule, List[Template], List[int]]]:
         """
 
         :param amount: single int representing total generation amount (distribution by proportion), or a int list
@@ -256,7 +514,11 @@ class Generator:
         :return:
         """
         if is_fresh:
-            self._duplicate_exclusion = []
+            self._duplicate_exclusion = {}
+
+            for pools in (self._CADT, self._CADNT, self._CAND, self._NCAD, self._IRR):
+                for pool in pools:
+                    pool.reset()
 
         ur_words = []  # type: List[Word]
         sr_words = []  # type: List[Word]
@@ -276,12 +538,12 @@ class Generator:
         for index in range(0, split_size):
             # START RANDOM PICK
 
-            cadt_words = self._generate_helper(self._CADT[index], cadt_num, "CADT", feature_to_type, feature_to_sounds)
-            cadnt_words = self._generate_helper(self._CADNT[index], cadnt_num, "CADNT", feature_to_type,
+            cadt_words = self._generate_helper(ExampleType.CADT, index, cadt_num, feature_to_type, feature_to_sounds)
+            cadnt_words = self._generate_helper(ExampleType.CADNT, index, cadnt_num, feature_to_type,
                                                 feature_to_sounds)
-            cand_words = self._generate_helper(self._CAND[index], cand_num, "CAND", feature_to_type, feature_to_sounds)
-            ncad_words = self._generate_helper(self._NCAD[index], ncad_num, "NCAD", feature_to_type, feature_to_sounds)
-            irr_words = self._generate_helper(self._IRR[index], irr_num, "IRR", feature_to_type, feature_to_sounds)
+            cand_words = self._generate_helper(ExampleType.CAND, index, cand_num, feature_to_type, feature_to_sounds)
+            ncad_words = self._generate_helper(ExampleType.NCAD, index, ncad_num, feature_to_type, feature_to_sounds)
+            irr_words = self._generate_helper(ExampleType.IRR, index, irr_num, feature_to_type, feature_to_sounds)
 
             # FINISH RANDOM PICK
             cadt_res, cadnt_res, cand_res, ncad_res, irr_res = len(cadt_words), len(cadnt_words), len(cand_words), len(
@@ -293,27 +555,30 @@ class Generator:
 
             if irr_res == 0 and irr_num > 0:
                 cadt_words.extend(
-                    self._generate_helper(self._CADT[index], irr_num, "CADT", feature_to_type, feature_to_sounds))
+                    self._generate_helper(ExampleType.CADT, index, irr_num, feature_to_type, feature_to_sounds))
 
             if cadnt_res == 0 and cadnt_num > 0:
                 cadt_words.extend(
-                    self._generate_helper(self._CADT[index], cadnt_num, "CADT", feature_to_type, feature_to_sounds))
+                    self._generate_helper(ExampleType.CADT, index, cadnt_num, feature_to_type, feature_to_sounds))
 
             if cand_res == 0 and cand_num > 0:
                 if ncad_res == 0:
                     cadt_words.extend(
-                        self._generate_helper(self._CADT[index], cand_num + ncad_num, "CADT", feature_to_type,
+                        self._generate_helper(ExampleType.CADT, index, cand_num + ncad_num, feature_to_type,
                                               feature_to_sounds))
                 else:
-                    ncad_words.extend(self._generate_helper(self._NCAD[index], cand_num, "NCAD", feature_to_type,
+                    ncad_words.extend(self._generate_helper(ExampleType.NCAD, index, cand_num, feature_to_type,
                                                             feature_to_sounds))
 
             if ncad_res == 0 and ncad_num > 0:
-                cand_words.extend(self._generate_helper(self._CAND[index], ncad_num, "CAND", feature_to_type,
+                cand_words.extend(self._generate_helper(ExampleType.CAND, index, ncad_num, feature_to_type,
                                                         feature_to_sounds))
 
-            print("\nActual Number:", "CADT", len(cadt_words), "CADNT", len(cadnt_words), "CAND", len(cand_words),
-                  "NCAD", len(ncad_words), "IRR", len(irr_words))
+            if instrument.has_listeners():
+                instrument.event("generator.actual", {"CADT": len(cadt_words), "CADNT": len(cadnt_words),
+                                                      "CAND": len(cand_words), "NCAD": len(ncad_words),
+                                                      "IRR": len(irr_words)})
+
             generation_amounts[0] += len(cadt_words)
             generation_amounts[1] += len(cadnt_words)
             generation_amounts[2] += len(cand_words)
@@ -332,9 +597,186 @@ class Generator:
 
         size = len(ur_words)
 
-        gloss_words = [w.pick() for w in random.sample(gloss_groups, size)]
+        with instrument.timer("generator.gloss"):
+            gloss_words = [w.pick() for w in random.sample(gloss_groups, size)]
 
         underlying_rep = [(ur_words[i], gloss_words[i]) for i in range(0, size)]
         surface_rep = [(sr_words[i], gloss_words[i]) for i in range(0, size)]
 
         return underlying_rep, surface_rep, self._rule, self._templates, generation_amounts
+
+
+class _Pool:
+    """
+    The examples of one type in one C/D alternative, grouped by the key classify gives them. Every word is kept once in
+    insertion order. The words not handed out yet are also kept per key in lists indexed by word, so drawing one and
+    setting one aside take constant time however large the library grows.
+    """
+    _words: Dict[Word, Word]
+    _fresh: Dict[Word, List[Word]]
+    _positions: Dict[Word, int]
+
+    def __init__(self) -> None:
+        self._words = {}
+        self._fresh = {}
+        self._positions = {}
+
+    def add(self, key: Word, word: Word, fresh: bool) -> bool:
+        """
+        :return: whether word was not in the pool yet
+        """
+        if word in self._words:
+            return False
+
+        self._words[word] = key
+
+        if fresh:
+            self._add_fresh(key, word)
+
+        return True
+
+    def _add_fresh(self, key: Word, word: Word) -> None:
+        if key not in self._fresh:
+            self._fresh[key] = []
+
+        self._positions[word] = len(self._fresh[key])
+        self._fresh[key].append(word)
+
+    def set_aside(self, word: Word) -> None:
+        position = self._positions.pop(word, None)
+
+        if position is None:
+            return
+
+        fresh = self._fresh[self._words[word]]
+        last = fresh.pop()
+
+        if last != word:
+            fresh[position] = last
+            self._positions[last] = position
+
+    def reset(self) -> None:
+        """
+        make every word fresh again
+        """
+        self._fresh = {}
+        self._positions = {}
+
+        for word, key in self._words.items():
+            self._add_fresh(key, word)
+
+    def get_size(self) -> int:
+        return len(self._words)
+
+    def get_fresh_size(self) -> int:
+        return len(self._positions)
+
+    def get_fresh(self) -> List[Word]:
+        return [w for w in self._words if w in self._positions]
+
+    def draw(self, amount: int) -> List[Word]:
+        """
+        Up to amount distinct fresh words, which stay fresh. Every round visits the keys in random order and draws one
+        of each key's fresh words not drawn yet, so keys with few words are not drowned by keys with many.
+        """
+        words = []  # type: List[Word]
+        drawn = {key: 0 for key, fresh in self._fresh.items() if len(fresh) > 0}
+        keys = list(drawn)
+
+        while len(words) < amount and len(keys) > 0:
+            random.shuffle(keys)
+
+            for key in keys:
+                fresh = self._fresh[key]
+                taken = drawn[key]
+                chosen = random.randrange(taken, len(fresh))
+                fresh[taken], fresh[chosen] = fresh[chosen], fresh[taken]
+                self._positions[fresh[taken]] = taken
+                self._positions[fresh[chosen]] = chosen
+                words.append(fresh[taken])
+                drawn[key] += 1
+
+                if len(words) >= amount:
+                    break
+
+            keys = [key for key in keys if drawn[key] < len(self._fresh[key])]
+
+        return words
+
+
+class _Sampler:
+    """
+    What sampling and classifying template words for a generator needs, sent once to every worker process.
+    """
+    _rule: Rule
+    _templates: List[Template]
+    _phonemes: List[Word]
+    _feature_to_type: Dict[str, str]
+    _feature_to_sounds: Dict[str, List[Sound]]
+    _phonotactics: Optional[Phonotactics]
+
+    def __init__(self, rule: Rule, templates: List[Template], phonemes: List[Word], feature_to_type: Dict[str, str],
+                 feature_to_sounds: Dict[str, List[Sound]], phonotactics: Optional[Phonotactics]) -> None:
+        self._rule = rule
+        self._templates = templates
+        self._phonemes = phonemes
+        self._feature_to_type = feature_to_type
+        self._feature_to_sounds = feature_to_sounds
+        self._phonotactics = phonotactics
+
+    def sample(self, job: Tuple[int, int, int, int, int, int]) -> Tuple[List[Word], List[Word]]:
+        """
+        Sample one template with the random generator seeded by the job, leaving the global random state as it was.
+
+        :param job: (template index, IRR words, sampled related words, constructed CADT words, constructed CADNT words,
+                    seed)
+        :return: the related words and the shuffled IRR words
+        """
+        index, irr_size, related_size, cadt_size, cadnt_size, seed = job
+        template = self._templates[index]
+        state = random.getstate()
+        random.seed(seed)
+
+        try:
+            a_matcher = self._rule.get_a_matcher(self._phonemes, None, self._feature_to_sounds)
+            a_sounds = set(a_matcher)
+            irr_phoneme = [w for w in self._phonemes if w not in a_sounds]
+
+            irr_word_list = template.generate_word_list(irr_phoneme, irr_size, self._feature_to_sounds, None,
+                                                        self._phonotactics)
+            related_word_list = template.generate_word_list(self._phonemes, related_size, self._feature_to_sounds,
+                                                            a_matcher, self._phonotactics)
+
+            for example_type, size in ((ExampleType.CADT, cadt_size), (ExampleType.CADNT, cadnt_size)):
+                related_word_list.extend(construct_examples(self._rule, template, self._phonemes, size, example_type,
+                                                            self._feature_to_type, self._feature_to_sounds,
+                                                            self._phonotactics))
+
+            random.shuffle(irr_word_list)
+        finally:
+            random.setstate(state)
+
+        return related_word_list, irr_word_list
+
+    def classify(self, words: List[Word]) -> List[List[Dict[ExampleType, Word]]]:
+        return [self._rule.classify(w, self._phonemes, self._feature_to_type, self._feature_to_sounds) for w in words]
+
+
+_worker_sampler = None  # type: Optional[_Sampler]
+
+
+def _init_worker(inventory: object, sampler: _Sampler) -> None:
+    """
+    keep the sampler in the worker process; the inventory comes first so words unpickled after it find it
+    """
+    global _worker_sampler
+
+    _worker_sampler = sampler
+
+
+def _sample_job(job: Tuple[int, int, int, int, int, int]) -> Tuple[List[Word], List[Word]]:
+    return _worker_sampler.sample(job)
+
+
+def _classify_chunk(words: List[Word]) -> List[List[Dict[ExampleType, Word]]]:
+    return _worker_sampler.classify(words)
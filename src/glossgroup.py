@@ -49,6 +49,13 @@ class GlossFamily:
 
 
 def import_default_gloss() -> Tuple[List[GlossFamily], List[GlossGroup]]:
+    from bundle import load_default_bundle
+
+    bundle = load_default_bundle()
+
+    if bundle is not None:
+        return bundle["gloss"]
+
     return _fetch_gloss('defaultgloss.txt')
 
 
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import json
+import math
+from time import perf_counter
+from typing import Dict, List, Any, Callable, Optional, Union
+
+ENABLED = False
+
+_recorder = None  # type: Optional[Recorder]
+_listeners = []  # type: List[Callable[[str, Dict[str, Any]], None]]
+
+
+class Recorder:
+    """
+    In-memory store of counters, timers and histograms. Subclass it and pass the instance to enable to send the
+    measurements elsewhere.
+
+    Histograms and timers keep their count, total, minimum and maximum, and count values into power-of-two buckets: a
+    value falls into the bucket of the smallest power of two not below it.
+    """
+    _counters: Dict[str, int]
+    _timers: Dict[str, List[float]]
+    _histograms: Dict[str, List[float]]
+    _buckets: Dict[str, Dict[float, int]]
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def time(self, name: str, seconds: float) -> None:
+        self._add(self._timers, name, seconds)
+
+    def observe(self, name: str, value: float) -> None:
+        self._add(self._histograms, name, value)
+
+    def _add(self, store: Dict[str, List[float]], name: str, value: float) -> None:
+        stat = store.get(name)
+
+        if stat is None:
+            store[name] = [1, value, value, value]
+            self._buckets[name] = {}
+        else:
+            stat[0] += 1
+            stat[1] += value
+            stat[2] = min(stat[2], value)
+            stat[3] = max(stat[3], value)
+
+        bound = 0.0 if value <= 0 else 2.0 ** math.ceil(math.log2(value))
+        buckets = self._buckets[name]
+        buckets[bound] = buckets.get(bound, 0) + 1
+
+    def reset(self) -> None:
+        self._counters = {}
+        self._timers = {}
+        self._histograms = {}
+        self._buckets = {}
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {"counters": dict(self._counters),
+                "timers": {name: self._summary(name, stat) for name, stat in self._timers.items()},
+                "histograms": {name: self._summary(name, stat) for name, stat in self._histograms.items()}}
+
+    def _summary(self, name: str, stat: List[float]) -> Dict[str, Any]:
+        return {"count": stat[0], "total": stat[1], "min": stat[2], "max": stat[3], "mean": stat[1] / stat[0],
+                "buckets": {str(bound): n for bound, n in sorted(self._buckets[name].items())}}
+
+
+class _Timer:
+    _name: str
+    _start: float
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __enter__(self) -> _Timer:
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _recorder.time(self._name, perf_counter() - self._start)
+
+
+class _NoTimer:
+    def __enter__(self) -> _NoTimer:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def enable(recorder: Optional[Recorder] = None) -> None:
+    """
+    Start recording into recorder, or into a fresh Recorder when None. While disabled, which is the default, every
+    recording function returns at once; hot paths check ENABLED before measuring anything.
+    """
+    global ENABLED, _recorder
+
+    _recorder = Recorder() if recorder is None else recorder
+    ENABLED = True
+
+
+def disable() -> None:
+    global ENABLED
+
+    ENABLED = False
+
+
+def get_recorder() -> Optional[Recorder]:
+    return _recorder
+
+
+def count(name: str, amount: int = 1) -> None:
+    if ENABLED:
+        _recorder.count(name, amount)
+
+
+def record_time(name: str, seconds: float) -> None:
+    if ENABLED:
+        _recorder.time(name, seconds)
+
+
+def observe(name: str, value: float) -> None:
+    if ENABLED:
+        _recorder.observe(name, value)
+
+
+def timer(name: str) -> Union[_Timer, _NoTimer]:
+    """
+    context manager timing its block under name
+    """
+    return _Timer(name) if ENABLED else _NO_TIMER
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    :return: counters by name, and timers (in seconds) and histograms by name with their count, total, min, max, mean
+             and buckets; all empty when nothing has been recorded
+    """
+    if _recorder is None:
+        return {"counters": {}, "timers": {}, "histograms": {}}
+
+    return _recorder.snapshot()
+
+
+def snapshot_json(indent: Optional[int] = None) -> str:
+    return json.dumps(snapshot(), indent=indent, ensure_ascii=False)
+
+
+def add_listener(listener: Callable[[str, Dict[str, Any]], None]) -> None:
+    """
+    subscribe listener to debug events; events are only built and sent while some listener is subscribed
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[str, Dict[str, Any]], None]) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def has_listeners() -> bool:
+    return len(_listeners) > 0
+
+
+def event(name: str, data: Dict[str, Any]) -> None:
+    for listener in _listeners:
+        listener(name, data)
+
+
+def print_event(name: str, data: Dict[str, Any]) -> None:
+    """
+    listener printing every event on one line
+    """
+    print("%s: %s" % (name, ", ".join(["%s %s" % (k, str(v)) for k, v in data.items()])))
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+from time import perf_counter
+from typing import List, Dict, Tuple, Optional, Any
+
+from sound import Sound
+import instrument
+
+_TERMINAL = None
+_NORMALIZATION = {'ɡ': 'g', '\u035c': '\u0361'}  # type: Dict[str, str]
+
+_INVENTORIES = {}  # type: Dict[str, Inventory]
+_default = None  # type: Optional[Inventory]
+
+
+class Inventory:
+    """
+    One loaded feature table: its symbols, sounds and feature indexes. Words and feature maps are bound to the
+    inventory their sounds come from, so several tables can be loaded side by side. Inventories are registered by
+    name once loaded; the first one registered becomes the default used by Word(str) when no inventory is given.
+
+    A name stands for one inventory per process, since pickled and stored words find their sounds by it: loading or
+    unpickling the same sound table under a registered name gives back the registered inventory, and another table
+    under it raises ValueError.
+    """
+    _name: str
+    _symbols: Dict[str, Sound]
+    _numbered: Dict[int, Sound]
+    _symbol_trie: Dict[Optional[str], Any]
+    _features: List[str]
+    _type_to_features: Dict[str, List[str]]
+    _feature_to_type: Dict[str, str]
+    _feature_to_sounds: Any
+    _features_to_sound: Dict[Any, Sound]
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._symbols = {}
+        self._numbered = {}
+        self._symbol_trie = {}
+        self._features = []
+        self._type_to_features = {}
+        self._feature_to_type = {}
+        self._feature_to_sounds = None
+        self._features_to_sound = {}
+
+    def add_sound(self, sound: Sound) -> None:
+        symbol = sound.get_symbol()
+
+        if symbol in self._symbols:
+            raise ValueError("Duplicated symbol not allowed!")
+
+        if sound.get_num() < 1 or symbol == '':
+            raise ValueError("Only numbered sounds with a symbol can join an inventory")
+
+        self._symbols[symbol] = sound
+        self._numbered[sound.get_num()] = sound
+        sound.set_inventory(self)
+        node = self._symbol_trie
+
+        for char in symbol:
+            node = node.setdefault(char, {})
+
+        node[_TERMINAL] = sound
+
+    def set_feature_data(self, features: List[str], type_to_features: Dict[str, List[str]],
+                         feature_to_type: Dict[str, str], feature_to_sounds: Any,
+                         features_to_sound: Dict[Any, Sound]) -> None:
+        """
+        Complete loading the inventory and register it. When its name is registered already, the inventory stays
+        unregistered: get_inventory gives the one loaded first, which has the same sound table.
+        """
+        self._features = features
+        self._type_to_features = type_to_features
+        self._feature_to_type = feature_to_type
+        self._feature_to_sounds = feature_to_sounds
+        self._features_to_sound = features_to_sound
+
+        _register(self)
+
+    def get_feature_data(self) -> tuple:
+        """
+        (features, sounds, type_to_features, feature_to_type, feature_to_sounds, features_to_sound), in the order the
+        feature loaders return them
+        """
+        return self._features, self.get_sounds(), self._type_to_features, self._feature_to_type, \
+               self._feature_to_sounds, self._features_to_sound
+
+    def get_name(self) -> str:
+        return self._name
+
+    def get_sounds(self) -> List[Sound]:
+        return list(self._numbered.values())
+
+    def get_sound_by_num(self, num: int) -> Sound:
+        return self._numbered[num]
+
+    def get_feature_to_type(self) -> Dict[str, str]:
+        return self._feature_to_type
+
+    def get_feature_to_sounds(self) -> Any:
+        return self._feature_to_sounds
+
+    def has_symbol(self, symbol: str) -> bool:
+        return symbol in self._symbols
+
+    def tokenize(self, data: str) -> List[Sound]:
+        """
+        Split an IPA string into this inventory's sounds in one pass, always taking the longest symbol. 'ɡ' is read as
+        'g' and the tie bar below as the tie bar above.
+        """
+        start = perf_counter() if instrument.ENABLED else None
+        sounds = []  # type: List[Sound]
+        i = 0
+        data_len = len(data)
+
+        while i < data_len:
+            node = self._symbol_trie
+            longest = None
+            end_loc = i
+
+            for j in range(i, data_len):
+                char = data[j]
+                node = node.get(_NORMALIZATION.get(char, char))
+
+                if node is None:
+                    break
+
+                if _TERMINAL in node:
+                    longest = node[_TERMINAL]
+                    end_loc = j + 1
+
+            if longest is None:
+                raise ValueError("Unknown symbol \'%s\' at position %d of \'%s\'" % (data[i], i, data))
+
+            sounds.append(longest)
+            i = end_loc
+
+        if start is not None:
+            instrument.record_time("word.parse", perf_counter() - start)
+            instrument.observe("word.parse.length", data_len)
+
+        return sounds
+
+    def __getitem__(self, symbol: str) -> Sound:
+        return self._symbols[symbol.replace('ɡ', 'g')]
+
+    def __reduce__(self) -> Tuple[object, Tuple[str], Dict[str, Any]]:
+        return _restore_inventory, (self._name,), self.__dict__
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """
+        fill an unpickled inventory, or only bind the unpickled sounds when it resolved to the registered one
+        """
+        sounds = list(state["_numbered"].values())
+
+        if _INVENTORIES.get(state["_name"]) is self:
+            _check_table(self, sounds)
+        else:
+            self.__dict__.update(state)
+            _register(self)
+
+        for sound in sounds:
+            sound.set_inventory(self)
+
+    def __str__(self) -> str:
+        return self._name
+
+
+def _register(inventory: Inventory) -> None:
+    """
+    bind the inventory's name to it, unless the name is bound already to an inventory with the same sound table
+    """
+    global _default
+
+    registered = _INVENTORIES.get(inventory.get_name())
+
+    if registered is not None:
+        _check_table(registered, inventory.get_sounds())
+        return
+
+    _INVENTORIES[inventory.get_name()] = inventory
+
+    if _default is None:
+        _default = inventory
+
+
+def _check_table(inventory: Inventory, sounds: List[Sound]) -> None:
+    if _get_table(inventory.get_sounds()) != _get_table(sounds):
+        raise ValueError("Inventory %s is already loaded with another sound table, load this one under another name" %
+                         inventory.get_name())
+
+
+def _get_table(sounds: List[Sound]) -> List[Tuple[int, str, List[str]]]:
+    return [(s.get_num(), s.get_symbol(), s.get_features()) for s in sounds]
+
+
+def _restore_inventory(name: str) -> Inventory:
+    """
+    the registered inventory of that name, or a new one for the pickled state to fill
+    """
+    registered = _INVENTORIES.get(name)
+
+    return Inventory(name) if registered is None else registered
+
+
+def get_inventory(name: str) -> Inventory:
+    if name not in _INVENTORIES:
+        raise KeyError("Inventory %s has not been loaded" % name)
+
+    return _INVENTORIES[name]
+
+
+def get_default_inventory() -> Inventory:
+    if _default is None:
+        raise ValueError("No inventory has been loaded yet")
+
+    return _default
+
+
+def set_default_inventory(inventory: Inventory) -> None:
+    global _default
+
+    _default = inventory
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import warnings
+from typing import List, Dict, Tuple, Optional
+
+from inventory import Inventory
+from phonotactics import Phonotactics
+from rules import Rule, ExampleType
+from templates import Template
+from word import Word
+
+STORE_FILE = "examplelibrary.sqlite"
+STORE_VERSION = 1
+
+_CODE_FILES = ["library_store.py", "generator.py", "rules.py", "automaton.py", "batch.py", "cache.py", "word.py",
+               "sound.py", "inventory.py", "feature_lib.py", "templates.py", "phonotactics.py", "construct.py",
+               "applicability.py"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    template INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    alternative INTEGER NOT NULL,
+    key BLOB NOT NULL,
+    word BLOB NOT NULL,
+    UNIQUE (fingerprint, type, alternative, word)
+);
+CREATE TABLE IF NOT EXISTS yields (
+    fingerprint TEXT NOT NULL,
+    template INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    alternative INTEGER NOT NULL,
+    sampled INTEGER NOT NULL,
+    found INTEGER NOT NULL,
+    PRIMARY KEY (fingerprint, template, type, alternative)
+);
+"""
+
+_code_digest = None  # type: Optional[str]
+
+# (template index, example type, alternative, classify key, word)
+StoredExample = Tuple[int, ExampleType, int, Word, Word]
+
+
+class LibraryStore:
+    """
+    Examples generators have classified, kept in an SQLite file under the fingerprint of what classified them, so a
+    generator built again over the same rule, templates, phonemes and inventory starts from them instead of sampling and
+    classifying anew. Words are stored as their packed sound numbers, templates as their index in the generator's
+    template list. Rows are only ever added, and every one gets an increasing id, so a reader can pick up what other
+    generators appended since its last read.
+
+    The store is a cache: failing to read or write it is warned about and otherwise ignored.
+    """
+    _filename: str
+    _connection: Optional[sqlite3.Connection]
+
+    def __init__(self, filename: str = STORE_FILE) -> None:
+        self._filename = filename
+
+        try:
+            self._connection = sqlite3.connect(filename)
+            self._connection.executescript(_SCHEMA)
+        except sqlite3.Error as e:
+            warnings.warn("Could not open example store %s: %s" % (filename, str(e)))
+            self._connection = None
+
+    def get_filename(self) -> str:
+        return self._filename
+
+    def load(self, fingerprint: str, inventory: Inventory, after: int = 0) -> Tuple[List[StoredExample], int]:
+        """
+        :param after: only examples appended after the one of this id are read
+        :return: the examples stored under fingerprint, in the order they were appended, and the id of the last one
+                 (after when there is none)
+        """
+        if self._connection is None:
+            return [], after
+
+        try:
+            rows = self._connection.execute("SELECT id, template, type, alternative, key, word FROM examples "
+                                            "WHERE fingerprint = ? AND id > ? ORDER BY id",
+                                            (fingerprint, after)).fetchall()
+        except sqlite3.Error as e:
+            warnings.warn("Could not read example store %s: %s" % (self._filename, str(e)))
+            return [], after
+
+        examples = [(template, ExampleType[type_name], alternative, _to_word(key, inventory), _to_word(word, inventory))
+                    for _, template, type_name, alternative, key, word in rows]
+
+        return examples, rows[-1][0] if len(rows) > 0 else after
+
+    def load_yields(self, fingerprint: str) -> Dict[Tuple[int, ExampleType, int], List[int]]:
+        """
+        :return: (template index, type, alternative) -> [words sampled towards them, new examples found]
+        """
+        if self._connection is None:
+            return {}
+
+        try:
+            rows = self._connection.execute("SELECT template, type, alternative, sampled, found FROM yields "
+                                            "WHERE fingerprint = ?", (fingerprint,)).fetchall()
+        except sqlite3.Error as e:
+            warnings.warn("Could not read example store %s: %s" % (self._filename, str(e)))
+            return {}
+
+        return {(template, ExampleType[type_name], alternative): [sampled, found]
+                for template, type_name, alternative, sampled, found in rows}
+
+    def append(self, fingerprint: str, examples: List[StoredExample],
+               yields: Dict[Tuple[int, ExampleType, int], List[int]]) -> None:
+        """
+        add the examples not stored yet, and replace the stored yields by the given ones, in one transaction
+        """
+        if self._connection is None:
+            return
+
+        try:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO examples (fingerprint, template, type, alternative, key, word) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(fingerprint, template, example_type.name, alternative, _to_blob(key), _to_blob(word))
+                     for template, example_type, alternative, key, word in examples])
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO yields (fingerprint, template, type, alternative, sampled, found) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(fingerprint, template, example_type.name, alternative, sampled, found)
+                     for (template, example_type, alternative), (sampled, found) in yields.items()])
+        except sqlite3.Error as e:
+            warnings.warn("Could not write example store %s: %s" % (self._filename, str(e)))
+
+    def clear(self, fingerprint: Optional[str] = None) -> None:
+        """
+        forget the examples and yields stored under fingerprint, or everything when it is None
+        """
+        if self._connection is None:
+            return
+
+        condition, parameters = ("", ()) if fingerprint is None else (" WHERE fingerprint = ?", (fingerprint,))
+
+        try:
+            with self._connection:
+                self._connection.execute("DELETE FROM examples" + condition, parameters)
+                self._connection.execute("DELETE FROM yields" + condition, parameters)
+        except sqlite3.Error as e:
+            warnings.warn("Could not write example store %s: %s" % (self._filename, str(e)))
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def get_fingerprint(rule: Rule, templates: List[Template], phonemes: List[Word], inventory: Inventory,
+                    phonotactics: Optional[Phonotactics] = None) -> str:
+    """
+    Digest of everything a generator's examples depend on: the rule, the templates in order with their phonotactics,
+    the phonemes, the extra phonotactics, every sound of the inventory with its features, and the code sampling,
+    classifying and recording the words.
+    """
+    parts = [str(STORE_VERSION), _get_code_digest(), str(rule), str(phonotactics)]
+    parts.extend(["%s %s" % (str(t), str(t.get_phonotactics())) for t in templates])
+    parts.append(" ".join([str(p) for p in phonemes]))
+    parts.extend(["%d %s %s" % (s.get_num(), s.get_symbol(), ",".join(sorted(s.get_features())))
+                  for s in inventory.get_sounds()])
+
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _get_code_digest() -> str:
+    global _code_digest
+
+    if _code_digest is None:
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256()
+
+        for filename in _CODE_FILES:
+            with open(os.path.join(code_dir, filename), 'rb') as code_file:
+                digest.update(code_file.read())
+
+        _code_digest = digest.hexdigest()
+
+    return _code_digest
+
+
+def _to_blob(word: Word) -> bytes:
+    return word.get_ids().tobytes()
+
+
+def _to_word(blob: bytes, inventory: Inventory) -> Word:
+    return Word.from_ids(memoryview(blob).cast('H'), inventory)
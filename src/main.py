@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import sys
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 
 from feature_lib import Particle, import_default_features
 from generator import Generator
@@ -11,6 +11,8 @@ from sound import Sound
 from glossgroup import import_default_gloss
 from templates import Template, import_default_templates
 from phonemes import import_default_phonemes
+from applicability import ApplicabilityMatrix
+import instrument
 
 
 def _print_result(rst: tuple):
@@ -28,7 +30,15 @@ def _print_result(rst: tuple):
         print(t)
 
 
-def random_select(families: List[RuleFamily], rules_: List[Rule], family_num: int, rule_num: int) -> List[Rule]:
+def random_select(families: List[RuleFamily], rules_: List[Rule], family_num: int, rule_num: int,
+                  matrix: Optional[ApplicabilityMatrix] = None) -> List[Rule]:
+    """
+    :param matrix: when given, rules that can not change any word of its inventory and templates are never chosen
+    """
+    if matrix is not None:
+        rules_ = [r for r in rules_ if matrix.is_applicable(r)]
+        families = [f for f in families if True in [matrix.is_applicable(r) for r in f.get_rules()]]
+
     if family_num > rule_num:
         raise AttributeError("family num larger than rule num")
 
@@ -39,7 +49,8 @@ def random_select(families: List[RuleFamily], rules_: List[Rule], family_num: in
         raise AttributeError("num greater than rule size")
 
     chosen_family = random.choices(families, k=family_num)  # type: List[RuleFamily]
-    rules_pool = [family_.get_rules() for family_ in chosen_family]
+    rules_pool = [[r for r in family_.get_rules() if matrix is None or matrix.is_applicable(r)]
+                  for family_ in chosen_family]
     random_result = []
 
     while rule_num > 0:
@@ -59,6 +70,7 @@ def random_select(families: List[RuleFamily], rules_: List[Rule], family_num: in
 
 
 if __name__ == '__main__':
+    instrument.add_listener(instrument.print_event)
     tup = import_default_features()
 
     features = tup[0]  # type: List[str]
@@ -66,7 +78,7 @@ if __name__ == '__main__':
     type_to_features = tup[2]  # type: Dict[str, List[str]]
     feature_to_type = tup[3]  # type: Dict[str, str]
     feature_to_sounds = tup[4]  # type: Dict[str, List[Sound]]
-    features_to_sound = tup[5]  # type: Dict[Particle, Sound]
+    features_to_sound = tup[5]  # type: Dict[Tuple[str, ...], Sound]
 
     templates = import_default_templates(features)  # type: List[Template]
 
@@ -76,7 +88,7 @@ if __name__ == '__main__':
         print(ti, template)
         ti += 1
 
-    rule_data = import_default_rules(features)  # type: Tuple[List[RuleFamily], List[Rule]]
+    rule_data: Tuple[List[RuleFamily], List[Rule]] = import_default_rules(features, feature_to_type, feature_to_sounds)
     rule_families = rule_data[0]  # type: List[RuleFamily]
     rules = rule_data[1]  # type: List[Rule]
 
@@ -140,15 +152,18 @@ if __name__ == '__main__':
 
     gen = Generator(phonemes, use_templates, use_rule, 5, feature_to_type, feature_to_sounds)
 
-    result = gen.generate(amount, True, feature_to_type, feature_to_sounds, gloss_groups)
+    try:
+        result = gen.generate(amount, True, feature_to_type, feature_to_sounds, gloss_groups)
 
-    _print_result(result)
+        _print_result(result)
 
-    print("\n\n\nTRIAL 2\n\n\n")
+        print("\n\n\nTRIAL 2\n\n\n")
 
-    result2 = gen.generate([5, 0, 0, 0, 0], False, feature_to_type, feature_to_sounds, gloss_groups)
+        result2 = gen.generate([5, 0, 0, 0, 0], False, feature_to_type, feature_to_sounds, gloss_groups)
 
-    _print_result(result2)
+        _print_result(result2)
+    finally:
+        gen.close()
 
     # sample template gen
     # print(templates[0].generate_word_list(feature_to_sounds))
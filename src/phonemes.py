@@ -1,18 +1,21 @@
 from __future__ import annotations
 
 import random
-from typing import List
+from typing import List, Optional
 
-from sound import Sound
 from word import Word
+from inventory import Inventory, get_default_inventory
 from random import random, sample
 
 
-def import_default_phonemes() -> List[Word]:
-    return _fetch_randomized_phonemes("defaultpresetphoneme.txt")
+def import_default_phonemes(inventory: Optional[Inventory] = None) -> List[Word]:
+    return _fetch_randomized_phonemes("defaultpresetphoneme.txt", inventory)
 
 
-def _fetch_randomized_phonemes(filename: str) -> List[Word]:
+def _fetch_randomized_phonemes(filename: str, inventory: Optional[Inventory] = None) -> List[Word]:
+    if inventory is None:
+        inventory = get_default_inventory()
+
     phoneme_list = []
     phoneme_str = []
 
@@ -111,12 +114,15 @@ def _fetch_randomized_phonemes(filename: str) -> List[Word]:
         drop_list.extend(["ɪ", "ʊ", "u"])
 
     phoneme_randomized = [s for s in phoneme_str if s not in drop_list]
-    phonemes = [Word([Sound(-1, '', [])[str(s)]]) for s in phoneme_randomized]
+    phonemes = [Word([inventory[str(s)]]) for s in phoneme_randomized]
 
     return phonemes
 
 
-def _fetch_preset_phonemes(filename: str) -> List[Word]:
+def _fetch_preset_phonemes(filename: str, inventory: Optional[Inventory] = None) -> List[Word]:
+    if inventory is None:
+        inventory = get_default_inventory()
+
     phonemes = []
 
     with open(filename, encoding='utf-8') as data_file:
@@ -127,6 +133,6 @@ def _fetch_preset_phonemes(filename: str) -> List[Word]:
             data = line.split(" ")
 
             for sound_str in data:
-                phonemes.append(Word([Sound(-1, '', [])[str(sound_str)]]))
+                phonemes.append(Word([inventory[str(sound_str)]]))
 
     return phonemes
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import List, Optional, Sequence, Union
+
+from feature_lib import Particle, FeatureSoundMap
+from sound import Sound
+
+
+class PhonotacticConstraint(ABC):
+    """
+    A restriction on adjacent sounds: it looks at a window of get_size() sounds and tells whether the window is banned.
+    """
+
+    @abstractmethod
+    def get_size(self) -> int:
+        pass
+
+    @abstractmethod
+    def is_banned(self, ids: Sequence[int], begin: int, feature_to_sounds: FeatureSoundMap) -> bool:
+        """
+        :param ids: sound numbers, holding the whole window starting at begin
+        """
+        pass
+
+
+class BannedSequence(PhonotacticConstraint):
+    """
+    Bans every run of sounds matching the items one by one; a particle matches the sounds having its features, a sound
+    only matches itself. [vowel]-[vowel] bans vowel hiatus, for instance.
+    """
+    _items: List[Union[Particle, Sound]]
+
+    def __init__(self, items: List[Union[Particle, Sound]]) -> None:
+        if len(items) == 0:
+            raise AttributeError("A banned sequence needs at least one item")
+
+        self._items = items
+
+    def get_items(self) -> List[Union[Particle, Sound]]:
+        return [i for i in self._items]
+
+    def get_size(self) -> int:
+        return len(self._items)
+
+    def is_banned(self, ids: Sequence[int], begin: int, feature_to_sounds: FeatureSoundMap) -> bool:
+        for k in range(0, len(self._items)):
+            item = self._items[k]
+            mask = feature_to_sounds.get_particle_mask(item) if isinstance(item, Particle) else item.get_mask()
+
+            if (mask >> (ids[begin + k] - 1)) & 1 == 0:
+                return False
+
+        return True
+
+    def __str__(self) -> str:
+        return "*" + "-".join([str(i) for i in self._items])
+
+
+class IdenticalAdjacency(PhonotacticConstraint):
+    """
+    Bans a sound directly followed by itself, among the sounds matching particle, or among all sounds when it is None.
+    """
+    _particle: Optional[Particle]
+
+    def __init__(self, particle: Optional[Particle] = None) -> None:
+        self._particle = particle
+
+    def get_particle(self) -> Optional[Particle]:
+        return self._particle
+
+    def get_size(self) -> int:
+        return 2
+
+    def is_banned(self, ids: Sequence[int], begin: int, feature_to_sounds: FeatureSoundMap) -> bool:
+        if ids[begin] != ids[begin + 1]:
+            return False
+
+        return self._particle is None or \
+               (feature_to_sounds.get_particle_mask(self._particle) >> (ids[begin] - 1)) & 1 == 1
+
+    def __str__(self) -> str:
+        return "*XX" if self._particle is None else "*XX in " + str(self._particle)
+
+
+class Phonotactics:
+    """
+    Constraints every word of a template, or every word built over an inventory, has to satisfy. All of them are local,
+    so templates check them while choosing sounds and drop a partial word as soon as it breaks one.
+    """
+    _constraints: List[PhonotacticConstraint]
+    _span: int
+
+    def __init__(self, constraints: List[PhonotacticConstraint]) -> None:
+        self._constraints = constraints
+        self._span = max([c.get_size() for c in constraints] + [1])
+
+    def get_constraints(self) -> List[PhonotacticConstraint]:
+        return [c for c in self._constraints]
+
+    def get_span(self) -> int:
+        """
+        :return: the widest window any constraint looks at
+        """
+        return self._span
+
+    def union(self, other: Optional[Phonotactics]) -> Phonotactics:
+        if other is None or other is self:
+            return self
+
+        return Phonotactics(self._constraints + [c for c in other.get_constraints() if c not in self._constraints])
+
+    def allows_start(self, ids: Sequence[int], feature_to_sounds: FeatureSoundMap) -> bool:
+        """
+        :return: whether no constraint bans a window starting at the first sound of ids
+        """
+        for constraint in self._constraints:
+            if constraint.get_size() <= len(ids) and constraint.is_banned(ids, 0, feature_to_sounds):
+                return False
+
+        return True
+
+    def allows_end(self, ids: Sequence[int], feature_to_sounds: FeatureSoundMap) -> bool:
+        """
+        :return: whether no constraint bans a window ending at the last sound of ids
+        """
+        for constraint in self._constraints:
+            if constraint.get_size() <= len(ids) and \
+                    constraint.is_banned(ids, len(ids) - constraint.get_size(), feature_to_sounds):
+                return False
+
+        return True
+
+    def allows(self, ids: Sequence[int], feature_to_sounds: FeatureSoundMap) -> bool:
+        for constraint in self._constraints:
+            for begin in range(0, len(ids) - constraint.get_size() + 1):
+                if constraint.is_banned(ids, begin, feature_to_sounds):
+                    return False
+
+        return True
+
+    def __str__(self) -> str:
+        return ", ".join([str(c) for c in self._constraints])
@@ -1,16 +1,25 @@
 from __future__ import annotations
 
 from enum import Enum
-from typing import List, Optional, Dict, Tuple
+from time import perf_counter
+from typing import List, Optional, Dict, Tuple, Set
 
 from word import Word
-from feature_lib import Particle
-from sound import Sound
+from feature_lib import Particle, FeatureSoundMap
+from sound import Sound, TransformationTable
+from inventory import Inventory
 from templates import Template
+from automaton import RuleAutomaton, PatternAutomaton
+from cache import LRUCache
+from batch import np, RuleBatch, CADT_BIT, CADNT_BIT, CAND_BIT, NCAD_BIT, IRR_BIT
 
 import csv
+import warnings
+import instrument
 
 EDGE_SYMBOL = '#'
+CADT_CACHE_DEFAULT_SIZE = 4096
+COMPILED_CACHE_DEFAULT_SIZE = 8
 
 
 class ExampleType(Enum):
@@ -24,182 +33,351 @@ class ExampleType(Enum):
         return self.name
 
 
+EXAMPLE_TYPE_BITS = {ExampleType.CADT: CADT_BIT, ExampleType.CADNT: CADNT_BIT, ExampleType.CAND: CAND_BIT,
+                     ExampleType.NCAD: NCAD_BIT, ExampleType.IRR: IRR_BIT}
+
+
 class Rule:
     """
     A>B/C_D
     """
     _As: List[List[Particle]]
-    _B: Optional[Tuple[Particle, List[str]], None]
-    _Cs: List[Optional[List[Particle], None]]
-    _Ds: List[Optional[List[Particle], None]]
-
-    _CADT_lib: Dict[Word, List[Tuple[int, int]]]
+    _B: Optional[Tuple[Particle, List[str]]]
+    _Cs: List[Optional[List[Particle]]]
+    _Ds: List[Optional[List[Particle]]]
+
+    _CADT_lib: LRUCache
+    _automata: LRUCache
+    _a_automata: LRUCache
+    _batches: LRUCache
     _Cs_edge: List[bool]
     _Ds_edge: List[bool]
     _name: str
     _family: RuleFamily
 
     def __init__(self, name: str, family: RuleFamily, a: List[List[Particle]],
-                 b: Optional[Tuple[Particle, List[str]], None], c: List[Optional[List[Particle], None]],
-                 c_edge: List[bool], d: List[Optional[List[Particle], None]], d_edge: List[bool]) -> None:
+                 b: Optional[Tuple[Particle, List[str]]], c: List[Optional[List[Particle]]],
+                 c_edge: List[bool], d: List[Optional[List[Particle]]], d_edge: List[bool]) -> None:
         self._name = name
         self._family = family
         self._As = a
-        self._A_matchers = {}
         self._B = b
 
         if len(c) != len(d):
             raise AttributeError("C and D list can not have different length %s _ %s" % (c, d))
 
         self._Cs = c
-        self._C_matchers = {}
         self._Ds = d
-        self._D_matchers = {}
         self._Cs_edge = c_edge
         self._Ds_edge = d_edge
 
-        self._CADT_lib = {}
+        self._CADT_lib = LRUCache(CADT_CACHE_DEFAULT_SIZE)
+        self._automata = LRUCache(COMPILED_CACHE_DEFAULT_SIZE)
+        self._a_automata = LRUCache(COMPILED_CACHE_DEFAULT_SIZE)
+        self._batches = LRUCache(COMPILED_CACHE_DEFAULT_SIZE)
+
+    def set_cache_size(self, size: int, compiled_size: Optional[int] = None) -> None:
+        """
+        bound the number of classified words whose change locations are kept
+
+        :param compiled_size: when given, bound the number of phoneme inventories the rule keeps compiled automata and
+                              batches for
+        """
+        self._CADT_lib.set_max_size(size)
+
+        if compiled_size is not None:
+            self._automata.set_max_size(compiled_size)
+            self._a_automata.set_max_size(compiled_size)
+            self._batches.set_max_size(compiled_size)
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        return self._CADT_lib.get_stats()
+
+    def __getstate__(self) -> Dict[str, object]:
+        """
+        pickle the rule with its caches emptied, keeping their bounds; they are rebuilt on use
+        """
+        state = dict(self.__dict__)
+
+        for name in ("_CADT_lib", "_automata", "_a_automata", "_batches"):
+            state[name] = LRUCache(state[name].get_max_size())
+
+        return state
 
     def apply(self, word: Word, phonemes: List[Word], feature_to_type: Dict[str, str],
               feature_to_sounds: Dict[str, List[Sound]]) -> Word:
-        if word not in self._CADT_lib.keys():
-            if ExampleType.CADT not in self.classify(word, phonemes, feature_to_type, feature_to_sounds):
-                return word
-
-        indexes = list(set(self._CADT_lib[word]))
+        start = perf_counter() if instrument.ENABLED else None
         new_word = word
-        prev_len = len(new_word)
-        len_diff = 0
 
-        for index in indexes:
-            new_word = self._do_replace(new_word, index[0] + len_diff, index[1] + len_diff, feature_to_type,
-                                        feature_to_sounds)
-            new_len = len(new_word)
-            len_diff = new_len - prev_len
-            prev_len = new_len
+        # right to left, so that replacements changing the length do not move the locations still to be replaced
+        for begin, end, _ in reversed(self.get_changes(word, phonemes, feature_to_type, feature_to_sounds)):
+            new_word = self._do_replace(new_word, begin, end, feature_to_type, feature_to_sounds)
+
+        if start is not None:
+            elapsed = perf_counter() - start
+            instrument.record_time("rule.apply", elapsed)
+            instrument.record_time("rule.apply:" + self._name, elapsed)
 
         return new_word
 
+    def get_changes(self, word: Word, phonemes: List[Word], feature_to_type: Dict[str, str],
+                    feature_to_sounds: Dict[str, List[Sound]]) -> List[Tuple[int, int, Word]]:
+        """
+        :return: where applying the rule changes word, as (begin, end, replacement) sorted by location
+        """
+        key, automaton, replacements = self._get_automaton(phonemes, feature_to_type, feature_to_sounds)
+        locations = self._CADT_lib.get((key, word))
+
+        if locations is None:
+            locations = self._classify(word, automaton, replacements)[1]
+            self._CADT_lib.put((key, word), locations)
+            instrument.count("rule.cache.miss")
+        else:
+            instrument.count("rule.cache.hit")
+
+        return [(begin, end, replacements[word[begin:end]]) for begin, end in locations]
+
+    def get_footprint(self, phonemes: List[Word], feature_to_type: Dict[str, str],
+                      feature_to_sounds: Dict[str, List[Sound]]) -> Tuple[Set[int], Set[int], bool]:
+        """
+        :return: numbers of the sounds classification looks at, numbers of the sounds a change removes or writes, and
+                 whether every change keeps the length of the word
+        """
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        replacements = self._get_automaton(phonemes, feature_to_type, feature_to_sounds)[2]
+        read = set()  # type: Set[int]
+        written = set()  # type: Set[int]
+        keeps_length = True
+
+        c_contexts, d_contexts = self.get_contexts(phonemes, feature_to_sounds)
+
+        for context in c_contexts + d_contexts:
+            for sounds in [] if context is None else context:
+                read.update(sounds)
+
+        for a_pattern, replaced in replacements.items():
+            read.update(a_pattern.get_ids())
+
+            if isinstance(replaced, Exception):
+                written.update(a_pattern.get_ids())
+                keeps_length = False
+            elif replaced != a_pattern:
+                written.update(a_pattern.get_ids())
+                written.update(replaced.get_ids())
+                keeps_length = keeps_length and len(replaced) == len(a_pattern)
+
+        return read, written, keeps_length
+
     def classify(self, word: Word, phonemes: List[Word], feature_to_type: Dict[str, str],
                  feature_to_sounds: Dict[str, List[Sound]]) -> List[Dict[ExampleType, Word]]:
-        a_data = self.locations_a(word, phonemes, feature_to_sounds)
-        a_locations = list(a_data.keys())  # type: List[int]
+        start = perf_counter() if instrument.ENABLED else None
+        key, automaton, replacements = self._get_automaton(phonemes, feature_to_type, feature_to_sounds)
+        extypes_to_sounds, locations = self._classify(word, automaton, replacements)
+        self._CADT_lib.put((key, word), locations)
+
+        if start is not None:
+            elapsed = perf_counter() - start
+            instrument.record_time("rule.classify", elapsed)
+            instrument.record_time("rule.classify:" + self._name, elapsed)
+
+        return extypes_to_sounds
+
+    def classify_many(self, ids: np.ndarray, lengths: np.ndarray, phonemes: List[Word], feature_to_type: Dict[str, str],
+                      feature_to_sounds: Dict[str, List[Sound]]) -> np.ndarray:
+        """
+        Classify a batch of words at once. Needs numpy.
+
+        :param ids: sound numbers of one word per row, padded to the longest word (see batch.to_id_matrix)
+        :param lengths: length of each word
+        :return: per word and C/D alternative, the example types classify would report as an OR of the bits in
+                 EXAMPLE_TYPE_BITS
+        """
+        return self._get_batch(phonemes, feature_to_type, feature_to_sounds).classify(ids, lengths)
+
+    def apply_many(self, ids: np.ndarray, lengths: np.ndarray, phonemes: List[Word], feature_to_type: Dict[str, str],
+                   feature_to_sounds: Dict[str, List[Sound]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Apply the rule to a batch of words given as for classify_many. Needs numpy.
+
+        :return: the sound numbers of the surface forms, padded like ids, and their lengths
+        """
+        return self._get_batch(phonemes, feature_to_type, feature_to_sounds).apply(ids, lengths)
+
+    def _get_batch(self, phonemes: List[Word], feature_to_type: Dict[str, str],
+                   feature_to_sounds: Dict[str, List[Sound]]) -> RuleBatch:
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        key, _, replacements = self._get_automaton(phonemes, feature_to_type, feature_to_sounds)
+        batch = self._batches.get(key)
+
+        if batch is None:
+            a_matcher = self._get_a_automaton(phonemes, feature_to_sounds)[1]
+            c_contexts, d_contexts = self.get_contexts(phonemes, feature_to_sounds)
+            batch = RuleBatch(feature_to_sounds.get_full_mask().bit_length() + 1, a_matcher, replacements, c_contexts,
+                              self._Cs_edge, d_contexts, self._Ds_edge)
+            self._batches.put(key, batch)
+
+        return batch
+
+    def _classify(self, word: Word, automaton: RuleAutomaton, replacements: Dict[Word, object]) -> Tuple[
+        List[Dict[ExampleType, Word]], Tuple[Tuple[int, int], ...]]:
+        """
+        :return: example types per C/D alternative, and the sorted distinct locations the rule changes
+        """
+        a_sites, c_ends, d_starts = automaton.scan(word)
+
+        if len(a_sites) == 0:
+            return [{ExampleType.IRR: Word([])} for _ in range(0, len(self._Cs))], ()
+
+        word_len = len(word)
+        extypes_to_sounds = [{} for _ in range(0, len(self._Cs))]  # type: List[Dict[ExampleType, Word]]
+        locations = set()
 
-        if len(a_locations) == 0 or a_locations == []:
-            return [{ExampleType.IRR: Word([Sound(-1, '', [])])} for _ in range(0, len(self._Cs))]
-        else:
-            extypes_to_sounds = [{} for _ in range(0, len(self._Cs))]  # type: List[Dict[ExampleType, Word]]
-
-            for i in range(0, len(self._Cs)):
-                c_instance = self._Cs[i]
-                d_instance = self._Ds[i]
-                c_matcher = None
-                c_size = None
-                c_edge = self._Cs_edge[i]
-                d_edge = self._Ds_edge[i]
-                d_matcher = None
-                d_size = None
-
-                if c_instance is not None:
-                    c_matcher = self._get_c_matcher(c_instance, phonemes, None, feature_to_sounds)
-
-                    if len(c_matcher) == 0 or c_matcher == []:
-                        continue
-
-                    c_size = len(c_matcher[0])
-
-                if d_instance is not None:
-                    d_matcher = self._get_d_matcher(d_instance, phonemes, None, feature_to_sounds)
-
-                    if len(d_matcher) == 0 or c_matcher == []:
-                        continue
-
-                    d_size = len(d_matcher[0])
-
-                for a_loc in a_locations:
-                    a_size = len(a_data[a_loc])
-
-                    is_c = False
-
-                    if c_edge and c_instance is None:
-                        is_c = a_loc == 0
-                    elif not c_edge and c_instance is None:
-                        is_c = True
-                    else:
-                        if not c_edge or a_loc - c_size == 0:
-
-                            for c_pattern in c_matcher:
-                                if a_loc - c_size >= 0 and Word(word[a_loc - c_size:a_loc]) == c_pattern:
-                                    is_c = True
-                                    break
-
-                    is_d = False
-
-                    if d_edge and d_instance is None:
-                        is_d = a_loc + a_size == len(word)
-                    elif not d_edge and d_instance is None:
-                        is_d = True
-                    else:
-                        if not d_edge or a_loc + a_size + d_size == len(word):
-
-                            for d_pattern in d_matcher:
-                                if a_loc + a_size < len(word) and word[
-                                                                  a_loc + a_size:a_loc + a_size + d_size] == d_pattern:
-                                    is_d = True
-                                    break
-
-                    a_word = word[a_loc]
-                    if is_c and is_d:
-                        if word != self._do_replace(word, a_loc, a_loc + a_size, feature_to_type, feature_to_sounds):
-                            extypes_to_sounds[i] = {ExampleType.CADT: a_word}
-                            location = (a_loc, a_loc + a_size)
-
-                            # if True not in [location in val for val in self._CADT_lib.values()]:
-                            if word in self._CADT_lib:
-                                self._CADT_lib[word].append(location)
-                            else:
-                                self._CADT_lib[word] = [location]
-                        elif ExampleType.CADT not in extypes_to_sounds[i]:
-                            extypes_to_sounds[i] = {ExampleType.CADNT: a_word}
-
-                    elif ExampleType.CADT not in extypes_to_sounds[i] and ExampleType.CADNT not in extypes_to_sounds[i]:
-                        if is_c and not is_d:
-                            extypes_to_sounds[i][ExampleType.CAND] = a_word
-                        if not is_c and is_d:
-                            extypes_to_sounds[i][ExampleType.NCAD] = a_word
-
-            return extypes_to_sounds
-
-    def _get_c_matcher(self, c_instance: Optional[List[Particle], None], phonemes: Optional[List[Sound], None],
-                       size_limit: Optional[int, None], feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
-        return Template(c_instance).generate_word_list(phonemes, size_limit, feature_to_sounds, None)
-
-    def _get_d_matcher(self, d_instance: Optional[List[Particle], None], phonemes: Optional[List[Sound], None],
-                       size_limit: Optional[int, None], feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
-        return Template(d_instance).generate_word_list(phonemes, size_limit, feature_to_sounds, None)
+        for i in range(0, len(self._Cs)):
+            c_instance = self._Cs[i]
+            d_instance = self._Ds[i]
+            c_edge = self._Cs_edge[i]
+            d_edge = self._Ds_edge[i]
+            c_size = 0 if c_instance is None else len(c_instance)
+            d_size = 0 if d_instance is None else len(d_instance)
+
+            if automaton.is_dead(i):
+                continue
+
+            for a_loc, a_size, a_pattern in a_sites:
+                if c_instance is None:
+                    is_c = not c_edge or a_loc == 0
+                else:
+                    is_c = a_loc >= c_size and (c_ends[i] >> (a_loc - 1)) & 1 == 1 and (
+                            not c_edge or a_loc == c_size)
+
+                d_loc = a_loc + a_size
+
+                if d_instance is None:
+                    is_d = not d_edge or d_loc == word_len
+                else:
+                    is_d = (d_starts[i] >> d_loc) & 1 == 1 and (not d_edge or d_loc + d_size == word_len)
+
+                a_word = word[a_loc]
+
+                if is_c and is_d:
+                    replaced = replacements[a_pattern]
+
+                    if isinstance(replaced, Exception):
+                        raise type(replaced)(*replaced.args)
+
+                    if replaced != a_pattern:
+                        extypes_to_sounds[i] = {ExampleType.CADT: a_word}
+                        locations.add((a_loc, a_loc + a_size))
+                    elif ExampleType.CADT not in extypes_to_sounds[i]:
+                        extypes_to_sounds[i] = {ExampleType.CADNT: a_word}
+
+                elif ExampleType.CADT not in extypes_to_sounds[i] and ExampleType.CADNT not in extypes_to_sounds[i]:
+                    if is_c and not is_d:
+                        extypes_to_sounds[i][ExampleType.CAND] = a_word
+                    if not is_c and is_d:
+                        extypes_to_sounds[i][ExampleType.NCAD] = a_word
+
+        return extypes_to_sounds, tuple(sorted(locations))
+
+    def _get_automaton(self, phonemes: List[Word], feature_to_type: Dict[str, str],
+                       feature_to_sounds: Dict[str, List[Sound]]) -> Tuple[
+        Tuple[Inventory, int], RuleAutomaton, Dict[Word, object]]:
+        """
+        The rule compiled for this phoneme inventory, built on first use, with its key and for every A pattern the word
+        replacing it, or a copy of the error replacing it raises. The copy is never raised itself, so it holds no
+        traceback; raise a new one of its type and arguments instead.
+        """
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        key, a_matcher, a_automaton = self._get_a_automaton(phonemes, feature_to_sounds)
+        compiled = self._automata.get(key)
+
+        if compiled is None:
+            c_contexts, d_contexts = self.get_contexts(phonemes, feature_to_sounds)
+            replacements = {}  # type: Dict[Word, object]
+
+            for a_pattern in a_matcher:
+                try:
+                    replacements[a_pattern] = self._do_replace(a_pattern, 0, len(a_pattern), feature_to_type,
+                                                               feature_to_sounds)
+                except (NotImplementedError, ValueError, KeyError) as e:
+                    replacements[a_pattern] = type(e)(*e.args)
+
+            compiled = (RuleAutomaton(a_automaton, c_contexts, d_contexts), replacements)
+            self._automata.put(key, compiled)
+
+        return (key,) + compiled
+
+    def _get_a_automaton(self, phonemes: Optional[List[Word]], feature_to_sounds: FeatureSoundMap) -> Tuple[
+        Tuple[Inventory, int], List[Word], PatternAutomaton]:
+        """
+        The A patterns for this phoneme inventory and their compiled search automaton, built on first use, with their
+        key.
+        """
+        phoneme_mask = -1 if phonemes is None else feature_to_sounds.get_phoneme_mask(phonemes)
+        key = (feature_to_sounds.get_inventory(), phoneme_mask)
+
+        compiled = self._a_automata.get(key)
+
+        if compiled is None:
+            a_matcher = self._build_a_matcher(phonemes, None, feature_to_sounds)
+            compiled = (a_matcher, PatternAutomaton(a_matcher))
+            self._a_automata.put(key, compiled)
+
+        return (key,) + compiled
+
+    def get_contexts(self, phonemes: Optional[List[Word]], feature_to_sounds: Dict[str, List[Sound]]) -> Tuple[
+        List[Optional[List[Set[int]]]], List[Optional[List[Set[int]]]]]:
+        """
+        :return: per C/D alternative, the numbers of the sounds each position of C matches (None without C), and the
+                 same for D
+        """
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        return [_get_context(c, phonemes, feature_to_sounds) for c in self._Cs], \
+               [_get_context(d, phonemes, feature_to_sounds) for d in self._Ds]
+
+    def get_edges(self) -> Tuple[List[bool], List[bool]]:
+        """
+        :return: per C/D alternative, whether C is anchored at the word start, and whether D is anchored at the word end
+        """
+        return [e for e in self._Cs_edge], [e for e in self._Ds_edge]
+
+    def get_replacements(self, phonemes: List[Word], feature_to_type: Dict[str, str],
+                         feature_to_sounds: Dict[str, List[Sound]]) -> Dict[Word, object]:
+        """
+        :return: every A pattern with the word replacing it, or with the error raised replacing it
+        """
+        return dict(self._get_automaton(phonemes, feature_to_type, feature_to_sounds)[2])
 
     def get_interest_phones(self, phonemes: List[Word], feature_to_type: Dict[str, str],
                             feature_to_sounds: Dict[str, List[Sound]]) -> Tuple[Dict[str, str], List[str]]:
         a_matcher = self.get_a_matcher(phonemes, None, feature_to_sounds)
         result = {}
-        all_phones = set([])
+        all_phones = {}  # type: Dict[str, int]
 
         if len(a_matcher) == 0:
             raise ValueError("No matching A found in the phonemes!")
 
-        print([str(w) for w in a_matcher])
+        if instrument.has_listeners():
+            instrument.event("rule.interest", {"rule": self._name, "a": [str(w) for w in a_matcher]})
+
         for a_word in a_matcher:
             if len(a_word) != 1:
                 raise NotImplementedError("Currently only support A of size 1")
 
             b_word = self._do_replace(a_word, 0, 1, feature_to_type, feature_to_sounds)
-            all_phones.add(str(a_word))
-            all_phones.add(str(b_word))
+            all_phones[str(a_word)] = a_word.get_ids()[0]
+            all_phones[str(b_word)] = b_word.get_ids()[0] if len(b_word) > 0 else 0
             result[str(a_word)] = str(b_word)
 
-        all_phones = list(all_phones)
-        all_phones.sort(key=lambda x: Sound(-1, '', [])[x].get_num())
-        return result, all_phones
+        return result, sorted(all_phones, key=lambda x: all_phones[x])
 
     def locations_a(self, word: Word, phonemes: List[Word], feature_to_sounds: Dict[str, List[Sound]]) -> Dict[
         int, Word]:
@@ -210,41 +388,37 @@ class Rule:
                 dict_[i] = word[i]
             return dict_
 
-        a_matcher = self.get_a_matcher(phonemes, None, feature_to_sounds)  # type:List[Word]
-        prev_index = 0  # type: int
-        result = {}  # type: Dict[int, Word]
-        i = 0
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
 
-        while i < len(a_matcher):
-            a_pattern = a_matcher[i]
-            a_index = word.index(a_pattern, prev_index)
+        a_automaton = self._get_a_automaton(phonemes, feature_to_sounds)[2]
 
-            if a_index < 0:
-                i += 1
-                prev_index = 0
-                continue
-            else:
-                prev_index = a_index + 1
-                result[a_index] = a_pattern
-                i -= 1
+        return {loc: pattern for loc, _, pattern in a_automaton.find(word)}
+
+    def get_a_matcher(self, phonemes: List[Word], size_limit: Optional[int],
+                      feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
 
-            i += 1
+        if size_limit is None:
+            return list(self._get_a_automaton(phonemes, feature_to_sounds)[1])
 
-        return result
+        return self._build_a_matcher(phonemes, size_limit, feature_to_sounds)
 
-    def get_a_matcher(self, phonemes: List[Word], size_limit: Optional[int, None],
-                      feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
+    def _build_a_matcher(self, phonemes: Optional[List[Word]], size_limit: Optional[int],
+                         feature_to_sounds: FeatureSoundMap) -> List[Word]:
+        """
+        the A patterns of every &-joined alternative, in order
+        """
         a_matcher = []  # type: List[Word]
+
         for sec in self._As:
-            words = Template(sec).generate_word_list(phonemes, size_limit, feature_to_sounds, None)
-            a_matcher.extend(words)
-            print([str(s) for s in words])
+            a_matcher.extend(Template(sec).generate_word_list(phonemes, size_limit, feature_to_sounds, None))
+
         return a_matcher
 
     def _do_replace(self, word: Word, begin_index: int, end_index: int, feature_to_type: Dict[str, str],
                     feature_to_sounds: Dict[str, List[Sound]]) -> Word:
-        target = str(word[begin_index:end_index])
-
         if end_index - begin_index != 1:
             raise NotImplementedError(
                 "begin %d end %d type like this has not been implemented yet" % (begin_index, end_index))
@@ -252,16 +426,33 @@ class Rule:
         if self._B is None:
             return word.change_word(begin_index, None)
         else:
-            dest_particle = self._B[0]
-            ignored_types = self._B[1]
+            dest_sound = self._get_transformations(feature_to_type, feature_to_sounds).get(
+                word.get_sounds()[begin_index])
 
-            dest_sound = Sound(-1, '', [])[target].get_transformed_sound(dest_particle, ignored_types, feature_to_type,
-                                                                         feature_to_sounds)
             if dest_sound is not None:
                 return word.change_word(begin_index, Word([dest_sound]))
 
         return word
 
+    def _get_transformations(self, feature_to_type: Dict[str, str],
+                             feature_to_sounds: Dict[str, List[Sound]]) -> TransformationTable:
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        return feature_to_sounds.get_transformations(self._B[0], self._B[1], feature_to_type)
+
+    def build_transformations(self, feature_to_type: Dict[str, str],
+                              feature_to_sounds: Dict[str, List[Sound]]) -> Dict[Sound, ValueError]:
+        """
+        Build the B transformation table for the whole inventory ahead of any classification.
+
+        :return: source sounds whose transformation is ambiguous, with the error raised when one is replaced
+        """
+        if self._B is None:
+            return {}
+
+        return self._get_transformations(feature_to_type, feature_to_sounds).get_errors()
+
     def get_name(self) -> str:
         return self._name
 
@@ -317,22 +508,59 @@ class Rule:
 
 class PredefinedRule(Rule):
     def __init__(self, name: str, family: RuleFamily, a_to_b: Dict[Word, Word],
-                 c: List[Optional[List[Particle], None]], c_edge: List[bool], d: List[Optional[List[Particle], None]],
+                 c: List[Optional[List[Particle]]], c_edge: List[bool], d: List[Optional[List[Particle]]],
                  d_edge: List[bool]) -> None:
         Rule.__init__(self, name, family, [], None, c, c_edge, d, d_edge)
 
         self._AtoB = a_to_b
+        self._AtoB_words = {}
+
+    def __getstate__(self) -> Dict[str, object]:
+        state = Rule.__getstate__(self)
+        state["_AtoB_words"] = {}
+
+        return state
+
+    def _get_a_to_b(self, inventory: Inventory) -> Dict[Word, str]:
+        """
+        a_to_b with its keys tokenized in inventory; values are kept as given and turned into words when used
+        """
+        if inventory not in self._AtoB_words:
+            self._AtoB_words[inventory] = {Word(a, inventory): b for a, b in self._AtoB.items()}
+
+        return self._AtoB_words[inventory]
 
     def _do_replace(self, word: Word, begin_index: int, end_index: int, feature_to_type: Dict[str, str],
                     feature_to_sounds: Dict[str, List[Sound]]) -> Word:
         if end_index - begin_index != 1:
             raise NotImplementedError(
                 "begin %d end %d type like this has not been implemented yet" % (begin_index, end_index))
-        return word.change_word(begin_index, self._AtoB[Word(word[begin_index:end_index])])
+        inventory = word.get_inventory()
+        target = self._get_a_to_b(inventory)[word[begin_index:end_index]]
 
-    def get_a_matcher(self, phonemes: List[Word], size_limit: Optional[int, None],
-                      feature_to_sounds: Dict[str, List[Sound]]) -> List[Word]:
-        return list(self._AtoB.keys())
+        return word.change_word(begin_index, Word(target, inventory))
+
+    def _build_a_matcher(self, phonemes: Optional[List[Word]], size_limit: Optional[int],
+                         feature_to_sounds: FeatureSoundMap) -> List[Word]:
+        return list(self._get_a_to_b(feature_to_sounds.get_inventory()).keys())
+
+    def build_transformations(self, feature_to_type: Dict[str, str],
+                              feature_to_sounds: Dict[str, List[Sound]]) -> Dict[Sound, ValueError]:
+        return {}
+
+    def get_symbol_errors(self, inventory: Inventory) -> List[ValueError]:
+        """
+        :return: the errors raised reading the symbols of a_to_b in inventory, which classify would raise otherwise
+        """
+        errors = []  # type: List[ValueError]
+
+        for symbol in list(self._AtoB.keys()) + list(self._AtoB.values()):
+            try:
+                Word(symbol, inventory)
+            except ValueError as e:
+                errors.append(e)
+
+        return errors
 
     def get_content_str(self) -> str:
         ab_str = ''
@@ -371,11 +599,79 @@ class RuleFamily:
         return "%s : %s" % (self._name, str([r.get_name() for r in self._rules]))
 
 
-def import_default_rules(feature_pool: List[str]) -> Tuple[List[RuleFamily], List[Rule]]:
-    return _fetch_rule_and_family_csv(feature_pool, "defaultrules.csv")
+def _get_context(instance: Optional[List[Particle]], phonemes: Optional[List[Word]],
+                 feature_to_sounds: FeatureSoundMap) -> Optional[List[Set[int]]]:
+    """
+    The numbers of the sounds each position of a C or D context matches, None when there is no context. A word matches
+    the context when every one of its sounds is in the set at its position.
+    """
+    if instance is None:
+        return None
+
+    phoneme_mask = -1 if phonemes is None else feature_to_sounds.get_phoneme_mask(phonemes)
+
+    return [set(s.get_num() for s in feature_to_sounds.get_sounds(feature_to_sounds.get_particle_mask(particle) &
+                                                                   phoneme_mask)) for particle in instance]
+
+
+def import_default_rules(feature_pool: List[str], feature_to_type: Optional[Dict[str, str]] = None,
+                         feature_to_sounds: Optional[Dict[str, List[Sound]]] = None) -> Tuple[
+    List[RuleFamily], List[Rule]]:
+    from bundle import load_default_bundle
+
+    bundle = load_default_bundle()
+
+    if bundle is not None and bundle["features"][0] == feature_pool and (
+            feature_to_sounds is None or feature_to_sounds is bundle["features"][4]):
+        for message in bundle["rule_warnings"]:
+            warnings.warn(message)
+
+        return bundle["rules"]
+
+    return _fetch_rule_and_family_csv(feature_pool, "defaultrules.csv", feature_to_type, feature_to_sounds)
+
+
+def _fetch_rule_and_family_csv(feature_pool: List[str], filename: str,
+                               feature_to_type: Optional[Dict[str, str]] = None,
+                               feature_to_sounds: Optional[Dict[str, List[Sound]]] = None) -> Tuple[
+    List[RuleFamily], List[Rule]]:
+    """
+    When feature_to_type and feature_to_sounds are given, every rule's B transformation table is built here and the
+    problems _get_rule_warnings finds are reported as warnings instead of surfacing in the middle of generation.
+    """
+    rule_data = _read_rule_csv(feature_pool, filename)
+
+    if feature_to_type is not None and feature_to_sounds is not None:
+        for message in _get_rule_warnings(rule_data[1], feature_to_type, feature_to_sounds):
+            warnings.warn(message)
+
+    return rule_data
+
+
+def _get_rule_warnings(rules: List[Rule], feature_to_type: Dict[str, str],
+                       feature_to_sounds: Dict[str, List[Sound]]) -> List[str]:
+    """
+    Build every rule's B transformation table over the inventory of feature_to_sounds.
+
+    :return: one message per ambiguous transformation and per predefined symbol the inventory lacks
+    """
+    if not isinstance(feature_to_sounds, FeatureSoundMap):
+        feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+    messages = []  # type: List[str]
+
+    for rule in rules:
+        for source, error in rule.build_transformations(feature_to_type, feature_to_sounds).items():
+            messages.append("Rule \"%s\" can not transform %s: %s" % (rule.get_name(), str(source), str(error)))
+
+        if isinstance(rule, PredefinedRule):
+            for error in rule.get_symbol_errors(feature_to_sounds.get_inventory()):
+                messages.append("Rule \"%s\" can not be applied: %s" % (rule.get_name(), str(error)))
+
+    return messages
 
 
-def _fetch_rule_and_family_csv(feature_pool: List[str], filename: str) -> Tuple[List[RuleFamily], List[Rule]]:
+def _read_rule_csv(feature_pool: List[str], filename: str) -> Tuple[List[RuleFamily], List[Rule]]:
     import ast
     rules = []  # type: List[Rule]
     families = {}  # type: Dict[str, RuleFamily]
@@ -471,10 +767,10 @@ def _interpret_a(a_str: str, feature_pool: List[str]) -> List[List[Particle]]:
 
 
 def _interpret_cd(cd_str: str, feature_pool: List[str]) -> Tuple[
-    List[Optional[List[Particle], None]], List[bool], List[Optional[List[Particle], None]], List[bool]]:
+    List[Optional[List[Particle]]], List[bool], List[Optional[List[Particle]]], List[bool]]:
     conditions = cd_str.split("&")
-    c_list = []  # type: List[Optional[List[Particle], None]]
-    d_list = []  # type: List[Optional[List[Particle], None]]
+    c_list = []  # type: List[Optional[List[Particle]]]
+    d_list = []  # type: List[Optional[List[Particle]]]
     c_edge = []  # type: List[bool]
     d_edge = []  # type: List[bool]
 
@@ -505,7 +801,7 @@ def _interpret_cd(cd_str: str, feature_pool: List[str]) -> Tuple[
     return c_list, c_edge, d_list, d_edge
 
 
-def _sec_to_particles(feature_pool: List[str], sec: str) -> Optional[List[Particle], None]:
+def _sec_to_particles(feature_pool: List[str], sec: str) -> Optional[List[Particle]]:
     particles = []  # type: List[Particle]
 
     parts = sec.lstrip('[').rstrip(']').split("][")
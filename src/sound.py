@@ -1,25 +1,21 @@
 from __future__ import annotations
 
-from typing import List, Dict, Any, Optional
-
-_SYMBOL = {}  # type: Dict[str, Sound]
+from typing import List, Dict, Any, Optional, Tuple
 
 
 class Sound:
     _num: int
+    _mask: int
     _features: List[str]
     _symbol: str
+    _inventory: Any
 
     def __init__(self, num: int, symbol: str, features: List[str]) -> None:
         self._num = num
+        self._mask = 1 << (num - 1) if num >= 1 else 0
         self._features = features
         self._symbol = symbol
-
-        if symbol in _SYMBOL.keys():
-            raise ValueError("Duplicated symbol not allowed!")
-
-        if num >= 1 and symbol != '':
-            _SYMBOL[symbol] = self
+        self._inventory = None
 
     def get_features(self) -> List[str]:
         return [f for f in self._features]
@@ -27,68 +23,41 @@ class Sound:
     def get_symbol(self) -> str:
         return self._symbol
 
+    def get_inventory(self) -> Any:
+        """
+        the Inventory this sound was added to, None for placeholder sounds
+        """
+        return self._inventory
+
+    def set_inventory(self, inventory: Any) -> None:
+        self._inventory = inventory
+
     def get_transformed_sound(self, target_particle: Any, ignored_types: List[str], feature_to_type: Dict[str, str],
-                              feature_to_sounds: Dict[str, List[Sound]]) -> Optional[Sound, None]:
-        from feature_lib import Particle
+                              feature_to_sounds: Dict[str, List[Sound]]) -> Optional[Sound]:
+        from feature_lib import Particle, FeatureSoundMap
 
         if not isinstance(target_particle, Particle):
             raise AttributeError("target particle must be a Particle")
 
-        specified_types = [feature_to_type[f] for f in target_particle.get_features()]
-
-        loose_match = []  # type: List[Sound]
-        tight_match = []  # type: List[Sound]
-
-        for sound in target_particle.get_matching_sounds(None, feature_to_sounds):
-            target_features = sound.get_features()
-            passed = True
-            is_loose = False
-
-            for i in range(0, len(self._features)):
-                target_feature = target_features[i]
-                this_feature = self._features[i]
-
-                target_type = feature_to_type[target_feature]
-
-                if target_type not in specified_types and target_type not in ignored_types:
-                    if target_feature != this_feature:
-                        if target_feature == 'NA' or this_feature == 'NA':
-                            is_loose = True
-                        else:
-                            passed = False
-                            break
-
-            if passed:
-                if is_loose:
-                    loose_match.append(sound)
-                else:
-                    tight_match.append(sound)
-
-        if len(loose_match) == 0 and len(tight_match) == 0:
-            return None
-
-        if len(tight_match) > 1:
-            raise ValueError("multiple tight matches!! %s" % [str(s) for s in tight_match])
-
-        if len(tight_match) == 1:
-            return tight_match[0]
-
-        if len(loose_match) > 1:
-            raise ValueError("multiple loose matches found %s" % [str(s) for s in loose_match])
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
 
-        if len(loose_match) == 1:
-            return loose_match[0]
-
-        raise EOFError("cant reach this line")
+        return feature_to_sounds.get_transformations(target_particle, ignored_types, feature_to_type).get(self)
 
     def get_num(self) -> int:
         return self._num
 
+    def get_mask(self) -> int:
+        """
+        single bit at position num - 1, 0 for placeholder sounds
+        """
+        return self._mask
+
     def __hash__(self) -> int:
         return self._num
 
-    def __getitem__(self, item: str) -> Sound:
-        return _SYMBOL[item]
+    def __reduce__(self) -> Tuple[type, Tuple[int, str, List[str]]]:
+        return Sound, (self._num, self._symbol, self._features)
 
     def __str__(self) -> str:
         return self._symbol
@@ -110,3 +79,78 @@ class Sound:
 
     def __ge__(self, other: Sound) -> bool:
         return self._num >= other.get_num()
+
+
+class TransformationTable:
+    """
+    source sound -> transformed sound for one (target particle, ignored types) pair, over a whole inventory.
+
+    A candidate is a tight match when it agrees with the source on every feature whose type is neither specified by the
+    target particle nor ignored, and a loose match when the only disagreements involve NA. A unique tight match wins,
+    then a unique loose match. Sources with several matches of the deciding kind are recorded in errors, by message, and
+    raise a new ValueError on every lookup.
+    """
+    _targets: Dict[Sound, Optional[Sound]]
+    _errors: Dict[Sound, str]
+
+    def __init__(self, target_particle: Any, ignored_types: List[str], feature_to_type: Dict[str, str],
+                 feature_to_sounds: Any) -> None:
+        self._targets = {}
+        self._errors = {}
+
+        specified_types = set(feature_to_type[f] for f in target_particle.get_features())
+        candidates = []  # type: List[Tuple[Sound, List[Tuple[int, str]]]]
+
+        for sound in target_particle.get_matching_sounds(None, feature_to_sounds):
+            compared = []  # type: List[Tuple[int, str]]
+
+            for i, feature in enumerate(sound.get_features()):
+                type_ = feature_to_type[feature]
+
+                if type_ not in specified_types and type_ not in ignored_types:
+                    compared.append((i, feature))
+
+            candidates.append((sound, compared))
+
+        for source in feature_to_sounds.get_sounds(feature_to_sounds.get_full_mask()):
+            source_features = source.get_features()
+            loose_match = []  # type: List[Sound]
+            tight_match = []  # type: List[Sound]
+
+            for sound, compared in candidates:
+                passed = True
+                is_loose = False
+
+                for i, feature in compared:
+                    if feature != source_features[i]:
+                        if feature == 'NA' or source_features[i] == 'NA':
+                            is_loose = True
+                        else:
+                            passed = False
+                            break
+
+                if passed:
+                    if is_loose:
+                        loose_match.append(sound)
+                    else:
+                        tight_match.append(sound)
+
+            if len(tight_match) > 1:
+                self._errors[source] = "multiple tight matches!! %s" % [str(s) for s in tight_match]
+            elif len(tight_match) == 1:
+                self._targets[source] = tight_match[0]
+            elif len(loose_match) > 1:
+                self._errors[source] = "multiple loose matches found %s" % [str(s) for s in loose_match]
+            elif len(loose_match) == 1:
+                self._targets[source] = loose_match[0]
+            else:
+                self._targets[source] = None
+
+    def get(self, source: Sound) -> Optional[Sound]:
+        if source in self._errors:
+            raise ValueError(self._errors[source])
+
+        return self._targets[source]
+
+    def get_errors(self) -> Dict[Sound, ValueError]:
+        return {source: ValueError(message) for source, message in self._errors.items()}
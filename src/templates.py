@@ -1,26 +1,51 @@
 from __future__ import annotations
 
 import random
-from typing import List, Dict, Optional
+from itertools import product, combinations
+from time import perf_counter
+from typing import List, Dict, Optional, Set, Iterator, Tuple
 
 from word import Word
 import warnings
+import instrument
 
-from feature_lib import Particle
+from feature_lib import Particle, FeatureSoundMap
 from sound import Sound
+from phonotactics import Phonotactics
 
 
 class Template:
     _size: int
     _components: List[Particle]
+    _phonotactics: Optional[Phonotactics]
 
-    def __init__(self, components: List[Particle]) -> None:
+    def __init__(self, components: List[Particle], phonotactics: Optional[Phonotactics] = None) -> None:
         self._components = components
         self._size = len(components)
-
-    def generate_word_list(self, phonemes: Optional[List[Word], None], size_limit: Optional[int, None],
-                           feature_to_sounds: Dict[str, List[Sound]], target_phoneme: Optional[List[Word], None]) -> \
-            List[Word]:
+        self._phonotactics = phonotactics
+
+    def generate_word_list(self, phonemes: Optional[List[Word]], size_limit: Optional[int],
+                           feature_to_sounds: Dict[str, List[Sound]], target_phoneme: Optional[List[Word]],
+                           phonotactics: Optional[Phonotactics] = None) -> List[Word]:
+        """
+        :param phonotactics: constraints of the inventory, on top of the template's own; words breaking any are never
+                             produced
+        """
+        if not instrument.ENABLED:
+            return self._generate_word_list(phonemes, size_limit, feature_to_sounds, target_phoneme, phonotactics)
+
+        start = perf_counter()
+        words = self._generate_word_list(phonemes, size_limit, feature_to_sounds, target_phoneme, phonotactics)
+        elapsed = perf_counter() - start
+        instrument.record_time("template.sample", elapsed)
+        instrument.record_time("template.sample:" + str(self), elapsed)
+        instrument.observe("template.sample.words", len(words))
+
+        return words
+
+    def _generate_word_list(self, phonemes: Optional[List[Word]], size_limit: Optional[int],
+                            feature_to_sounds: Dict[str, List[Sound]], target_phoneme: Optional[List[Word]],
+                            phonotactics: Optional[Phonotactics]) -> List[Word]:
         if size_limit is None:
             if target_phoneme is not None:
                 raise AttributeError("Not allowed to have target phoneme when not having a size limit")
@@ -30,7 +55,6 @@ class Template:
         part_sounds = []
         interest_sounds = []
         interest_indexes = []
-        word_list = set([])
 
         if word_len == 0:
             return []
@@ -46,67 +70,103 @@ class Template:
                 if interest_sound != [] and len(interest_sound) > 0:
                     interest_indexes.append(len(interest_sounds) - 1)
 
-        interest_total = len(interest_indexes)
-
         if size_limit is None:
-            result = self._recur_full_word_list(part_sounds, 0, [''])
+            return list(self.iter_words(phonemes, feature_to_sounds, 0, phonotactics))
+
+        combined = self._get_phonotactics(phonotactics)
+
+        if combined is not None:
+            if not isinstance(feature_to_sounds, FeatureSoundMap):
+                feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+            part_ids = [[s.get_num() for s in sounds] for sounds in part_sounds]
+            interest_sets = None if target_phoneme is None else [set(s.get_num() for s in i) for i in interest_sounds]
+            space = _WordSpace(part_ids, combined, feature_to_sounds, interest_sets)
+            inventory = feature_to_sounds.get_inventory()
 
-            return [Word(r) for r in result]
+            return [Word.from_ids(ids, inventory) for ids in space.sample(size_limit)]
+
+        radices = [len(p) for p in part_sounds]
+
+        if target_phoneme is None:
+            indexes = _sample_uniform(radices, size_limit)
         else:
-            word_count = 0
-            if target_phoneme is None:
-                while word_count < size_limit:
-                    curr_word = []  # type: List[Sound]
-
-                    for i in range(word_len):
-                        if part_sounds[i] == [] or len(part_sounds[i]) == 0:
-                            return []
-                        curr_word.append(random.choice(part_sounds[i]))
-
-                    word_list.add(Word(curr_word))
-                    word_count += 1
+            interest_digits = [[part_sounds[i].index(s) for s in interest_sounds[i]] for i in range(0, word_len)]
+            indexes = _sample_interest(radices, interest_digits, interest_indexes, size_limit)
+
+        return [Word([part_sounds[i][d] for i, d in enumerate(_to_digits(index, radices))]) for index in indexes]
+
+    def iter_ids(self, phonemes: Optional[List[Word]], feature_to_sounds: Dict[str, List[Sound]],
+                 start: int = 0, phonotactics: Optional[Phonotactics] = None) -> Iterator[Tuple[int, ...]]:
+        """
+        Every word of the template as a tuple of sound numbers, produced one at a time. The first slot changes fastest
+        and each slot runs through its sounds in loading order, so word i is always the same and enumeration can resume
+        from any start index. Under phonotactics the words breaking a constraint are skipped, keeping the numbering.
+        """
+        if len(self._components) == 0:
+            return
+
+        part_ids = [[s.get_num() for s in p.get_matching_sounds(phonemes, feature_to_sounds)] for p in self._components]
+        radices = [len(ids) for ids in part_ids]
+
+        if 0 in radices or start >= _product(radices):
+            return
+
+        digits = _to_digits(start, radices)
+        phonotactics = self._get_phonotactics(phonotactics)
+
+        if phonotactics is not None:
+            if not isinstance(feature_to_sounds, FeatureSoundMap):
+                feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+            yield from _WordSpace(part_ids, phonotactics, feature_to_sounds).iterate(digits)
+            return
+
+        current = [part_ids[i][digits[i]] for i in range(0, len(radices))]
+
+        while True:
+            yield tuple(current)
+            i = 0
+
+            while i < len(radices):
+                digits[i] += 1
+
+                if digits[i] < radices[i]:
+                    current[i] = part_ids[i][digits[i]]
+                    break
+
+                digits[i] = 0
+                current[i] = part_ids[i][0]
+                i += 1
             else:
-                while word_count < size_limit:
-                    interest_past = 0
-                    interest_added = 0
-                    possibility = 1.0 / interest_total
-
-                    curr_word = [Sound(-1, '', []) for _ in range(0, word_len)]  # type: List[Sound]
-                    unordered_index = [i for i in range(0, word_len)]
-                    random.shuffle(unordered_index)
-
-                    for i in unordered_index:
-                        if interest_added < 3 and i in interest_indexes:
-                            if random.random() < possibility or interest_added + interest_total - interest_past <= 1:
-                                curr_word[i] = random.choice(interest_sounds[i])
-                                interest_added += 1
-                            else:
-                                curr_word[i] = random.choice(part_sounds[i])
-
-                            interest_past += 1
-                        else:
-                            curr_word[i] = random.choice(part_sounds[i])
-
-                    word_list.add(Word(curr_word))
-                    word_count += 1
-
-            result = list(word_list)
-            return result
-
-    def _recur_full_word_list(self, comb_sound: List[List[Sound]], index: int, words: List[str]) -> List[str]:
-        if index >= len(comb_sound):
-            return words
-        else:
-            new_words = []  # type: List[str]
+                return
+
+    def iter_words(self, phonemes: Optional[List[Word]], feature_to_sounds: Dict[str, List[Sound]],
+                   start: int = 0, phonotactics: Optional[Phonotactics] = None) -> Iterator[Word]:
+        """
+        the words of iter_ids, as Words
+        """
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        inventory = feature_to_sounds.get_inventory()
+
+        for ids in self.iter_ids(phonemes, feature_to_sounds, start, phonotactics):
+            yield Word.from_ids(ids, inventory)
+
+    def get_word_list_size(self, phonemes: Optional[List[Word]], feature_to_sounds: Dict[str, List[Sound]],
+                           phonotactics: Optional[Phonotactics] = None) -> int:
+        combined = self._get_phonotactics(phonotactics)
+
+        if combined is not None and len(self._components) > 0:
+            if not isinstance(feature_to_sounds, FeatureSoundMap):
+                feature_to_sounds = FeatureSoundMap(feature_to_sounds)
 
-            for sound in comb_sound[index]:
-                for word in words:
-                    new_words.append(word + str(sound))
+            part_ids = [[s.get_num() for s in p.get_matching_sounds(phonemes, feature_to_sounds)]
+                        for p in self._components]
 
-            return self._recur_full_word_list(comb_sound, index + 1, new_words)
+            return _WordSpace(part_ids, combined, feature_to_sounds).count()
 
-    def get_word_list_size(self, phonemes: Optional[List[Word], None],
-                           feature_to_sounds: Dict[str, List[Sound]]) -> int:
         size = 1
         for particle in self._components:
             size *= len(particle.get_matching_sounds(phonemes, feature_to_sounds))
@@ -116,11 +176,406 @@ class Template:
     def get_components(self) -> List[Particle]:
         return [block for block in self._components]
 
+    def get_phonotactics(self) -> Optional[Phonotactics]:
+        return self._phonotactics
+
+    def allows(self, ids: List[int], feature_to_sounds: Dict[str, List[Sound]],
+               phonotactics: Optional[Phonotactics] = None) -> bool:
+        """
+        :return: whether the word with the sound numbers ids breaks none of the template's and of phonotactics'
+                 constraints
+        """
+        combined = self._get_phonotactics(phonotactics)
+
+        if combined is None:
+            return True
+
+        if not isinstance(feature_to_sounds, FeatureSoundMap):
+            feature_to_sounds = FeatureSoundMap(feature_to_sounds)
+
+        return combined.allows(ids, feature_to_sounds)
+
+    def _get_phonotactics(self, phonotactics: Optional[Phonotactics]) -> Optional[Phonotactics]:
+        if self._phonotactics is None:
+            return phonotactics
+
+        return self._phonotactics.union(phonotactics)
+
     def __str__(self) -> str:
         return "-".join([str(p) for p in self._components])
 
 
+class _WordSpace:
+    """
+    The words of a template keeping to phonotactics, and having an interest sound in some slot when interest sets are
+    given. Slots are filled from the last to the first, the order of iter_ids, and a partial word is dropped as soon
+    as a window starting at the slot just filled is banned. How many ways each partial word can be completed is
+    memoized, so words are drawn uniformly without rejection.
+
+    A partial word is only known by what later slots need: its first get_span() - 1 sounds and whether it has an
+    interest sound yet.
+
+    With interest sets, draw_interest weights words the way _draw_interest does without phonotactics: that draw gives
+    an interest sound on purpose to a set of one to three interest slots, as likely as any other set of its size, and
+    leaves every other slot free. A set is picked in proportion to its chance times the share of the words it allows
+    that keep to phonotactics, then a word is drawn uniformly among those, which is that draw kept to the words allowed.
+    """
+    _part_ids: List[List[int]]
+    _phonotactics: Phonotactics
+    _feature_to_sounds: FeatureSoundMap
+    _interest_sets: Optional[List[Set[int]]]
+    _counts: Dict[Tuple[int, Tuple[Tuple[int, ...], bool]], int]
+    _forced: Optional[List[Tuple[float, _WordSpace]]]
+
+    def __init__(self, part_ids: List[List[int]], phonotactics: Phonotactics, feature_to_sounds: FeatureSoundMap,
+                 interest_sets: Optional[List[Set[int]]] = None) -> None:
+        self._part_ids = part_ids
+        self._phonotactics = phonotactics
+        self._feature_to_sounds = feature_to_sounds
+        self._interest_sets = interest_sets
+        self._counts = {}
+        self._forced = None
+
+    def _next(self, j: int, num: int, state: Tuple[Tuple[int, ...], bool]) -> Optional[Tuple[Tuple[int, ...], bool]]:
+        following, has_interest = state
+        window = (num,) + following
+
+        if not self._phonotactics.allows_start(window, self._feature_to_sounds):
+            return None
+
+        return window[:self._phonotactics.get_span() - 1], \
+               has_interest or (self._interest_sets is not None and num in self._interest_sets[j])
+
+    def count(self, j: Optional[int] = None, state: Tuple[Tuple[int, ...], bool] = ((), False)) -> int:
+        """
+        :return: the number of ways to fill the slots before j, the slots from j on being summed up by state; the
+                 number of words when j is None
+        """
+        if j is None:
+            j = len(self._part_ids)
+
+        key = (j, state)
+
+        if key not in self._counts:
+            if j == 0:
+                self._counts[key] = 1 if self._interest_sets is None or state[1] else 0
+            else:
+                total = 0
+
+                for num in self._part_ids[j - 1]:
+                    next_state = self._next(j - 1, num, state)
+
+                    if next_state is not None:
+                        total += self.count(j - 1, next_state)
+
+                self._counts[key] = total
+
+        return self._counts[key]
+
+    def draw(self) -> Tuple[int, ...]:
+        j = len(self._part_ids)
+        state = ((), False)
+        ids = [0] * j
+
+        while j > 0:
+            pick = random.randrange(0, self.count(j, state))
+
+            for num in self._part_ids[j - 1]:
+                next_state = self._next(j - 1, num, state)
+
+                if next_state is None:
+                    continue
+
+                completions = self.count(j - 1, next_state)
+
+                if pick < completions:
+                    ids[j - 1] = num
+                    state = next_state
+                    break
+
+                pick -= completions
+
+            j -= 1
+
+        return tuple(ids)
+
+    def draw_interest(self) -> Tuple[int, ...]:
+        """
+        one word drawn with the interest weighting; there must be interest sets and a word having an interest sound
+        """
+        if self._forced is None:
+            self._forced = self._get_forced()
+
+        pick = random.random() * sum([w for w, _ in self._forced])
+
+        for weight, space in self._forced:
+            if pick < weight:
+                return space.draw()
+
+            pick -= weight
+
+        return [space for weight, space in self._forced if weight > 0][-1].draw()
+
+    def _get_forced(self) -> List[Tuple[float, _WordSpace]]:
+        """
+        for every set of interest slots _draw_interest can give interest sounds to, its weight and the words having
+        interest sounds there
+        """
+        slots = [j for j in range(0, len(self._part_ids))
+                 if len([n for n in self._part_ids[j] if n in self._interest_sets[j]]) > 0]
+        chances = _get_interest_chances(len(slots))
+        forced = []  # type: List[Tuple[float, _WordSpace]]
+
+        for size in range(1, len(chances)):
+            subsets = list(combinations(slots, size))
+
+            for subset in subsets:
+                part_ids = [[n for n in self._part_ids[j] if n in self._interest_sets[j]] if j in subset
+                            else self._part_ids[j] for j in range(0, len(self._part_ids))]
+                space = _WordSpace(part_ids, self._phonotactics, self._feature_to_sounds)
+                share = float(space.count())
+
+                for j in range(0, len(part_ids)):
+                    share /= len(part_ids[j])
+
+                forced.append((chances[size] / len(subsets) * share, space))
+
+        return forced
+
+    def iterate(self, digits: List[int]) -> Iterator[Tuple[int, ...]]:
+        """
+        the words in the order of iter_ids, starting from the one with digits
+        """
+        return self._walk(len(self._part_ids), ((), False), [0] * len(self._part_ids), digits, True)
+
+    def _walk(self, j: int, state: Tuple[Tuple[int, ...], bool], ids: List[int], digits: List[int],
+              bounded: bool) -> Iterator[Tuple[int, ...]]:
+        if j == 0:
+            yield tuple(ids)
+            return
+
+        first = digits[j - 1] if bounded else 0
+
+        for d in range(first, len(self._part_ids[j - 1])):
+            num = self._part_ids[j - 1][d]
+            next_state = self._next(j - 1, num, state)
+
+            if next_state is None or self.count(j - 1, next_state) == 0:
+                continue
+
+            ids[j - 1] = num
+            yield from self._walk(j - 1, next_state, ids, digits, bounded and d == first)
+
+    def sample(self, size_limit: int) -> List[Tuple[int, ...]]:
+        """
+        min(size_limit, number of words) distinct words. With interest sets they are drawn with the interest weighting
+        until new words get rare, like _sample_interest; the rest, or all of them without interest sets, are drawn
+        uniformly among the words not drawn yet.
+        """
+        total = self.count()
+        amount = min(size_limit, total)
+        chosen = {}  # type: Dict[Tuple[int, ...], None]
+
+        if self._interest_sets is not None:
+            duplicates = 0
+
+            while len(chosen) < amount and duplicates < amount:
+                ids = self.draw_interest()
+
+                if ids in chosen:
+                    duplicates += 1
+                else:
+                    chosen[ids] = None
+
+        missing = amount - len(chosen)
+
+        if missing > 0 and total - len(chosen) <= 2 * missing:
+            rest = [ids for ids in self.iterate([0] * len(self._part_ids)) if ids not in chosen]
+
+            for ids in random.sample(rest, missing):
+                chosen[ids] = None
+
+        while len(chosen) < amount:
+            chosen[self.draw()] = None
+
+        return list(chosen.keys())
+
+
+def _product(radices: List[int]) -> int:
+    total = 1
+
+    for radix in radices:
+        total *= radix
+
+    return total
+
+
+def _to_digits(index: int, radices: List[int]) -> List[int]:
+    """
+    index as mixed-radix digits, the first slot being the least significant
+    """
+    digits = [0] * len(radices)
+
+    for i in range(0, len(radices)):
+        index, digits[i] = divmod(index, radices[i])
+
+    return digits
+
+
+def _to_index(digits: List[int], radices: List[int]) -> int:
+    index = 0
+
+    for i in range(len(radices) - 1, -1, -1):
+        index = index * radices[i] + digits[i]
+
+    return index
+
+
+def _sample_uniform(radices: List[int], size_limit: int) -> List[int]:
+    """
+    min(size_limit, total) distinct word indexes drawn uniformly, without building the words that are not drawn
+    """
+    total = _product(radices)
+
+    return random.sample(range(0, total), min(size_limit, total))
+
+
+def _sample_interest(radices: List[int], interest_digits: List[List[int]], interest_indexes: List[int],
+                     size_limit: int) -> List[int]:
+    """
+    Distinct indexes of words having an interest sound in an interest slot, min(size_limit, number of such words) of
+    them. Words are drawn with the interest weighting until new words get rare; the rest are drawn uniformly among the
+    words not drawn yet, by enumerating the words with interest when there are few of them left and by rejection
+    otherwise.
+    """
+    total = 1
+    without_interest = 1
+
+    for i in range(0, len(radices)):
+        total *= radices[i]
+        without_interest *= radices[i] - len(interest_digits[i]) if i in interest_indexes else radices[i]
+
+    amount = min(size_limit, total - without_interest)
+    chosen = {}  # type: Dict[int, None]
+    duplicates = 0
+
+    while len(chosen) < amount and duplicates < amount:
+        index = _to_index(_draw_interest(radices, interest_digits, interest_indexes), radices)
+
+        if index in chosen:
+            duplicates += 1
+        else:
+            chosen[index] = None
+
+    missing = amount - len(chosen)
+
+    if missing > 0:
+        interest_sets = [set(d) for d in interest_digits]
+
+        if total - without_interest - len(chosen) <= 2 * missing:
+            rest = [i for i in _iter_interest(radices, interest_sets, interest_indexes) if i not in chosen]
+
+            for index in random.sample(rest, missing):
+                chosen[index] = None
+        else:
+            while len(chosen) < amount:
+                index = random.randrange(0, total)
+
+                if index not in chosen and _has_interest(_to_digits(index, radices), interest_sets, interest_indexes):
+                    chosen[index] = None
+
+    return list(chosen.keys())
+
+
+def _iter_interest(radices: List[int], interest_sets: List[Set[int]], interest_indexes: List[int]) -> Iterator[int]:
+    """
+    The index of every word having an interest sound in an interest slot, and of no other word. Each word is counted
+    under the first interest slot holding an interest sound: the interest slots before it take other sounds, those after
+    it and the other slots take any.
+    """
+    for position in range(0, len(interest_indexes)):
+        choices = [range(0, radix) for radix in radices]  # type: List[object]
+
+        for i in interest_indexes[:position]:
+            choices[i] = [d for d in range(0, radices[i]) if d not in interest_sets[i]]
+
+        choices[interest_indexes[position]] = sorted(interest_sets[interest_indexes[position]])
+
+        for digits in product(*choices):
+            yield _to_index(list(digits), radices)
+
+
+def _has_interest(digits: List[int], interest_sets: List[Set[int]], interest_indexes: List[int]) -> bool:
+    return True in [digits[i] in interest_sets[i] for i in interest_indexes]
+
+
+def _get_interest_chances(interest_total: int) -> List[float]:
+    """
+    :return: by k, the chance that _draw_interest gives an interest sound on purpose to exactly k of interest_total
+             interest slots
+    """
+    chances = [1.0] + [0.0] * min(3, interest_total)
+
+    for interest_past in range(0, interest_total):
+        following = [0.0] * len(chances)
+
+        for interest_added in range(0, len(chances)):
+            if interest_added >= 3:
+                following[interest_added] += chances[interest_added]
+                continue
+
+            if interest_added + interest_total - interest_past <= 1:
+                taken = 1.0
+            else:
+                taken = 1.0 / interest_total
+
+            if interest_added + 1 < len(chances):
+                following[interest_added + 1] += chances[interest_added] * taken
+
+            following[interest_added] += chances[interest_added] * (1 - taken)
+
+        chances = following
+
+    return chances
+
+
+def _draw_interest(radices: List[int], interest_digits: List[List[int]], interest_indexes: List[int]) -> List[int]:
+    """
+    one word as digits: up to three interest slots, and at least one, get an interest sound; any other slot gets any
+    of its sounds
+    """
+    interest_total = len(interest_indexes)
+    interest_past = 0
+    interest_added = 0
+    possibility = 1.0 / interest_total
+
+    digits = [0] * len(radices)
+    unordered_index = [i for i in range(0, len(radices))]
+    random.shuffle(unordered_index)
+
+    for i in unordered_index:
+        if interest_added < 3 and i in interest_indexes:
+            if random.random() < possibility or interest_added + interest_total - interest_past <= 1:
+                digits[i] = random.choice(interest_digits[i])
+                interest_added += 1
+            else:
+                digits[i] = random.randrange(0, radices[i])
+
+            interest_past += 1
+        else:
+            digits[i] = random.randrange(0, radices[i])
+
+    return digits
+
+
 def import_default_templates(feature_pool: List[str]) -> List[Template]:
+    from bundle import load_default_bundle
+
+    bundle = load_default_bundle()
+
+    if bundle is not None and bundle["features"][0] == feature_pool:
+        return bundle["templates"]
+
     return _fetch_templates("defaulttemplate.txt", feature_pool)
 
 
@@ -1,97 +1,184 @@
 from __future__ import annotations
-from typing import List, Optional
-from sound import Sound, _SYMBOL
 
+from array import array
+from typing import List, Optional, Tuple, Iterable, Union
 
-class Word:
-    _sounds: List[Sound]
-
-    def __init__(self, data: Optional[List[Sound], str]) -> None:
-        if type(data) == str:
-            sounds = []
-            i = 0
+from sound import Sound
+from inventory import Inventory, get_inventory, get_default_inventory
 
-            while i < len(data):
-                end_loc = -1
+_ID_SIZE = array('H').itemsize
 
-                for j in range(i + 1, len(data) + 1):
-                    if len(data[i:j]) > 0 and data[i:j] in _SYMBOL:
-                        end_loc = j
 
-                sounds.append(_SYMBOL[data[i:end_loc]])
-                i = end_loc
-
-            self._sounds = sounds
-
-        elif type(data) == list and len(data) > 0 and type(data[0]) == Sound:
-            self._sounds = data
+class Word:
+    """
+    Sequence of sounds of one Inventory, stored as their sound numbers packed as unsigned shorts in an immutable
+    buffer. Slices are views sharing their parent's buffer, so slicing, comparing and searching never copy sound
+    numbers. The hash and the string form are computed on first use.
+    """
+    __slots__ = ('_buf', '_begin', '_end', '_inventory', '_hash', '_str')
+
+    _buf: bytes
+    _begin: int
+    _end: int
+    _inventory: Optional[Inventory]
+    _hash: Optional[int]
+    _str: Optional[str]
+
+    def __init__(self, data: Union[List[Sound], str, Word], inventory: Optional[Inventory] = None) -> None:
+        """
+        :param inventory: inventory to read a string with, the default inventory if None. Words built from sounds
+                          belong to the inventory of those sounds.
+        """
+        if type(data) == str:
+            self._inventory = get_default_inventory() if inventory is None else inventory
+            self._buf = array('H', [s.get_num() for s in self._inventory.tokenize(data)]).tobytes()
+        elif isinstance(data, Word):
+            self._inventory = data._inventory
+            self._buf = data._buf[data._begin * _ID_SIZE:data._end * _ID_SIZE] if data._is_view() else data._buf
+        elif type(data) == list and (len(data) == 0 or type(data[0]) == Sound):
+            self._inventory = inventory
+
+            for sound in data:
+                if sound.get_inventory() is None:
+                    raise ValueError("Sound %s does not belong to any inventory" % str(sound))
+
+                if self._inventory is None:
+                    self._inventory = sound.get_inventory()
+                elif sound.get_inventory() is not self._inventory:
+                    raise ValueError("Sounds of a word must come from one inventory")
+
+            self._buf = array('H', [s.get_num() for s in data]).tobytes()
         else:
             raise TypeError("data must be either sound list or string, get %s" % str(type(data)))
 
+        self._begin = 0
+        self._end = len(self._buf) // _ID_SIZE
+        self._hash = None
+        self._str = None
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int], inventory: Inventory) -> Word:
+        buf = array('H', ids).tobytes()
+        return cls._view(buf, 0, len(buf) // _ID_SIZE, inventory)
+
+    @classmethod
+    def _view(cls, buf: bytes, begin: int, end: int, inventory: Optional[Inventory]) -> Word:
+        word = cls.__new__(cls)
+        word._buf = buf
+        word._begin = begin
+        word._end = end
+        word._inventory = inventory
+        word._hash = None
+        word._str = None
+        return word
+
+    def _is_view(self) -> bool:
+        return self._begin != 0 or self._end * _ID_SIZE != len(self._buf)
+
+    def _bytes(self) -> Union[bytes, memoryview]:
+        """
+        the packed sound numbers of this word, without copying them
+        """
+        if self._is_view():
+            return memoryview(self._buf)[self._begin * _ID_SIZE:self._end * _ID_SIZE]
+
+        return self._buf
+
+    def get_ids(self) -> memoryview:
+        return memoryview(self._buf)[self._begin * _ID_SIZE:self._end * _ID_SIZE].cast('H')
+
+    def get_inventory(self) -> Optional[Inventory]:
+        return self._inventory
+
     def get_sounds(self) -> List[Sound]:
-        return self._sounds
+        return [self._inventory.get_sound_by_num(i) for i in self.get_ids()]
 
-    def change_word(self, index: int, target: Optional[None, Word]) -> Word:
-        clone_sounds = [s for s in self._sounds]
+    def change_word(self, index: int, target: Optional[Word]) -> Word:
+        begin = self._begin * _ID_SIZE
+        split = (self._begin + index) * _ID_SIZE
+        end = self._end * _ID_SIZE
+        target_bytes = b'' if target is None else target._bytes()
 
-        if target is None:
-            clone_sounds.pop(index)
-        else:
-            clone_sounds = clone_sounds[:index] + target.get_sounds() + clone_sounds[index + 1:]
+        return Word._view(b''.join([self._buf[begin:split], target_bytes, self._buf[split + _ID_SIZE:end]]), 0,
+                          len(self) - 1 + (0 if target is None else len(target)), self._inventory)
 
-        return Word(clone_sounds)
+    def matches_at(self, content: Word, index: int) -> bool:
+        """
+        whether content occurs in this word starting at index; indexes outside the word never match
+        """
+        if index < 0 or index + len(content) > len(self):
+            return False
+
+        return self._buf.startswith(content._bytes(), (self._begin + index) * _ID_SIZE, self._end * _ID_SIZE)
 
     def index(self, content: Word, start_index: int) -> int:
-        con_len = len(content)
+        pattern = content._bytes()
+        end = self._end * _ID_SIZE
+        loc = self._buf.find(pattern, (self._begin + max(start_index, 0)) * _ID_SIZE, end)
 
-        for i in range(start_index, len(self)):
-            if i + con_len <= len(self) and Word(self._sounds[i:i + con_len]) == content:
-                return i
+        while loc >= 0 and loc % _ID_SIZE != 0:
+            loc = self._buf.find(pattern, loc + 1, end)
 
-        return -1
+        if loc < 0:
+            return -1
 
-    def __str__(self) -> str:
-        word_str = ""
+        return loc // _ID_SIZE - self._begin
 
-        for sound in self._sounds:
-            word_str += str(sound)
+    def __str__(self) -> str:
+        if self._str is None:
+            self._str = "".join([self._inventory.get_sound_by_num(i).get_symbol() for i in self.get_ids()])
 
-        return word_str
+        return self._str
 
     def __len__(self):
-        return len(self._sounds)
+        return self._end - self._begin
 
     def __hash__(self):
-        return hash(str(self))
+        if self._hash is None:
+            self._hash = hash(self._bytes())
+
+        return self._hash
 
     def __getitem__(self, item) -> Word:
         if type(item) == int:
-            return Word([self._sounds[item]])
+            length = len(self)
+
+            if item < -length or item >= length:
+                raise IndexError("word index out of range")
+
+            begin = self._begin + (item if item >= 0 else length + item)
+            return Word._view(self._buf, begin, begin + 1, self._inventory)
         elif type(item) == slice:
-            return Word(self._sounds[item])
+            start, stop, step = item.indices(len(self))
+
+            if step != 1:
+                return Word.from_ids(self.get_ids()[item], self._inventory)
+
+            return Word._view(self._buf, self._begin + start, self._begin + max(start, stop), self._inventory)
         else:
             raise TypeError("can only use int as index to words")
 
+    def __reduce__(self) -> Tuple[object, Tuple[Optional[str], List[int]]]:
+        return _restore_word, (None if self._inventory is None else self._inventory.get_name(), self.get_ids().tolist())
+
     def __eq__(self, other: Word) -> bool:
-        return str(self) == str(other)
+        if not isinstance(other, Word):
+            return NotImplemented
 
-        # if len(self) == len(other):
-        #     for i in range(0, len(self._sounds)):
-        #         if self.get_sounds()[i] != other.get_sounds()[i]:
-        #             return False
-        #
-        #     return True
-        #
-        # return False
+        if len(self) != len(other):
+            return False
+
+        if self._inventory is not other._inventory and len(self) > 0:
+            return False
+
+        return self._bytes() == other._bytes()
 
     def __ne__(self, other: Word) -> bool:
-        return str(self) != str(other)
-
-        # if len(self) != len(other):
-        #     return True
-        #
-        # for i in range(0, len(self._sounds)):
-        #     if self.get_sounds()[i] != other.get_sounds()[i]:
-        #         return True
-        #
-        # return False
+        if not isinstance(other, Word):
+            return NotImplemented
+
+        return not self == other
+
+
+def _restore_word(inventory_name: Optional[str], ids: List[int]) -> Word:
+    return Word.from_ids(ids, None if inventory_name is None else get_inventory(inventory_name))